@@ -1,3 +1,5 @@
+import numpy
+from sqlalchemy import Table
 from lsst.sims.catalogs.db import CatalogDBObject
 
 __all__ = ["CompoundCatalogDBObject"]
@@ -24,6 +26,13 @@ class CompoundCatalogDBObject(CatalogDBObject):
     In cases where the CatalogDBObject does not change the name of the column, the column
     will also be returned by its original, un-mangled name.
 
+    When several of the requested columns are the same SQL expression (e.g. the
+    raJ2000 of each of several galaxy component CatalogDBObjects), the expression
+    is only selected once.  The other names are served as aliases of the same
+    column of the returned recarray (fields of its dtype with the same offset),
+    so they must not be modified in place.  This is not done if _final_pass has
+    been overridden, since it may modify the columns in place.
+
     In cases where a custom query_columns method must be implemented, this class
     can be sub-classed and the custom method added as a member method.  In that
     case, the _table_restriction member variable should be set to a list of table
@@ -51,7 +60,10 @@ class CompoundCatalogDBObject(CatalogDBObject):
         read in classes without an active connection and establish its
         own connection in this constructor.  This means that all connection
         parameters must be specified in the class definitions of the classes
-        passed into catalogDbObjectClassList.
+        passed into catalogDbObjectClassList.  The classes are not instantiated
+        at all (unless they define their own __init__, or idColKey is only set
+        on instantiation); their columns are worked out from one reflection
+        of the shared table, however many classes there are.
 
         @param [in] connection is an optional instantiation of DBConnection
         representing an active connection to the database required by
@@ -66,21 +78,56 @@ class CompoundCatalogDBObject(CatalogDBObject):
         for ix in range(len(self._dbObjectClassList)):
             self._nameList.append(self._dbObjectClassList[ix].objid)
 
+        first_class = self._dbObjectClassList[0]
+        if connection is None:
+            connection = self._get_connection(getattr(first_class, 'database', None),
+                                              getattr(first_class, 'driver', None),
+                                              getattr(first_class, 'host', None),
+                                              getattr(first_class, 'port', None))
+
+        # reflect the shared table once; the member classes read their
+        # columns from it without being instantiated (see _member_columns)
+        self.connection = connection
+        self.table = Table(first_class.tableid, connection.metadata, autoload=True)
+
         self._make_columns()
         self._make_dbTypeMap()
         self._make_dbDefaultValues()
 
-        dbo = self._dbObjectClassList[0](connection=connection)
-        # need to instantiate the first one because sometimes
-        # idColKey is not defined until instantiation
-        # (see GalaxyTileObj in sims_catUtils/../baseCatalogModels/GalaxyModels.py)
+        if first_class.idColKey is None:
+            # sometimes idColKey is not defined until instantiation
+            # (see GalaxyTileObj in sims_catUtils/../baseCatalogModels/GalaxyModels.py)
+            dbo = first_class(connection=connection)
+        else:
+            dbo = first_class
 
         self.tableid = dbo.tableid
         self.idColKey = dbo.idColKey
         self.raColName = dbo.raColName
         self.decColName = dbo.decColName
 
-        super(CompoundCatalogDBObject, self).__init__(connection=dbo.connection)
+        super(CompoundCatalogDBObject, self).__init__(connection=connection)
+
+    def _id_column_key(self):
+        """
+        Return the key of self.columnMap holding the expression of the id
+        column: idColKey if the first CatalogDBObject reads it un-mangled,
+        and its mangled name otherwise
+        """
+        if self.idColKey in self.columnMap:
+            return self.idColKey
+        return '%s_%s' % (self._nameList[0], self.idColKey)
+
+    def _member_columns(self, dbo):
+        """
+        Return the columns of the member CatalogDBObject class dbo.  They are
+        worked out from the reflection of the shared table in self.table, unless
+        dbo has its own __init__ (which may change its columns), in which case
+        dbo is instantiated on the shared connection.
+        """
+        if dbo.__init__.im_func is CatalogDBObject.__init__.im_func:
+            return dbo._columns_for_table(self.table)
+        return dbo(connection=self.connection).columns
 
     def _make_columns(self):
         """
@@ -91,8 +138,7 @@ class CompoundCatalogDBObject(CatalogDBObject):
         column_names = []
         self.columns = []
         for dbo, dbName in zip(self._dbObjectClassList, self._nameList):
-            db_inst = dbo()
-            for row in db_inst.columns:
+            for row in self._member_columns(dbo):
                 new_row = [ww for ww in row]
                 new_row[0] = str('%s_%s' % (dbName, row[0]))
                 if new_row[1] is None:
@@ -214,3 +260,118 @@ class CompoundCatalogDBObject(CatalogDBObject):
             if tableList[0] not in self._table_restriction:
                 raise RuntimeError("This CompoundCatalogDBObject does not support " +
                                    "the table '%s' " % tableList[0])
+
+    def _deduplicate_columns(self, colnames):
+        """
+        Find the columns in colnames that are the same SQL expression (with
+        the same type and default value) as a column earlier in colnames.
+
+        @param [in] colnames is a list of column names (keys of self.columnMap)
+
+        @param [out] the list of the columns to select and a dict mapping
+        each of the other columns to the selected column it is an alias of
+        """
+        if self._has_custom_final_pass():
+            return colnames, {}
+
+        idColName = self.columnMap[self._id_column_key()]
+        selected = []
+        aliases = {}
+        canonical = {}
+        for col in colnames:
+            val = self.columnMap.get(col, None)
+            if val is None or val == idColName:
+                # leave the id column (and invalid names) to _get_column_query
+                selected.append(col)
+                continue
+
+            key = (val, self.typeMap[col], self.dbDefaultValues.get(col, None))
+            if key in canonical:
+                aliases[col] = canonical[key]
+                continue
+
+            # numpy cannot alias fields that hold python objects
+            if not numpy.dtype([(str(col),)+self.typeMap[col]]).hasobject:
+                canonical[key] = col
+            selected.append(col)
+
+        return selected, aliases
+
+    def query_columns(self, colnames=None, chunk_size=None,
+                      obs_metadata=None, constraint=None, limit=None,
+                      sample_fraction=None, seed=0):
+        """
+        Execute a query (see CatalogDBObject.query_columns), selecting the
+        SQL expression of columns with the same expression only once
+        """
+        if colnames is None:
+            colnames = [k for k in self.columnMap]
+
+        selected, aliases = self._deduplicate_columns(colnames)
+        results = super(CompoundCatalogDBObject, self).query_columns(colnames=selected,
+                                                                     chunk_size=chunk_size,
+                                                                     obs_metadata=obs_metadata,
+                                                                     constraint=constraint,
+                                                                     limit=limit,
+                                                                     sample_fraction=sample_fraction,
+                                                                     seed=seed)
+        if len(aliases) == 0:
+            return results
+
+        return _AliasingChunkIterator(results, colnames, aliases)
+
+
+class _AliasingChunkIterator(object):
+    """
+    Wraps the ChunkIterator of a query from which duplicate columns were
+    removed, adding the removed columns to each chunk as aliases of the
+    columns that were selected in their place
+    """
+
+    def __init__(self, chunk_iterator, colnames, aliases):
+        """
+        @param [in] chunk_iterator is the ChunkIterator of the query
+
+        @param [in] colnames is the list of columns that were requested
+
+        @param [in] aliases is a dict mapping each column removed from the
+        query to the column that was selected in its place
+        """
+        self._chunk_iterator = chunk_iterator
+        self._colnames = colnames
+        self._aliases = aliases
+        self._dtype = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        chunk = self._chunk_iterator.next()
+        if self._dtype is None:
+            self._dtype = self._aliased_dtype(chunk.dtype)
+        return chunk.view(dtype=(numpy.record, self._dtype), type=numpy.recarray)
+
+    def _aliased_dtype(self, dtype):
+        """
+        Return dtype with the removed columns added as fields
+        overlapping the columns selected in their place
+        """
+        # the first column of a query is always the id column;
+        # the others are in the requested order
+        order = [dtype.names[0]]
+        for col in self._colnames:
+            if col not in order and (col in dtype.fields or col in self._aliases):
+                order.append(col)
+        for col in dtype.names:
+            if col not in order:
+                order.append(col)
+
+        formats = []
+        offsets = []
+        for col in order:
+            field = dtype.fields[self._aliases.get(col, col)]
+            formats.append(field[0])
+            offsets.append(field[1])
+
+        return numpy.dtype({'names': order, 'formats': formats, 'offsets': offsets,
+                            'itemsize': dtype.itemsize})
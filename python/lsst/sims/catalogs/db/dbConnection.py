@@ -1,7 +1,9 @@
 import warnings
 import numpy
 import os
+import zlib
 import inspect
+import threading
 from StringIO import StringIO
 from collections import OrderedDict
 
@@ -20,7 +22,7 @@ from lsst.sims.utils.CodeUtilities import sims_clean_up
 #TODO: test for cdecimal and use it if it exists.
 import decimal
 
-__all__ = ["ChunkIterator", "DBObject", "CatalogDBObject", "fileDBObject"]
+__all__ = ["ChunkIterator", "DBConnectionRegistry", "DBObject", "CatalogDBObject", "fileDBObject"]
 
 def valueOfPi():
     """
@@ -51,7 +53,7 @@ def declareTrigFunctions(conn,connection_rec,connection_proxy):
 
 class ChunkIterator(object):
     """Iterator for query chunks"""
-    def __init__(self, dbobj, query, chunk_size, arbitrarySQL = False):
+    def __init__(self, dbobj, query, chunk_size, arbitrarySQL = False, sampler = None):
         self.dbobj = dbobj
         self.exec_query = dbobj.connection.session.execute(query)
         self.chunk_size = chunk_size
@@ -62,10 +64,24 @@ class ChunkIterator(object):
         #rather than _postprocess_results
         self.arbitrarySQL = arbitrarySQL
 
+        #sampler is an optional function which takes a chunk and returns
+        #the rows of it to keep (used when a sample of the query results
+        #cannot be selected in SQL); chunks it empties are skipped
+        self.sampler = sampler
+
     def __iter__(self):
         return self
 
     def next(self):
+        if self.sampler is None:
+            return self._next_chunk()
+
+        while True:
+            chunk = self.sampler(self._next_chunk())
+            if len(chunk) > 0:
+                return chunk
+
+    def _next_chunk(self):
         if self.chunk_size is None and not self.exec_query.closed:
             chunk = self.exec_query.fetchall()
             return self._postprocess_results(chunk)
@@ -233,6 +249,103 @@ class DBConnection(object):
         return self._verbose
 
 
+class DBConnectionRegistry(object):
+    """
+    A registry of open DBConnections, so that every object connecting to the
+    same database shares one DBConnection (and so one sqlalchemy engine).
+    CatalogDBObject (and so CompoundCatalogDBObject and CompoundInstanceCatalog)
+    gets its connections from one process-wide registry.
+
+    Connections are identified by their normalized parameters (see key()),
+    so that, e.g., a port given as an int or a string, or two different
+    paths to the same sqlite file, find the same connection.
+    """
+
+    def __init__(self, connections=None):
+        """
+        @param [in] connections is an optional list in which to keep the
+        connections (e.g. one that sims_clean_up empties)
+        """
+        if connections is None:
+            connections = []
+        self.connections = connections
+        self.opened = 0
+        self.reused = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(database, driver, host, port):
+        """
+        Return the normalized (database, driver, host, port) tuple identifying
+        a connection.  sqlite connections are identified by the absolute path
+        of their file alone; host and port are ignored, as in DBConnection.
+        """
+        database = None if database is None else str(database)
+        driver = None if driver is None else str(driver)
+        if driver is not None and 'sqlite' in driver:
+            if database is not None and database != ':memory:' and '//' not in database:
+                database = os.path.normcase(os.path.abspath(database))
+            return (database, driver, None, None)
+        host = None if host is None else str(host)
+        port = None if port is None else str(port)
+        return (database, driver, host, port)
+
+    def find(self, database, driver, host, port):
+        """
+        Return the registered DBConnection with these parameters,
+        or None if there is none
+        """
+        desired = self.key(database, driver, host, port)
+        with self._lock:
+            for conn in self.connections:
+                if self.key(conn.database, conn.driver, conn.host, conn.port) == desired:
+                    return conn
+        return None
+
+    def get_connection(self, database, driver, host, port, verbose=False):
+        """
+        Return the registered DBConnection with these parameters,
+        opening (and registering) it if there is none
+        """
+        with self._lock:
+            conn = self.find(database, driver, host, port)
+            if conn is not None:
+                self.reused += 1
+                return conn
+
+            conn = DBConnection(database=database, driver=driver, host=host, port=port,
+                                verbose=verbose)
+            self.connections.append(conn)
+            self.opened += 1
+            return conn
+
+    def register(self, conn):
+        """
+        Add an already open DBConnection to the registry (unless a
+        connection with the same parameters is registered).  Returns
+        the registered connection.
+        """
+        with self._lock:
+            registered = self.find(conn.database, conn.driver, conn.host, conn.port)
+            if registered is not None:
+                return registered
+            self.connections.append(conn)
+            return conn
+
+    def statistics(self):
+        """
+        Return the number of open connections, and the numbers of
+        connections opened and re-used through the registry
+        """
+        with self._lock:
+            return OrderedDict([('connections', len(self.connections)),
+                                ('opened', self.opened),
+                                ('reused', self.reused)])
+
+    def __len__(self):
+        return len(self.connections)
+
+
 class DBObject(object):
 
     def __init__(self, database=None, driver=None, host=None, port=None, verbose=False,
@@ -282,10 +395,10 @@ class DBObject(object):
 
     def _get_connection(self, database, driver, host, port):
         """
-        Search self._connection_cache (if it exists; it won't for DBObject, but
-        will for CatalogDBObject) for a DBConnection matching the specified
-        parameters.  If it exists, return it.  If not, open a connection to
-        the specified database, add it to the cache, and return the connection.
+        Get a DBConnection matching the specified parameters from
+        self._connection_registry (if it exists; it won't for DBObject, but
+        will for CatalogDBObject), which opens the connection if it has
+        not been opened yet.  Without a registry, open a new connection.
 
         Parameters
         ----------
@@ -298,20 +411,10 @@ class DBObject(object):
         port is the port on the remote host to connect to, if appropriate
         """
 
-        if hasattr(self, '_connection_cache'):
-            for conn in self._connection_cache:
-                if str(conn.database) == str(database):
-                    if str(conn.driver) == str(driver):
-                        if str(conn.host) == str(host):
-                            if str(conn.port) == str(port):
-                                return conn
+        if hasattr(self, '_connection_registry'):
+            return self._connection_registry.get_connection(database, driver, host, port)
 
-        conn = DBConnection(database=database, driver=driver, host=host, port=port)
-
-        if hasattr(self, '_connection_cache'):
-            self._connection_cache.append(conn)
-
-        return conn
+        return DBConnection(database=database, driver=driver, host=host, port=port)
 
     def get_table_names(self):
         """Return a list of the names of the tables in the database"""
@@ -350,6 +453,12 @@ class DBObject(object):
         """
         return results
 
+    def _has_custom_final_pass(self):
+        """
+        Return True if this class modifies its query results in _final_pass
+        """
+        return self.__class__._final_pass.im_func is not DBObject._final_pass.im_func
+
     def _postprocess_results(self, results):
         """
         This wrapper exists so that a ChunkIterator built from a DBObject
@@ -504,6 +613,9 @@ class CatalogDBObject(DBObject):
 
     _connection_cache = []  # a list to store open database connections in
 
+    # the process-wide registry of the connections in _connection_cache
+    _connection_registry = DBConnectionRegistry(_connection_cache)
+
     #Provide information if this object should be tested in the unit test
     doRunTest = False
     testObservationMetaData = None
@@ -599,6 +711,14 @@ class CatalogDBObject(DBObject):
         self._make_column_map()
         self._make_type_map()
 
+    @classmethod
+    def connection_statistics(cls):
+        """
+        Return the numbers of database connections open, opened
+        and re-used by CatalogDBObjects (see DBConnectionRegistry)
+        """
+        return cls._connection_registry.statistics()
+
     def show_mapped_columns(self):
         for col in self.columnMap.keys():
             print "%s -- %s"%(col, self.typeMap[col][0].__name__)
@@ -633,26 +753,45 @@ class CatalogDBObject(DBObject):
                                    for el in self.columns])
 
     def _make_default_columns(self):
-        if self.columns:
-            colnames = [el[0] for el in self.columns]
-        else:
+        if not self.columns:
             self.columns = []
-            colnames = []
-        for col in self.table.c.keys():
-            dbtypestr = self.table.c[col].type.__visit_name__
+        self._append_default_columns(self.columns, self.table, self.dbTypeMap, self.verbose)
+
+    @staticmethod
+    def _append_default_columns(columns, table, dbTypeMap, verbose=False):
+        """
+        Append a default column (mapped to itself, with the type given by
+        dbTypeMap) to the list columns for every column of table that is
+        not already in columns
+        """
+        colnames = [el[0] for el in columns]
+        for col in table.c.keys():
+            dbtypestr = table.c[col].type.__visit_name__
             dbtypestr = dbtypestr.upper()
             if col in colnames:
-                if self.verbose: #Warn for possible column redefinition
+                if verbose: #Warn for possible column redefinition
                     warnings.warn("Database column, %s, overridden in self.columns... "%(col)+
                                   "Skipping default assignment.")
-            elif dbtypestr in self.dbTypeMap:
-                self.columns.append((col, col)+self.dbTypeMap[dbtypestr])
+            elif dbtypestr in dbTypeMap:
+                columns.append((col, col)+dbTypeMap[dbtypestr])
             else:
-                if self.verbose:
+                if verbose:
                     warnings.warn("Can't create default column for %s.  There is no mapping "%(col)+
                                   "for type %s.  Modify the dbTypeMap, or make a custom columns "%(dbtypestr)+
                                   "list.")
 
+    @classmethod
+    def _columns_for_table(cls, table):
+        """
+        Return the list of columns an instantiation of this class would
+        have if it read table (an already reflected sqlalchemy Table), without
+        instantiating the class (i.e. without connecting to the database)
+        """
+        columns = list(cls.columns) if cls.columns else []
+        if cls.generateDefaultColumnMap:
+            cls._append_default_columns(columns, table, cls.dbTypeMap)
+        return columns
+
     def _get_column_query(self, colnames=None):
         """Given a list of valid column names, return the query object"""
         if colnames is None:
@@ -668,11 +807,8 @@ class CatalogDBObject(DBObject):
             raise ValueError('entries in colnames must be in self.columnMap')
 
         # Get the first query
-        idColName = self.columnMap[self.idColKey]
-        if idColName in vals:
-            idLabel = self.idColKey
-        else:
-            idLabel = idColName
+        idColName = self.columnMap[self._id_column_key()]
+        idLabel = self._id_column_label(colnames)
 
         query = self.connection.session.query(self.table.c[idColName].label(idLabel))
 
@@ -689,6 +825,151 @@ class CatalogDBObject(DBObject):
 
         return query
 
+    def _id_column_key(self):
+        """
+        Return the key of self.columnMap holding the expression of the id column
+        """
+        return self.idColKey
+
+    def _id_column_label(self, colnames=None):
+        """
+        Return the name of the field of the query results of colnames (see
+        _get_column_query) holding the ids: idColKey if one of colnames is the
+        id column, and the name of the id column in the table otherwise
+        """
+        if colnames is None:
+            colnames = [k for k in self.columnMap]
+        idColName = self.columnMap[self._id_column_key()]
+        if idColName in [self.columnMap[k] for k in colnames]:
+            return self.idColKey
+        return idColName
+
+    # the modulus and multiplier of the hash used to sample rows by
+    # their ids (see sample_predicate).  The modulus is the largest prime
+    # whose square fits in a signed 32-bit integer, so the hash cannot
+    # overflow even when the id column is a 32-bit integer.
+    _sample_modulus = 46337
+    _sample_multiplier = 27644
+
+    # the dialects in which sample_predicate can express the hash
+    _sample_dialects = ('sqlite', 'postgresql', 'mysql', 'mssql')
+
+    @classmethod
+    def _sample_threshold(cls, sample_fraction):
+        if sample_fraction < 0.0 or sample_fraction > 1.0:
+            raise RuntimeError("sample_fraction must be between 0 and 1; "
+                               "you gave %s" % str(sample_fraction))
+        return int(round(sample_fraction*cls._sample_modulus))
+
+    @classmethod
+    def sample_mask(cls, ids, sample_fraction, seed=0):
+        """
+        Return a numpy array of booleans which is True for the ids in the
+        sample selected by sample_predicate(sample_fraction, seed)
+
+        @param [in] ids is a numpy array of object ids (ids that are not
+        integers are replaced by the CRC-32 checksums of their string forms)
+
+        @param [in] sample_fraction is the fraction of objects to select
+
+        @param [in] seed is an integer choosing which sample to select
+        """
+        threshold = cls._sample_threshold(sample_fraction)
+        modulus = cls._sample_modulus
+        ids = numpy.asarray(ids)
+        if ids.dtype.kind not in ('i', 'u'):
+            ids = numpy.array([zlib.crc32(str(obj_id)) & 0xffffffff for obj_id in ids],
+                              dtype=numpy.int64)
+        hashed = ((numpy.abs(ids.astype(numpy.int64)) % modulus)*cls._sample_multiplier +
+                  seed % modulus) % modulus
+        return hashed < threshold
+
+    def sample_predicate(self, sample_fraction, seed=0):
+        """
+        Return an SQL predicate which selects a deterministic, pseudo-random
+        fraction of the rows of this table, according to a hash of their
+        idColKey (so the same objects are selected every time the same
+        sample_fraction and seed are asked for).  Returns None if the
+        sample cannot be selected in SQL, because idColKey is not an integer
+        column or the dialect is not known to support the hash; in that
+        case, use sample_mask on the query results.
+
+        @param [in] sample_fraction is the fraction of objects to select
+
+        @param [in] seed is an integer choosing which sample to select
+        """
+        threshold = self._sample_threshold(sample_fraction)
+
+        dialect = self.connection.engine.dialect
+        if dialect.name not in self._sample_dialects:
+            return None
+
+        id_key = self._id_column_key()
+        if numpy.dtype(self.typeMap[id_key][0]).kind not in ('i', 'u'):
+            return None
+
+        return '((ABS(%s) %% %d)*%d + %d) %% %d < %d' % (self._column_expression(id_key),
+                                                        self._sample_modulus,
+                                                        self._sample_multiplier,
+                                                        seed % self._sample_modulus,
+                                                        self._sample_modulus,
+                                                        threshold)
+
+    def _column_expression(self, col):
+        """
+        Return the SQL expression for the column col of self.columnMap
+        """
+        val = self.columnMap[col]
+        if val == col:
+            return self.connection.engine.dialect.identifier_preparer.quote(col)
+        return '(%s)' % val
+
+    def not_null_predicates(self, colnames):
+        """
+        Return a list of SQL predicates which exclude the rows in which any of
+        the columns in colnames is NULL (or NaN, for float columns in dialects
+        that can store NaN).  The predicates are written in terms of the
+        expressions in self.columnMap, so they can be added to the constraint
+        passed to query_columns.
+
+        Columns that have an entry in self.dbDefaultValues are skipped, since
+        their NULLs are replaced after the query.  If this class post-processes
+        its query results with a custom _final_pass, no predicates are returned,
+        since _final_pass may change which values are null.
+        """
+        if self._has_custom_final_pass():
+            return []
+
+        dialect = self.connection.engine.dialect
+        predicates = []
+        for col in colnames:
+            if col not in self.columnMap or col in self.dbDefaultValues:
+                continue
+
+            expr = self._column_expression(col)
+            predicates.append('%s IS NOT NULL' % expr)
+            if dialect.name == 'postgresql' and self.typeMap[col][0] is float:
+                predicates.append("%s <> 'NaN'" % expr)
+
+        return predicates
+
+    @staticmethod
+    def combine_constraints(constraint, predicates):
+        """
+        Combine an SQL constraint (a string or None) with a list of SQL
+        predicates, returning a single constraint string (or None if there
+        is nothing to constrain)
+        """
+        clauses = []
+        if constraint is not None:
+            clauses.append('(%s)' % constraint)
+        clauses += ['(%s)' % pp for pp in predicates]
+        if len(clauses) == 0:
+            return None
+        if len(clauses) == 1 and constraint is not None:
+            return constraint
+        return ' AND '.join(clauses)
+
     def filter(self, query, bounds):
         """Filter the query by the associated metadata"""
         if bounds is not None:
@@ -733,7 +1014,8 @@ class CatalogDBObject(DBObject):
         return self._final_pass(retresults)
 
     def query_columns(self, colnames=None, chunk_size=None,
-                      obs_metadata=None, constraint=None, limit=None):
+                      obs_metadata=None, constraint=None, limit=None,
+                      sample_fraction=None, seed=0):
         """Execute a query
 
         **Parameters**
@@ -753,6 +1035,12 @@ class CatalogDBObject(DBObject):
               a string which is interpreted as SQL and used as a predicate on the query
             * limit : int (optional)
               limits the number of rows returned by the query
+            * sample_fraction : float (optional)
+              if specified, only return a deterministic, pseudo-random sample
+              of this fraction of the rows, selected by a hash of idColKey
+              (in SQL where possible; see sample_predicate)
+            * seed : int (optional)
+              chooses which sample sample_fraction selects (default 0)
 
         **Returns**
 
@@ -770,10 +1058,19 @@ class CatalogDBObject(DBObject):
         if constraint is not None:
             query = query.filter(constraint)
 
+        sampler = None
+        if sample_fraction is not None:
+            predicate = self.sample_predicate(sample_fraction, seed)
+            if predicate is not None:
+                query = query.filter(predicate)
+            else:
+                id_label = self._id_column_label(colnames)
+                sampler = lambda chunk: chunk[self.sample_mask(chunk[id_label], sample_fraction, seed)]
+
         if limit is not None:
             query = query.limit(limit)
 
-        return ChunkIterator(self, query, chunk_size)
+        return ChunkIterator(self, query, chunk_size, sampler=sampler)
 
 sims_clean_up.targets.append(CatalogDBObject._connection_cache)
 
@@ -0,0 +1,467 @@
+"""
+An id-indexed store of per-object column values that outlives the chunks
+(and, optionally, the runs) of the catalogs that fill it; see the
+@persistent_cached decorator.
+"""
+import os
+import re
+import threading
+import numpy as np
+from collections import OrderedDict
+
+__all__ = ["PersistentColumnStore"]
+
+
+def _keep_last(ids, *arrays):
+    """
+    Sort ids (and the arrays that go with them) by id, keeping only the
+    last occurrence of each id
+    """
+    order = np.argsort(ids, kind='mergesort')[::-1]
+    ids = ids[order]
+    ids, first_dexes = np.unique(ids, return_index=True)
+    return (ids,) + tuple(array[order][first_dexes] for array in arrays)
+
+
+def _search(sorted_ids, ids):
+    """
+    Return the indexes in sorted_ids (a sorted array) of each of ids, and a
+    numpy array of booleans that is True where an id was found
+    """
+    dexes = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids)-1)
+    return dexes, sorted_ids[dexes] == ids
+
+
+class PersistentColumnStore(object):
+    """
+    A store of one value per object, keyed on the object's type and id.
+
+    Objects of different types (e.g. the bulges and disks of galaxies, read
+    from different CatalogDBObjects) can share ids, so every value is stored
+    under an object_type (by default None) as well as its id.  @persistent_cached
+    uses the objid of the catalog's CatalogDBObject as the object_type.
+
+    The most recently used values are kept in memory, up to max_entries of
+    them (older ones are evicted first), in sorted arrays of ids and values
+    for each object type.  If filename is given, the values are also kept on
+    disk, in a pair of .npy files per object type (root_ids.npy holding the
+    sorted ids and root_values.npy holding the values, where root is filename
+    for the object_type None and filename.object_type otherwise) which are
+    memory mapped, so that values survive eviction from memory and can be
+    shared between runs.
+
+    Values that are not yet on disk when they are evicted are not merged
+    into those files straight away: all of the values evicted by one call to
+    store() are written, sorted, to one run file (root_run<N>.npy).  Runs are
+    merged with each other as they accumulate, so that there are only ever a
+    few of them, and are merged into the main files by flush(), which is called
+    at the end of InstanceCatalog.write_catalog(), and by close().  Run files
+    left behind by a store that was never flushed are discarded.
+
+    Every id looked up is counted as a hit (found in memory or on disk) or a
+    miss; see statistics().
+
+    The store can be shared by catalogs being written on different threads
+    (e.g. by parallelCatalogWriter); its public methods hold a lock.
+    """
+
+    def __init__(self, max_entries=1000000, filename=None, dtype=None):
+        """
+        @param [in] max_entries is the number of values to keep in memory
+
+        @param [in] filename is the root of the names of the files in which
+        to keep the values on disk (optional; if None, the store only lives
+        in memory)
+
+        @param [in] dtype is the numpy dtype of the values (optional; if None,
+        it is taken from the first values stored or from the files on disk)
+        """
+        if max_entries < 1:
+            raise RuntimeError("PersistentColumnStore needs max_entries >= 1; "
+                               "you gave %s" % str(max_entries))
+
+        self.max_entries = max_entries
+        self.filename = filename
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        # the (sorted ids, values, last use, not yet on disk) arrays
+        # in memory of each object type
+        self._memory = {}
+        # the clock against which the last use of the values in memory is kept
+        self._clock = 0
+        # the memory mapped (ids, values) on disk of each object type
+        self._disk = {}
+        # the list of (file name, memory mapped run) of each object type,
+        # from the oldest run to the newest
+        self._runs = {}
+        self._n_runs = 0
+        # the (object_type, ids, values) stored since _take_stored() was
+        # last called, if the store is recording them (see _record_stores)
+        self._stored = None
+        self._lock = threading.RLock()
+
+        if filename is not None:
+            # the files of the object_type None
+            self.ids_file_name, self.values_file_name = self._file_names(None)
+            self._remove_run_files()
+            self._open_disk_files()
+
+    def _root(self, object_type):
+        if object_type is None:
+            return self.filename
+        return '%s.%s' % (self.filename, object_type)
+
+    def _file_names(self, object_type):
+        """
+        Return the names of the files holding the ids and
+        the values of object_type
+        """
+        root = self._root(object_type)
+        return root + '_ids.npy', root + '_values.npy'
+
+    def _disk_object_types(self):
+        """
+        Return a list of the object types with files on disk
+        """
+        object_types = []
+        if os.path.exists(self._file_names(None)[0]):
+            object_types.append(None)
+
+        file_dir = os.path.dirname(os.path.abspath(self.filename))
+        prefix = os.path.basename(self.filename) + '.'
+        suffix = '_ids.npy'
+        for file_name in sorted(os.listdir(file_dir)):
+            if file_name.startswith(prefix) and file_name.endswith(suffix):
+                object_types.append(file_name[len(prefix):-len(suffix)])
+        return object_types
+
+    def _remove_run_files(self):
+        """
+        Delete the run files of every object type
+        """
+        file_dir = os.path.dirname(os.path.abspath(self.filename))
+        run_pattern = re.compile(re.escape(os.path.basename(self.filename)) +
+                                 r'(\..*)?_run[0-9]+\.npy$')
+        for file_name in os.listdir(file_dir):
+            if run_pattern.match(file_name):
+                os.unlink(os.path.join(file_dir, file_name))
+        self._runs = {}
+
+    def _open_disk_files(self):
+        for object_type in self._disk_object_types():
+            self._open_object_type(object_type)
+
+    def _open_object_type(self, object_type):
+        ids_file_name, values_file_name = self._file_names(object_type)
+        if not os.path.exists(ids_file_name):
+            self._disk.pop(object_type, None)
+            return
+
+        disk_ids = np.load(ids_file_name, mmap_mode='r')
+        disk_values = np.load(values_file_name, mmap_mode='r')
+        if self.dtype is None:
+            self.dtype = disk_values.dtype
+        elif self.dtype != disk_values.dtype:
+            raise RuntimeError("PersistentColumnStore was asked for dtype %s, "
+                               "but %s holds values of dtype %s"
+                               % (str(self.dtype), values_file_name,
+                                  str(disk_values.dtype)))
+        self._disk[object_type] = (disk_ids, disk_values)
+
+    def _disk_tiers(self, object_type):
+        """
+        Return a list of the (sorted ids, values) on disk of object_type,
+        from the newest to the oldest
+        """
+        tiers = [(run['id'], run['value'])
+                 for file_name, run in reversed(self._runs.get(object_type, []))]
+        if object_type in self._disk:
+            tiers.append(self._disk[object_type])
+        return tiers
+
+    def __len__(self):
+        """
+        The number of distinct (object type, id) pairs in the store
+        """
+        with self._lock:
+            if self.filename is None:
+                return sum(len(memory[0]) for memory in self._memory.values())
+
+            n_entries = 0
+            object_types = set(self._disk.keys())
+            object_types.update(self._runs.keys())
+            object_types.update(self._memory.keys())
+            for object_type in object_types:
+                ids_list = [np.asarray(ids) for ids, values in self._disk_tiers(object_type)]
+                if object_type in self._memory:
+                    ids_list.append(self._memory[object_type][0])
+                n_entries += len(np.unique(np.concatenate(ids_list)))
+            return int(n_entries)
+
+    def lookup(self, ids, object_type=None):
+        """
+        Look up the values of a sequence of ids of objects of object_type.
+
+        Returns a numpy array of values (with arbitrary values where an id was
+        not found) and a numpy array of booleans that is True where an id
+        was found.
+        """
+        with self._lock:
+            return self._lookup(ids, object_type)
+
+    def _lookup(self, ids, object_type):
+        ids = np.asarray(ids)
+        found = np.zeros(len(ids), dtype=bool)
+        if self.dtype is None or len(ids) == 0:
+            self.misses += len(ids)
+            return np.zeros(len(ids)), found
+
+        values = np.zeros(len(ids), dtype=self.dtype)
+
+        if object_type in self._memory:
+            memory_ids, memory_values, last_use, dirty = self._memory[object_type]
+            dexes, found = _search(memory_ids, ids)
+            values[found] = memory_values[dexes[found]]
+            # mark them as the most recently used
+            last_use[dexes[found]] = self._clock + np.arange(len(ids))[found]
+            self._clock += len(ids)
+
+        n_memory = found.sum()
+
+        for disk_ids, disk_values in self._disk_tiers(object_type):
+            if found.all():
+                break
+            unfound = np.where(~found)[0]
+            dexes, on_disk = _search(disk_ids, ids[unfound])
+            values[unfound[on_disk]] = disk_values[dexes[on_disk]]
+            found[unfound[on_disk]] = True
+
+        n_found = found.sum()
+        self.memory_hits += n_memory
+        self.disk_hits += n_found - n_memory
+        self.hits += n_found
+        self.misses += len(ids) - n_found
+        return values, found
+
+    def store(self, ids, values, object_type=None):
+        """
+        Store the values of a sequence of ids of objects of object_type
+        """
+        with self._lock:
+            self._store(ids, values, object_type)
+
+    def _store(self, ids, values, object_type):
+        values = np.asarray(values)
+        if self.dtype is None:
+            self.dtype = values.dtype
+        ids = np.asarray(ids)
+        if len(ids) == 0:
+            return
+
+        values = values.astype(self.dtype)
+        last_use = self._clock + np.arange(len(ids))
+        self._clock += len(ids)
+        if self._stored is not None:
+            # the values are handed back rather than written to disk
+            self._stored.append((object_type, ids, values))
+            dirty = np.zeros(len(ids), dtype=bool)
+        elif self.filename is not None:
+            dirty = np.ones(len(ids), dtype=bool)
+        else:
+            dirty = np.zeros(len(ids), dtype=bool)
+
+        if object_type in self._memory:
+            old = self._memory[object_type]
+            ids, values, last_use, dirty = [np.concatenate([old_array, new_array])
+                                            for old_array, new_array in zip(old, (ids, values, last_use, dirty))]
+
+        self._memory[object_type] = _keep_last(ids, values, last_use, dirty)
+        self._evict()
+
+    def _evict(self):
+        """
+        Evict the least recently used values from memory until there are no
+        more than max_entries, writing those which are not yet on disk to
+        one run per object type
+        """
+        object_types = list(self._memory.keys())
+        sizes = [len(self._memory[object_type][0]) for object_type in object_types]
+        n_evict = sum(sizes) - self.max_entries
+        if n_evict <= 0:
+            return
+
+        last_use = np.concatenate([self._memory[object_type][2] for object_type in object_types])
+        evicted = np.zeros(len(last_use), dtype=bool)
+        evicted[np.argpartition(last_use, n_evict-1)[:n_evict]] = True
+
+        offsets = np.cumsum([0] + sizes)
+        for ix, object_type in enumerate(object_types):
+            memory_ids, memory_values, memory_last_use, dirty = self._memory[object_type]
+            type_evicted = evicted[offsets[ix]:offsets[ix+1]]
+            if not type_evicted.any():
+                continue
+
+            to_disk = type_evicted & dirty
+            if to_disk.any():
+                self._add_run(object_type, memory_ids[to_disk], memory_values[to_disk])
+
+            kept = ~type_evicted
+            if kept.any():
+                self._memory[object_type] = (memory_ids[kept], memory_values[kept],
+                                             memory_last_use[kept], dirty[kept])
+            else:
+                self._memory.pop(object_type)
+
+    def _write_run(self, object_type, ids, values):
+        """
+        Write sorted ids and their values to a new run file of object_type;
+        return the (file name, memory mapped run)
+        """
+        file_name = '%s_run%d.npy' % (self._root(object_type), self._n_runs)
+        self._n_runs += 1
+        run = np.empty(len(ids), dtype=[('id', ids.dtype), ('value', self.dtype)])
+        run['id'] = ids
+        run['value'] = values
+        with open(file_name, 'wb') as file_handle:
+            np.save(file_handle, run)
+        return file_name, np.load(file_name, mmap_mode='r')
+
+    def _add_run(self, object_type, ids, values):
+        """
+        Add a run of sorted ids and their values to the runs of object_type,
+        merging the newest runs while the one before the newest is not more
+        than twice as long (so that there are only ever a few runs, and each
+        value is only rewritten a few times before it is flushed)
+        """
+        runs = self._runs.setdefault(object_type, [])
+        runs.append(self._write_run(object_type, ids, values))
+        while len(runs) > 1 and len(runs[-2][1]) <= 2*len(runs[-1][1]):
+            (older_name, older), (newer_name, newer) = runs[-2:]
+            merged = _keep_last(np.concatenate([older['id'], newer['id']]),
+                                np.concatenate([older['value'], newer['value']]))
+            runs[-2:] = [self._write_run(object_type, *merged)]
+            del older, newer
+            for file_name in (older_name, newer_name):
+                os.unlink(file_name)
+
+    def _record_stores(self):
+        """
+        Keep a list of the values stored from now on, to be returned by
+        _take_stored(), instead of writing them to disk.  This is used in the
+        worker processes of InstanceCatalog.write_catalog(workers=N), which
+        hand the values they calculate back to the parent process.
+        """
+        with self._lock:
+            self._stored = []
+
+    def _take_stored(self):
+        """
+        Return (and forget) the list of the (object_type, ids, values)
+        stored since the last call (see _record_stores)
+        """
+        with self._lock:
+            stored = self._stored
+            self._stored = []
+            return stored
+
+    def flush(self):
+        """
+        Write the values that are not yet on disk to disk
+        (if the store has a filename)
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self.filename is None:
+            return
+
+        object_types = set(self._runs.keys())
+        object_types.update(object_type for object_type in self._memory
+                            if self._memory[object_type][3].any())
+        for object_type in object_types:
+            self._flush_object_type(object_type)
+
+    def _flush_object_type(self, object_type):
+        """
+        Merge the runs and the values in memory not yet on disk
+        of object_type into the files of object_type
+        """
+        ids_list = []
+        values_list = []
+        for disk_ids, disk_values in reversed(self._disk_tiers(object_type)):
+            ids_list.append(np.asarray(disk_ids))
+            values_list.append(np.asarray(disk_values))
+
+        if object_type in self._memory:
+            memory_ids, memory_values, last_use, dirty = self._memory[object_type]
+            ids_list.append(memory_ids[dirty])
+            values_list.append(memory_values[dirty])
+
+        # keep the last (newest) value stored for each id
+        new_ids, new_values = _keep_last(np.concatenate(ids_list), np.concatenate(values_list))
+
+        # write to temporary files and rename them, so that a failed flush
+        # leaves the old files intact
+        self._disk.pop(object_type, None)
+        ids_file_name, values_file_name = self._file_names(object_type)
+        for file_name, data in ((ids_file_name, new_ids),
+                                (values_file_name, new_values)):
+            with open(file_name + '.tmp', 'wb') as file_handle:
+                np.save(file_handle, data)
+        for file_name in (values_file_name, ids_file_name):
+            os.rename(file_name + '.tmp', file_name)
+
+        self._open_object_type(object_type)
+        for file_name, run in self._runs.pop(object_type, []):
+            os.unlink(file_name)
+        if object_type in self._memory:
+            self._memory[object_type][3][:] = False
+
+    def close(self):
+        """
+        Flush the store and release its memory
+        """
+        with self._lock:
+            self._flush()
+            self._memory = {}
+            self._disk = {}
+
+    def clear(self):
+        """
+        Empty the store (deleting its files, if any) and reset its statistics
+        """
+        with self._lock:
+            self._memory = {}
+            self._disk = {}
+            if self.filename is not None:
+                self._remove_run_files()
+                for object_type in self._disk_object_types():
+                    for file_name in self._file_names(object_type):
+                        if os.path.exists(file_name):
+                            os.unlink(file_name)
+            self.reset_statistics()
+
+    def reset_statistics(self):
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+
+    def statistics(self):
+        """
+        Return a dict of the numbers of hits (in memory and on disk) and
+        misses, the hit rate, and the numbers of values in memory and in the store
+        """
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            return OrderedDict([('hits', int(self.hits)),
+                                ('memory_hits', int(self.memory_hits)),
+                                ('disk_hits', int(self.disk_hits)),
+                                ('misses', int(self.misses)),
+                                ('hit_rate', float(self.hits)/n_lookups if n_lookups > 0 else 0.0),
+                                ('memory_entries', sum(len(memory[0]) for memory in self._memory.values())),
+                                ('entries', len(self))])
@@ -1,7 +1,10 @@
 from functools import wraps
 from collections import OrderedDict
+import numpy as np
+from .PersistentColumnStore import PersistentColumnStore
 
-__all__ = ["cached", "compound", "register_class", "register_method"]
+__all__ = ["cached", "compound", "time_dependent", "persistent_cached",
+           "register_class", "register_method", "CompoundColumn"]
 
 #---------------------------------------------------------------------- 
 # Define decorators for get_* methods
@@ -27,6 +30,45 @@ def cached(f):
     new_f._cache_results = True
     return new_f
 
+class CompoundColumn(OrderedDict):
+    """The result of a @compound getter: an OrderedDict mapping each of the
+ getter's column names to its values.
+
+ When the getter returns a 2-dimensional numpy array (one row per column),
+ that array is kept as self.data, and the values in the dict are views into
+ it.  Selecting rows with take() is then a single fancy index over all of the
+ columns, rather than one per column.  Otherwise, self.data is None and the
+ values are the columns returned by the getter (they are not copied)."""
+
+    data = None
+
+    @classmethod
+    def from_results(cls, colnames, results):
+        """
+        Make a CompoundColumn from the names of the columns of a compound
+        getter and the columns it returned
+        """
+        if (isinstance(results, np.ndarray) and results.ndim == 2 and
+            results.shape[0] == len(colnames) and results.dtype != object):
+
+            output = cls(zip(colnames, results))
+            output.data = results
+            return output
+
+        return cls(zip(colnames, results))
+
+    def take(self, dexes):
+        """
+        Return a CompoundColumn containing only the rows specified by dexes
+        """
+        if self.data is None:
+            return CompoundColumn([(key, value[dexes]) for key, value in self.items()])
+
+        block = self.data[:, dexes]
+        output = CompoundColumn(zip(self.keys(), block))
+        output.data = block
+        return output
+
 def compound(*colnames):
     """Specifies that a column is a "compound column",
  that is, it returns multiple values.  This is useful in the case of,
@@ -47,12 +89,99 @@ def compound(*colnames):
         @wraps(f)
         def new_f(self, *args, **kwargs):
             results = f(self, *args, **kwargs)
-            return OrderedDict(zip(colnames, results))
+            return CompoundColumn.from_results(colnames, results)
         new_f._compound_column = True
         new_f._colnames = colnames
         return new_f
     return wrapper
 
+def time_dependent(f):
+    """Decorator for specifying that a get_* method depends on the time of the
+ observation, so that InstanceCatalog.write_epoch_catalogs() re-evaluates it
+ for every epoch.  (Getters which read self.obs_metadata.mjd are detected
+ automatically; this is for getters that depend on the time in other ways.)
+ It can be combined with @cached and @compound."""
+    if not f.__name__.startswith('get_'):
+        raise ValueError("@time_dependent can only be applied to get_* methods: "
+                         "Method '%s' invalid." % f.__name__)
+    f._time_dependent = True
+    return f
+
+def persistent_cached(store=None, max_entries=1000000, filename=None, dtype=None):
+    """Decorator for specifying that the computed result should be cached
+ per object, across chunks and catalogs, in a PersistentColumnStore keyed on
+ the objid of the catalog's CatalogDBObject (so that e.g. the bulges and the
+ disks of galaxies, which share ids, are kept apart) and its unique id
+ column (refIdCol).  This is meant for expensive
+ quantities which depend only on the object, not on the pointing.  When the
+ column is requested, the values of all of the ids in the current chunk are
+ looked up at once and the getter is only run on the rows that were not
+ found.  Like @cached, the result is also cached for the rest of the chunk.
+
+ Either pass a PersistentColumnStore as store (to share it between getters
+ or keep a handle on it), or the arguments with which to make one.  The
+ store is available as the _persistent_store attribute of the getter, e.g.::
+
+     class MyCatalog(InstanceCatalog):
+         @persistent_cached(max_entries=100000, filename='sed_norm_cache')
+         def get_sedNorm(self):
+             ...
+
+     print MyCatalog.get_sedNorm._persistent_store.statistics()
+
+ It cannot be applied to compound getters."""
+    if store is None:
+        store = PersistentColumnStore(max_entries=max_entries, filename=filename, dtype=dtype)
+
+    def wrapper(f):
+        if not f.__name__.startswith('get_'):
+            raise ValueError("@persistent_cached can only be applied to get_* methods: "
+                             "Method '%s' invalid." % f.__name__)
+        if getattr(f, '_compound_column', False):
+            raise ValueError("@persistent_cached cannot be applied to compound getters: "
+                             "Method '%s' invalid." % f.__name__)
+        colname = f.__name__.replace('get_', '', 1)
+
+        @wraps(f)
+        def new_f(self, *args, **kwargs):
+            if colname in self._column_cache:
+                return self._column_cache[colname]
+
+            ids = self.column_by_name(self.refIdCol)
+            object_type = getattr(self.db_obj, 'objid', None)
+            if len(ids) == 0:
+                # nothing to look up (this is also the path taken while
+                # the catalog is working out which columns it needs)
+                result = f(self, *args, **kwargs)
+            else:
+                result, found = store.lookup(ids, object_type=object_type)
+                if not found.all():
+                    missing = np.where(~found)[0]
+                    if len(missing) == len(ids):
+                        computed = np.asarray(f(self, *args, **kwargs))
+                    else:
+                        # run the getter on the rows that were not found
+                        saved_chunk = self._current_chunk
+                        saved_cache = self._column_cache
+                        saved_rows = self._current_rows
+                        self._update_current_chunk(missing)
+                        try:
+                            computed = np.asarray(f(self, *args, **kwargs))
+                        finally:
+                            self._set_current_chunk(saved_chunk, column_cache=saved_cache,
+                                                    rows=saved_rows)
+                    store.store(ids[missing], computed, object_type=object_type)
+                    if computed.dtype != result.dtype:
+                        result = result.astype(computed.dtype)
+                    result[missing] = computed
+
+            self._column_cache[colname] = result
+            return result
+        new_f._cache_results = True
+        new_f._persistent_store = store
+        return new_f
+    return wrapper
+
 def register_class(cls):
     cls._methodRegistry = {}
     for methodname in dir(cls):
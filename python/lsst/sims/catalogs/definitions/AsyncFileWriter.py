@@ -0,0 +1,171 @@
+"""
+A file writer that does its disk writes on a background thread, so that
+formatting the next chunk of a catalog overlaps with writing the last one
+(see the async_write kwarg of InstanceCatalog.write_catalog)
+"""
+import threading
+import Queue
+
+__all__ = ["AsyncFileWriter"]
+
+
+class AsyncFileWriter(object):
+    """
+    A write-only file-like object.  Text passed to write() and writelines()
+    is collected into blocks of block_size bytes, which are handed over a
+    bounded queue to a background thread that writes them to disk.  Only
+    the last block written by close() can be shorter than block_size.
+
+    If the background thread fails to write, the exception is raised by the
+    next call to write(), writelines() or close().  The file is flushed and
+    closed by the time close() returns (close() is called on leaving a with
+    block).
+    """
+
+    def __init__(self, filename, mode='w', block_size=4*1024*1024, max_pending=4):
+        """
+        @param [in] filename is the name of the file to be written
+
+        @param [in] mode is 'w' to overwrite the file or 'a' to append to it
+
+        @param [in] block_size is the size in bytes of the blocks in which the
+        file is written (default 4 MiB)
+
+        @param [in] max_pending is the maximum number of blocks that may be waiting
+        to be written.  write() blocks until the background thread catches up
+        once there are this many (default 4).
+        """
+        self.name = filename
+        self._block_size = block_size
+        self._buffer = []
+        self._buffered = 0
+        self._error = None
+        self._closed = False
+        self._file_handle = open(filename, mode)
+        self._queue = Queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._write_blocks)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_blocks(self):
+        """
+        The body of the background thread.  After a failed write, the
+        remaining blocks are discarded (so that the caller never blocks on a
+        full queue) until the end-of-file marker None arrives.
+        """
+        try:
+            while True:
+                block = self._queue.get()
+                if block is None:
+                    break
+                if self._error is None:
+                    try:
+                        self._file_handle.write(block)
+                    except Exception as error:
+                        self._error = error
+            if self._error is None:
+                self._file_handle.flush()
+        except Exception as error:
+            if self._error is None:
+                self._error = error
+        finally:
+            try:
+                self._file_handle.close()
+            except Exception as error:
+                if self._error is None:
+                    self._error = error
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            self.abort()
+            raise error
+
+    def write(self, text):
+        """
+        Queue text to be written to the file
+        """
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+        self._raise_error()
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self._block_size:
+            self._send_blocks()
+
+    def writelines(self, lines):
+        """
+        Queue the strings in lines to be written to the file
+        """
+        self.write(''.join(lines))
+
+    def _send_blocks(self):
+        """
+        Hand every whole block in the buffer to the background thread,
+        keeping the remainder for the next block
+        """
+        data = ''.join(self._buffer)
+        n_aligned = len(data) - len(data) % self._block_size
+        for start in range(0, n_aligned, self._block_size):
+            self._queue.put(data[start:start+self._block_size])
+        remainder = data[n_aligned:]
+        self._buffer = [remainder]
+        self._buffered = len(remainder)
+
+    def _stop(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def abort(self):
+        """
+        Stop the background thread and close the file without writing
+        what is left in the buffer
+        """
+        if not self._closed:
+            self._buffer = []
+            self._buffered = 0
+            self._stop()
+
+    def close(self):
+        """
+        Write whatever is left in the buffer, wait for the background thread
+        to finish and close the file.  Raises any exception met while writing.
+        """
+        if self._closed:
+            self._raise_error()
+            return
+        self._raise_error()
+        if self._buffered > 0:
+            self._queue.put(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        self._stop()
+        self._raise_error()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not let a write error hide the exception
+            # that is already on its way up
+            self.abort()
+        return False
+
+
+def open_catalog_file(filename, mode, async_write=False):
+    """
+    Open filename for writing a catalog.  Returns an AsyncFileWriter if
+    async_write is True and an ordinary file handle otherwise.
+    """
+    if async_write:
+        return AsyncFileWriter(filename, mode)
+    return open(filename, mode)
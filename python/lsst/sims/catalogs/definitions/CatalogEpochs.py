@@ -0,0 +1,136 @@
+"""
+Helpers for writing one InstanceCatalog at many epochs of the same pointing
+(see InstanceCatalog.write_epoch_catalogs)
+"""
+import copy
+
+__all__ = []
+
+
+_watched_classes = {}
+
+
+def _watched_class(obs_class):
+    """
+    Return a subclass of obs_class whose mjd attribute calls
+    self._mjd_callback() every time it is read
+    """
+    if obs_class in _watched_classes:
+        return _watched_classes[obs_class]
+
+    base_mjd = getattr(obs_class, 'mjd', None)
+
+    def get_mjd(self):
+        self._mjd_callback()
+        if isinstance(base_mjd, property):
+            return base_mjd.__get__(self, obs_class)
+        return self.__dict__['mjd']
+
+    def set_mjd(self, value):
+        if isinstance(base_mjd, property):
+            base_mjd.__set__(self, value)
+        else:
+            self.__dict__['mjd'] = value
+
+    watched_class = type('MJDWatched' + obs_class.__name__, (obs_class,),
+                         {'mjd': property(get_mjd, set_mjd)})
+    _watched_classes[obs_class] = watched_class
+    return watched_class
+
+
+def watch_mjd(obs_metadata, callback):
+    """
+    Return a copy of obs_metadata (an ObservationMetaData) which calls
+    callback() whenever its mjd is read
+    """
+    watched = copy.copy(obs_metadata)
+    watched.__class__ = _watched_class(obs_metadata.__class__)
+    watched._mjd_callback = callback
+    return watched
+
+
+class _EpochTracker(object):
+    """
+    Sorts the columns of an InstanceCatalog into those that depend on the
+    time of the observation and those that do not.
+
+    While the first epoch of the first non-empty chunk is evaluated, the
+    catalog reports every column it evaluates with enter() and exit(), and
+    its ObservationMetaData reports every read of its mjd to touched_mjd().
+    A column is time-dependent if it was declared so (with the
+    @time_dependent decorator), if it read the mjd, or if it depends on a
+    time-dependent column.  classify() then fixes the list of static columns:
+    those evaluated during that pass that are not time-dependent (the columns
+    returned by one compound getter are all time-dependent if any of them is).
+    Columns that are evaluated for the first time after classify() count as
+    time-dependent.
+    """
+
+    def __init__(self, declared):
+        """
+        @param [in] declared is a list of the columns declared time-dependent
+        """
+        self.time_dependent = set(declared)
+        self.evaluated = []
+        self.classified = False
+        self.static_columns = []
+        self._static = set()
+        self._stack = []
+        self._dependents = {}  # the columns which called each column
+
+    def enter(self, column_name):
+        if len(self._stack) > 0:
+            if column_name not in self._dependents:
+                self._dependents[column_name] = set()
+            self._dependents[column_name].add(self._stack[-1])
+        self._stack.append(column_name)
+
+    def exit(self):
+        column_name = self._stack.pop()
+        if column_name not in self.evaluated:
+            self.evaluated.append(column_name)
+
+    def touched_mjd(self):
+        self.time_dependent.update(self._stack)
+
+    def watch(self, obs_metadata):
+        """
+        Return a copy of obs_metadata that reports reads of its mjd
+        """
+        if obs_metadata is None:
+            return None
+        return watch_mjd(obs_metadata, self.touched_mjd)
+
+    def classify(self, compound_column_names):
+        """
+        Fix the list of static columns
+
+        @param [in] compound_column_names is the catalog's dict mapping the
+        columns returned by compound getters to the names of their getters
+        """
+        compound_siblings = {}
+        for column_name, getter in compound_column_names.items():
+            if getter not in compound_siblings:
+                compound_siblings[getter] = []
+            compound_siblings[getter].append(column_name)
+
+        # spread time-dependence to compound siblings and to every column
+        # that called a time-dependent column
+        to_visit = list(self.time_dependent)
+        while len(to_visit) > 0:
+            column_name = to_visit.pop()
+            related = set(self._dependents.get(column_name, ()))
+            if column_name in compound_column_names:
+                related.update(compound_siblings[compound_column_names[column_name]])
+            for other in related:
+                if other not in self.time_dependent:
+                    self.time_dependent.add(other)
+                    to_visit.append(other)
+
+        self.static_columns = [column_name for column_name in self.evaluated
+                               if column_name not in self.time_dependent]
+        self._static = set(self.static_columns)
+        self.classified = True
+
+    def is_static(self, column_name):
+        return column_name in self._static
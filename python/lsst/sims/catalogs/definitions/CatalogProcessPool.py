@@ -0,0 +1,223 @@
+"""
+Helpers for evaluating and formatting InstanceCatalog chunks in a pool of
+worker processes (see InstanceCatalog.write_catalog(workers=N))
+"""
+from collections import deque
+import sys
+import multiprocessing
+import time
+from .CatalogStatistics import CatalogStatistics
+
+__all__ = []
+
+
+class _DetachedDBObject(object):
+    """
+    A stand-in for a CatalogDBObject inside of a worker process.
+
+    It carries the data members of the CatalogDBObject (columnMap, idColKey,
+    objectTypeId, etc.) but none of its database connection, so that an
+    InstanceCatalog rebuilt in a worker can evaluate its getters without
+    ever touching the database.
+    """
+
+    _skip = ('connection', 'table', 'registry', '_connection_cache', '_connection_registry')
+
+    def __init__(self, db_obj):
+        for name in dir(db_obj):
+            if name.startswith('__') or name in self._skip:
+                continue
+            try:
+                value = getattr(db_obj, name)
+            except AttributeError:
+                continue
+            if callable(value):
+                continue
+            setattr(self, name, value)
+
+        self._idColKey = db_obj.getIdColKey()
+        self._objectTypeId = db_obj.getObjectTypeId()
+
+    def getIdColKey(self):
+        return self._idColKey
+
+    def getObjectTypeId(self):
+        return self._objectTypeId
+
+
+def catalog_description(catalog):
+    """
+    Return a (class, state) tuple from which a copy of catalog can be
+    rebuilt in a worker process.  The CatalogDBObject is replaced by a
+    _DetachedDBObject and the chunk-specific state is dropped.
+    """
+    state = dict(catalog.__dict__)
+    state['db_obj'] = _DetachedDBObject(catalog.db_obj)
+    state['_current_chunk'] = None
+    state['_column_cache'] = {}
+    if state.get('_profiler', None) is not None:
+        state['_profiler'] = CatalogStatistics(catalog_class=catalog.__class__.__name__)
+    return catalog.__class__, state
+
+
+def rebuild_catalog(description):
+    """
+    Rebuild an InstanceCatalog from the output of catalog_description()
+    """
+    catalog_class, state = description
+    catalog = catalog_class.__new__(catalog_class)
+    catalog.__dict__.update(state)
+    return catalog
+
+
+_worker_catalog = None
+
+
+def _initialize_worker(description):
+    global _worker_catalog
+    _worker_catalog = rebuild_catalog(description)
+    # the values calculated by @persistent_cached getters are handed back
+    # to the parent process, which owns the files of the stores
+    for store in _worker_catalog._persistent_stores():
+        store._record_stores()
+
+
+def _filter_totals(catalog):
+    """
+    Return a dict of the (calls, rows in, rows passed, time) totals
+    of each entry of catalog's filter statistics
+    """
+    return dict((key, (stats.calls, stats.rows_in, stats.rows_passed, stats.time))
+                for key, stats in catalog._filter_stats.items())
+
+
+def _worker_updates(catalog, filter_totals):
+    """
+    Return the updates made to the state of catalog that the parent process
+    needs: a list of the (column name, source, calls, rows in, rows passed,
+    time) added to each entry of its filter statistics since filter_totals
+    were taken, and a list of the (store index, object type, ids, values)
+    stored by its @persistent_cached getters (see
+    InstanceCatalog._merge_worker_updates)
+    """
+    filter_updates = []
+    for (col_name, source), stats in catalog._filter_stats.items():
+        calls, rows_in, rows_passed, elapsed = filter_totals.get((col_name, source), (0, 0, 0, 0.0))
+        if stats.calls > calls:
+            filter_updates.append((col_name, source, stats.calls - calls, stats.rows_in - rows_in,
+                                   stats.rows_passed - rows_passed, stats.time - elapsed))
+
+    store_updates = []
+    for ix, store in enumerate(catalog._persistent_stores()):
+        for object_type, ids, values in store._take_stored():
+            store_updates.append((ix, object_type, ids, values))
+
+    return filter_updates, store_updates
+
+
+def _format_chunk_in_worker(chunk):
+    """
+    Filter and evaluate one database chunk in a worker process.
+    Returns a tuple containing the formatted lines of the chunk as a single
+    string, the CatalogStatistics record of the chunk (None if the catalog is
+    not being profiled), the (RA, Dec) of its rows (None unless the catalog
+    is being written to a ShardedCatalogWriter that needs them), the sort
+    keys of its rows (None unless it is being written to a SortedCatalogWriter)
+    and the updates to the state of the catalog (see _worker_updates).
+    """
+    filter_totals = _filter_totals(_worker_catalog)
+    _worker_catalog._filter_chunk(chunk)
+    coordinates = _worker_catalog._current_chunk_coordinates()
+    sort_keys = _worker_catalog._current_chunk_sort_keys()
+    profiler = _worker_catalog._profiler
+    if profiler is None:
+        text = ''.join(_worker_catalog._current_chunk_lines())
+        return text, None, coordinates, sort_keys, _worker_updates(_worker_catalog, filter_totals)
+
+    column_time = profiler.column_time
+    t_start = time.time()
+    text = ''.join(_worker_catalog._current_chunk_lines())
+    profiler.add_time('format', time.time() - t_start - (profiler.column_time - column_time))
+    record = profiler.end_chunk()
+    # the record is handed back to the parent process; do not keep it here too
+    profiler.chunks.pop()
+    return text, record, coordinates, sort_keys, _worker_updates(_worker_catalog, filter_totals)
+
+
+def _forks_workers():
+    """
+    Return True if multiprocessing starts its worker processes by forking
+    this one
+    """
+    get_start_method = getattr(multiprocessing, 'get_start_method', None)
+    if get_start_method is not None:
+        return get_start_method() == 'fork'
+    return not sys.platform.startswith('win')
+
+
+class CatalogProcessPool(object):
+    """
+    A pool of worker processes, each holding a rebuilt copy of one
+    InstanceCatalog.  Chunks are submitted with submit() and their formatted
+    lines (and, if the catalog is being profiled, their statistics) are
+    handed back by submit() and drain() in the order in which the chunks
+    were submitted.
+
+    The worker processes must be forked from this one: the copy of the
+    catalog handed to them refers to classes (and getters) that need not be
+    importable by a freshly started interpreter.
+    """
+
+    def __init__(self, catalog, workers, max_pending=None):
+        """
+        @param [in] catalog is the InstanceCatalog to evaluate.  Its
+        _write_pre_process() must already have been run.
+
+        @param [in] workers is the number of worker processes
+
+        @param [in] max_pending is the maximum number of chunks that may be
+        in flight at once (default 2*workers)
+        """
+        if not _forks_workers():
+            raise RuntimeError("CatalogProcessPool needs multiprocessing to start "
+                               "its workers with fork, which is not available here; "
+                               "write the catalog without workers")
+
+        self._pool = multiprocessing.Pool(processes=workers,
+                                          initializer=_initialize_worker,
+                                          initargs=(catalog_description(catalog),))
+        if max_pending is None:
+            max_pending = 2*workers
+        self._max_pending = max_pending
+        self._pending = deque()
+
+    def submit(self, chunk):
+        """
+        Submit a chunk for evaluation.  The chunk is handed to the pool
+        straight away.  Returns a list of the (text, statistics, coordinates,
+        sort keys, worker updates) tuples of the earlier chunks that had to be
+        retrieved to keep the number of chunks in flight below max_pending.
+        """
+        self._pending.append(self._pool.apply_async(_format_chunk_in_worker, (chunk,)))
+        results = []
+        while len(self._pending) >= self._max_pending:
+            results.append(self._pending.popleft().get())
+        return results
+
+    def drain(self):
+        """
+        Return a list of the (text, statistics, coordinates, sort keys,
+        worker updates) tuples of every chunk still in flight.
+        """
+        results = []
+        while len(self._pending) > 0:
+            results.append(self._pending.popleft().get())
+        return results
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
@@ -0,0 +1,340 @@
+"""
+Writing a catalog into several files (shards), split by row count, size or
+position on the sky (see InstanceCatalog.write_sharded_catalog)
+"""
+import os
+import json
+import numpy as np
+from collections import OrderedDict
+from .AsyncFileWriter import open_catalog_file
+
+__all__ = ["ShardedCatalogWriter"]
+
+# the key under which rows with NaN coordinates are sharded
+# when the catalog is split on the sky
+_NAN_PIXEL = 'nan'
+
+
+class _Shard(object):
+    """
+    One file written by a ShardedCatalogWriter
+    """
+
+    def __init__(self, filename, header, pixel, async_write):
+        self.filename = filename
+        self.pixel = pixel
+        self.rows = 0
+        self.bytes = 0
+        self.ra_range = None
+        self.dec_range = None
+        self.async_write = async_write
+        self.file_handle = open_catalog_file(filename, 'w', async_write=async_write)
+        if len(header) > 0:
+            self.file_handle.write(header)
+            self.bytes += len(header)
+
+    def suspend(self):
+        """
+        Close the file, which resume() reopens in append mode
+        """
+        self.file_handle.close()
+        self.file_handle = None
+
+    def resume(self):
+        self.file_handle = open_catalog_file(self.filename, 'a', async_write=self.async_write)
+
+    def write(self, lines, ra=None, dec=None):
+        self.file_handle.writelines(lines)
+        self.rows += len(lines)
+        self.bytes += sum(len(line) for line in lines)
+        if ra is not None and len(ra) > 0:
+            self.ra_range = _extend_range(self.ra_range, ra)
+            self.dec_range = _extend_range(self.dec_range, dec)
+
+    def manifest_entry(self):
+        entry = OrderedDict([('file', os.path.basename(self.filename)),
+                             ('rows', self.rows),
+                             ('bytes', self.bytes)])
+        if self.pixel == _NAN_PIXEL:
+            entry['nan_coordinates'] = True
+        elif self.pixel is not None:
+            entry['pixel'] = list(self.pixel)
+        if self.ra_range is not None:
+            entry['ra_min'], entry['ra_max'] = self.ra_range
+            entry['dec_min'], entry['dec_max'] = self.dec_range
+        return entry
+
+
+def _extend_range(old_range, values):
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return old_range
+    new_range = (float(values.min()), float(values.max()))
+    if old_range is None:
+        return new_range
+    return (min(old_range[0], new_range[0]), max(old_range[1], new_range[1]))
+
+
+class ShardedCatalogWriter(object):
+    """
+    A write-only file-like object that spreads the lines of a catalog over
+    several files.  A new file (shard) is started whenever the current one
+    would exceed max_rows rows or max_bytes bytes.  If pixel_size is set,
+    each line is also routed to a shard according to the cell of an RA/Dec grid
+    of that size containing it, using the coordinates passed to set_coordinates()
+    before the lines are written.
+
+    Rows with NaN coordinates are written to shards of their own (marked
+    'nan_coordinates' in the manifest) when pixel_size is set.  At most
+    max_open_shards shards are kept open at once; when another one is needed,
+    the least recently written one is closed, and reopened in append mode if
+    more of its cell's lines arrive.
+
+    Shards are named root_0000.ext, root_0001.ext, ... (where filename is
+    root.ext), in the order in which they are started.  Each shard starts
+    with its own copy of header.  close() writes root_manifest.json, listing
+    the file name, number of rows, size, grid cell (if any) and RA/Dec extent
+    (if coordinates were given) of each shard.
+    """
+
+    def __init__(self, filename, header='', max_rows=None, max_bytes=None,
+                 pixel_size=None, endline='\n', async_write=False, max_open_shards=64):
+        """
+        @param [in] filename is the name from which the names of the shards
+        and of the manifest are made
+
+        @param [in] header is the text with which to begin each shard
+
+        @param [in] max_rows is the maximum number of rows in a shard (optional)
+
+        @param [in] max_bytes is the maximum size of a shard in bytes (optional;
+        a shard can exceed it only if a single line does)
+
+        @param [in] pixel_size is the size of the cells of the RA/Dec grid by
+        which to split the catalog, in the units of the coordinates passed to
+        set_coordinates() (optional)
+
+        @param [in] endline is the string that ends each line of the catalog
+
+        @param [in] async_write is a boolean.  If True, each shard is written
+        by its own AsyncFileWriter, so that the shards are written concurrently.
+
+        @param [in] max_open_shards is the maximum number of shards kept
+        open at once (each holding a file and, with async_write, a thread;
+        default 64)
+        """
+        if max_rows is not None and max_rows < 1:
+            raise RuntimeError("ShardedCatalogWriter needs max_rows >= 1; you gave %s" % str(max_rows))
+        if max_open_shards < 1:
+            raise RuntimeError("ShardedCatalogWriter needs max_open_shards >= 1; "
+                               "you gave %s" % str(max_open_shards))
+
+        self._root, self._ext = os.path.splitext(filename)
+        self.manifest_name = self._root + '_manifest.json'
+        self._header = header
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._pixel_size = pixel_size
+        self._endline = endline
+        self._async_write = async_write
+        self._max_open_shards = max_open_shards
+        self._shards = []
+        # the shard being filled for each grid cell, and those of
+        # them whose files are open (least recently written first)
+        self._current_shards = {}
+        self._open_shards = OrderedDict()
+        self._ra = None
+        self._dec = None
+        self._next_row = 0
+        self._closed = False
+
+    @property
+    def shards(self):
+        """
+        The list of the names of the shard files written so far
+        """
+        return [shard.filename for shard in self._shards]
+
+    def set_coordinates(self, ra, dec):
+        """
+        Set the RA and Dec of the lines that are about to be written (one
+        value per line; they are consumed in order by write() and writelines())
+        """
+        self._ra = np.asarray(ra, dtype=float)
+        self._dec = np.asarray(dec, dtype=float)
+        self._next_row = 0
+
+    def write(self, text):
+        """
+        Write text (a whole number of lines) to the shards
+        """
+        lines = text.split(self._endline)
+        if len(lines[-1]) > 0:
+            raise RuntimeError("ShardedCatalogWriter.write() was passed a partial line")
+        self.writelines([line + self._endline for line in lines[:-1]])
+
+    def writelines(self, lines):
+        """
+        Write a sequence of lines to the shards
+        """
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+
+        lines = list(lines)
+        if len(lines) == 0:
+            return
+
+        ra = dec = None
+        if self._ra is not None:
+            start = self._next_row
+            self._next_row += len(lines)
+            ra = self._ra[start:self._next_row]
+            dec = self._dec[start:self._next_row]
+            if len(ra) != len(lines):
+                raise RuntimeError("ShardedCatalogWriter was given coordinates "
+                                   "for fewer lines than it was asked to write")
+
+        if self._pixel_size is None:
+            self._write_to_pixel(None, lines, ra, dec)
+            return
+
+        if ra is None:
+            raise RuntimeError("ShardedCatalogWriter needs set_coordinates() to be "
+                               "called before lines are written when pixel_size is set")
+
+        finite = np.isfinite(ra) & np.isfinite(dec)
+        i_ra = np.floor(np.where(finite, ra, 0.0)/self._pixel_size).astype(int)
+        i_dec = np.floor(np.where(finite, dec, 0.0)/self._pixel_size).astype(int)
+        pixel_dexes = OrderedDict()
+        for ix, (pixel, is_finite) in enumerate(zip(zip(i_ra.tolist(), i_dec.tolist()),
+                                                    finite.tolist())):
+            if not is_finite:
+                pixel = _NAN_PIXEL
+            if pixel not in pixel_dexes:
+                pixel_dexes[pixel] = []
+            pixel_dexes[pixel].append(ix)
+
+        for pixel, dexes in pixel_dexes.items():
+            dexes = np.array(dexes)
+            if pixel == _NAN_PIXEL:
+                self._write_to_pixel(pixel, [lines[dd] for dd in dexes], None, None)
+            else:
+                self._write_to_pixel(pixel, [lines[dd] for dd in dexes], ra[dexes], dec[dexes])
+
+    def _write_to_pixel(self, pixel, lines, ra, dec):
+        """
+        Write lines to the open shard of the grid cell pixel (None when the
+        catalog is not split on the sky), starting new shards as they fill up
+        """
+        start = 0
+        while start < len(lines):
+            shard = self._current_shards.get(pixel, None)
+            if shard is None:
+                shard = self._start_shard(pixel)
+            else:
+                self._touch_shard(pixel)
+
+            # take as many lines as fit in the shard (a shard always takes at
+            # least one line, even if that line alone is longer than max_bytes)
+            end = start
+            rows = shard.rows
+            n_bytes = shard.bytes
+            while end < len(lines):
+                if self._max_rows is not None and rows >= self._max_rows:
+                    break
+                if (self._max_bytes is not None and rows > 0 and
+                    n_bytes + len(lines[end]) > self._max_bytes):
+                    break
+                rows += 1
+                n_bytes += len(lines[end])
+                end += 1
+
+            if end == start:
+                self._finish_shard(pixel)
+                continue
+
+            shard.write(lines[start:end],
+                        ra=None if ra is None else ra[start:end],
+                        dec=None if dec is None else dec[start:end])
+            start = end
+
+    def _start_shard(self, pixel):
+        self._make_room()
+        filename = '%s_%04d%s' % (self._root, len(self._shards), self._ext)
+        shard = _Shard(filename, self._header, pixel, self._async_write)
+        self._shards.append(shard)
+        self._current_shards[pixel] = shard
+        self._open_shards[pixel] = shard
+        return shard
+
+    def _touch_shard(self, pixel):
+        """
+        Make sure the current shard of pixel is open, and mark
+        it as the most recently written
+        """
+        shard = self._open_shards.pop(pixel, None)
+        if shard is None:
+            self._make_room()
+            shard = self._current_shards[pixel]
+            shard.resume()
+        self._open_shards[pixel] = shard
+
+    def _make_room(self):
+        """
+        Close the least recently written shards until
+        another one can be opened
+        """
+        while len(self._open_shards) >= self._max_open_shards:
+            pixel, shard = self._open_shards.popitem(last=False)
+            shard.suspend()
+
+    def _finish_shard(self, pixel):
+        self._current_shards.pop(pixel)
+        shard = self._open_shards.pop(pixel, None)
+        if shard is not None:
+            shard.file_handle.close()
+
+    def manifest(self):
+        """
+        Return the manifest (a dict) describing the shards
+        """
+        return OrderedDict([('max_rows', self._max_rows),
+                            ('max_bytes', self._max_bytes),
+                            ('pixel_size', self._pixel_size),
+                            ('shards', [shard.manifest_entry() for shard in self._shards])])
+
+    def close(self):
+        """
+        Close every shard and write the manifest
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for pixel in list(self._current_shards.keys()):
+            self._finish_shard(pixel)
+        with open(self.manifest_name, 'w') as manifest_file:
+            json.dump(self.manifest(), manifest_file, indent=2)
+            manifest_file.write('\n')
+
+    def abort(self):
+        """
+        Close every shard without writing the manifest
+        """
+        self._closed = True
+        for shard in self._open_shards.values():
+            if hasattr(shard.file_handle, 'abort'):
+                shard.file_handle.abort()
+            else:
+                shard.file_handle.close()
+        self._current_shards = {}
+        self._open_shards = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
@@ -0,0 +1,212 @@
+"""
+Run statistics recorded by an InstanceCatalog while it is profiling
+(see InstanceCatalog.profile)
+"""
+from collections import OrderedDict
+
+__all__ = ["CatalogStatistics"]
+
+
+def _new_column_record(origin):
+    return OrderedDict([('origin', origin),
+                        ('calls', 0),
+                        ('cache_hits', 0),
+                        ('time', 0.0),
+                        ('self_time', 0.0)])
+
+
+def _new_chunk_record():
+    return OrderedDict([('rows_in', 0),
+                        ('rows_out', 0),
+                        ('filter_time', 0.0),
+                        ('column_time', 0.0),
+                        ('format_time', 0.0),
+                        ('write_time', 0.0),
+                        ('columns', OrderedDict())])
+
+
+class CatalogStatistics(object):
+    """
+    A record of where the time went while an InstanceCatalog was written.
+
+    For each chunk of database rows, the record contains the number of rows
+    in and out of InstanceCatalog._filter_chunk, the time spent filtering
+    (including evaluating the cannot_be_null columns), the total time spent in
+    column_by_name, the time spent formatting lines (excluding evaluating their
+    columns) and writing them, and, for each column requested through
+    column_by_name, the number of calls, the number of those calls answered by
+    the column cache, the total time (including the columns it depended on),
+    the time spent in the column itself, and the name of the class which
+    defined its getter.
+
+    Everything is stored as plain dicts, lists, numbers and strings, so that
+    as_dict() can be saved (e.g. as JSON) and statistics from several runs can
+    be combined with aggregate() or +.
+    """
+
+    def __init__(self, catalog_class=None, chunks=None):
+        """
+        @param [in] catalog_class is the name of the InstanceCatalog class
+        being profiled (optional)
+
+        @param [in] chunks is an optional list of chunk records (as returned by
+        as_dict()['chunks']) with which to initialize the statistics
+        """
+        self.catalog_class = catalog_class
+        self.chunks = []
+        if chunks is not None:
+            self.chunks.extend(chunks)
+        self._current = None
+        self._child_time = []
+
+    def start_chunk(self, rows_in):
+        """
+        Begin the record of a new chunk containing rows_in database rows
+        """
+        self._current = _new_chunk_record()
+        self._current['rows_in'] = rows_in
+        self.chunks.append(self._current)
+        return self._current
+
+    def end_chunk(self):
+        """
+        Finish the record of the current chunk and return it
+        """
+        record = self._current
+        self._current = None
+        return record
+
+    def add_chunk(self, record):
+        """
+        Append a chunk record made elsewhere (e.g. in a worker process)
+        """
+        self.chunks.append(record)
+
+    @property
+    def column_time(self):
+        """
+        The time spent in (outermost) calls to column_by_name during the
+        current chunk
+        """
+        if self._current is None:
+            return 0.0
+        return self._current['column_time']
+
+    def enter_column(self):
+        """
+        Called by column_by_name before it evaluates a column, so that the time
+        spent in the columns it depends on can be subtracted from its own.
+        """
+        self._child_time.append(0.0)
+
+    def exit_column(self, column_name, origin, elapsed, cache_hit):
+        """
+        Called by column_by_name after it has evaluated a column
+
+        @param [in] column_name is the name of the column
+
+        @param [in] origin is the name of the class which defined the column
+        (or 'the database' or 'default column')
+
+        @param [in] elapsed is the wall time spent in column_by_name in seconds
+
+        @param [in] cache_hit is True if the column came out of the column cache
+        """
+        child_time = self._child_time.pop()
+        if len(self._child_time) > 0:
+            self._child_time[-1] += elapsed
+        elif self._current is not None:
+            self._current['column_time'] += elapsed
+
+        if self._current is None:
+            return
+
+        columns = self._current['columns']
+        if column_name not in columns:
+            columns[column_name] = _new_column_record(origin)
+        record = columns[column_name]
+        record['calls'] += 1
+        if cache_hit:
+            record['cache_hits'] += 1
+        record['time'] += elapsed
+        record['self_time'] += elapsed - child_time
+
+    def end_filter(self, rows_out, elapsed):
+        """
+        Record that rows_out rows of the current chunk passed the filter
+        and that filtering took elapsed seconds
+        """
+        if self._current is not None:
+            self._current['rows_out'] = rows_out
+            self._current['filter_time'] += elapsed
+
+    def add_time(self, stage, elapsed):
+        """
+        Add elapsed seconds to the 'format' or 'write' time of the
+        current chunk
+        """
+        if self._current is not None:
+            self._current['%s_time' % stage] += elapsed
+
+    def totals(self):
+        """
+        Return a dict of the rows and times summed over all chunks
+        """
+        output = OrderedDict([('chunks', len(self.chunks)),
+                              ('rows_in', 0),
+                              ('rows_out', 0),
+                              ('filter_time', 0.0),
+                              ('column_time', 0.0),
+                              ('format_time', 0.0),
+                              ('write_time', 0.0)])
+        for record in self.chunks:
+            for key in output:
+                if key != 'chunks':
+                    output[key] += record[key]
+        return output
+
+    def column_totals(self):
+        """
+        Return a dict keyed on column name of the column records summed over
+        all chunks, sorted from the most to the least self_time
+        """
+        output = {}
+        for record in self.chunks:
+            for column_name, column in record['columns'].items():
+                if column_name not in output:
+                    output[column_name] = _new_column_record(column['origin'])
+                for key in ('calls', 'cache_hits', 'time', 'self_time'):
+                    output[column_name][key] += column[key]
+        return OrderedDict(sorted(output.items(), key=lambda item: -item[1]['self_time']))
+
+    def as_dict(self):
+        """
+        Return the statistics as a dict of plain python types
+        """
+        return OrderedDict([('catalog_class', self.catalog_class),
+                            ('totals', self.totals()),
+                            ('columns', self.column_totals()),
+                            ('chunks', self.chunks)])
+
+    @classmethod
+    def from_dict(cls, stats_dict):
+        """
+        Rebuild CatalogStatistics from the output of as_dict()
+        """
+        return cls(catalog_class=stats_dict['catalog_class'],
+                   chunks=stats_dict['chunks'])
+
+    @classmethod
+    def aggregate(cls, stats_list):
+        """
+        Combine a list of CatalogStatistics (e.g. from several runs) into one
+        """
+        classes = set([stats.catalog_class for stats in stats_list])
+        catalog_class = classes.pop() if len(classes) == 1 else None
+        output = cls(catalog_class=catalog_class)
+        for stats in stats_list:
+            output.chunks.extend(stats.chunks)
+        return output
+
+    def __add__(self, other):
+        return self.aggregate([self, other])
@@ -0,0 +1,86 @@
+"""
+Handing InstanceCatalogs some of the columns of a chunk of query results,
+under their own names, without copying them (see CompoundInstanceCatalog)
+"""
+import numpy as np
+
+__all__ = ["RoutedChunk"]
+
+
+class RoutedChunk(object):
+    """
+    A read-only view of some of the columns of a chunk of query results
+    (a numpy recarray), renamed, and optionally of a subset of its rows.
+    InstanceCatalogs accept a RoutedChunk wherever they accept a recarray.
+
+    The chunk protocol an InstanceCatalog relies on is:
+
+    len(chunk) is the number of rows
+
+    chunk.dtype.names are the names of the columns
+
+    chunk[name] is the numpy array of the column called name
+
+    chunk[rows] (where rows is an array of indices or a boolean mask)
+    is a chunk containing only those rows
+
+    Columns are read from the master chunk as views when they are first
+    asked for; selecting rows only records the indices of the rows in the
+    master chunk, so that the master chunk is never copied as a whole.
+    """
+
+    def __init__(self, chunk, name_map, dtype=None, rows=None):
+        """
+        @param [in] chunk is the master chunk of query results
+
+        @param [in] name_map is an OrderedDict mapping the name of each column
+        of the RoutedChunk to the name of the column of chunk that it reads
+
+        @param [in] dtype is the dtype of the RoutedChunk (the dtypes of the
+        columns of chunk under their new names).  It is worked out from chunk
+        if it is None; pass it to avoid building it again for every chunk.
+
+        @param [in] rows is an optional array of the indices of the rows
+        of chunk in the RoutedChunk (default: all of them)
+        """
+        self._chunk = chunk
+        self._name_map = name_map
+        self._rows = rows
+        self._columns = {}
+        if dtype is None:
+            dtype = self.make_dtype(chunk, name_map)
+        self.dtype = dtype
+
+    @staticmethod
+    def make_dtype(chunk, name_map):
+        """
+        Return the dtype of a RoutedChunk reading the columns
+        of chunk named in name_map, under their new names
+        """
+        return np.dtype([(str(name), chunk.dtype[name_map[name]]) for name in name_map])
+
+    def __len__(self):
+        if self._rows is None:
+            return len(self._chunk)
+        return len(self._rows)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            if key not in self._columns:
+                if key not in self._name_map:
+                    raise ValueError("no field of name %s" % key)
+                column = self._chunk[self._name_map[key]]
+                if self._rows is not None:
+                    column = column[self._rows]
+                else:
+                    column = column.view(np.ndarray)
+                # the master chunk is shared by other catalogs
+                column.flags['WRITEABLE'] = False
+                self._columns[key] = column
+            return self._columns[key]
+
+        if self._rows is None:
+            rows = np.arange(len(self._chunk))[key]
+        else:
+            rows = self._rows[key]
+        return RoutedChunk(self._chunk, self._name_map, dtype=self.dtype, rows=rows)
@@ -1,6 +1,17 @@
 from __future__ import with_statement
+import os
+import copy
+import Queue
+import shutil
+import tempfile
 import numpy as np
-from lsst.sims.catalogs.db import CompoundCatalogDBObject
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from lsst.sims.utils import ObservationMetaData
+from lsst.sims.catalogs.db import CatalogDBObject, CompoundCatalogDBObject
+from .AsyncFileWriter import open_catalog_file
+from .ChunkRouting import RoutedChunk
+from .SortedCatalogWriter import SortedCatalogWriter
 
 
 class CompoundInstanceCatalog(object):
@@ -66,7 +77,6 @@ class CompoundInstanceCatalog(object):
         self._dbo_list = catalogDBObjectClassList
         self._ic_list = instanceCatalogClassList
         self._constraint = constraint
-        self._active_connections = []
 
         assigned = [False]*len(self._dbo_list)
         self._dbObjectGroupList = []
@@ -141,12 +151,14 @@ class CompoundInstanceCatalog(object):
 
     def find_a_connection(self, dboClass):
         """
-        Find an active database connection for a DBObject
+        Find an open database connection for a DBObject in the process-wide
+        registry of connections shared with CatalogDBObject (see
+        DBConnectionRegistry)
 
         @param [in] dbo is a DBObject class that needs to be connected
 
-        @param [out] returns a connection of self._active_connections
-        that suits the DBObject.  Returns None otherwise.
+        @param [out] returns the registered connection that suits the
+        DBObject.  Returns None otherwise.
         """
 
         if hasattr(dboClass, 'database'):
@@ -169,55 +181,25 @@ class CompoundInstanceCatalog(object):
         else:
             desired_port = None
 
-        if hasattr(dboClass, 'verbose'):
-            desired_verbose = dboClass.verbose
-        else:
-            desired_verbose = False
-
-        best_connection = None
-
-        for cc in self._active_connections:
-            if cc.database is desired_database and \
-               cc.driver is desired_driver and \
-               cc.host is desired_host and \
-               cc.port is desired_port and \
-               cc.verbose is desired_verbose:
-
-                best_connection = cc
-                break
-
-        return best_connection
+        return CatalogDBObject._connection_registry.find(desired_database, desired_driver,
+                                                         desired_host, desired_port)
 
-    def write_catalog(self, filename, chunk_size=None, write_header=True, write_mode='w'):
+    def _instantiate_catalogs(self):
         """
-        Write the stored list of InstanceCatalogs to a single ASCII output catalog.
-
-        @param [in] filename is the name of the file to be written
+        Instantiate the InstanceCatalog classes (each connected to its CatalogDBObject),
+        assign the non-private member variables of the CompoundInstanceCatalog to them,
+        and pre-process them (i.e. verify that they have access to all of the columns
+        they need).
 
-        @param [in] chunk_size is an optional parameter telling the CompoundInstanceCatalog
-        to query the database in manageable chunks (in case returning the whole catalog
-        takes too much memory)
-
-        @param [in] write_header a boolean specifying whether or not to add a header
-        to the output catalog (Note: only one header will be written; there will not be
-        a header for each InstanceCatalog in the CompoundInstanceCatalog; default True)
-
-        @param [in] write_mode is 'w' if you want to overwrite the output file or
-        'a' if you want to append to an existing output file (default: 'w')
+        @param [out] a list of the instantiated InstanceCatalogs, in the same
+        order as self._ic_list
         """
-
         instantiated_ic_list = [None]*len(self._ic_list)
 
-        # first, loop over all of the InstanceCatalog and CatalogDBObject classes, pre-processing
-        # them (i.e. verifying that they have access to all of the columns they need)
         for ix, (icClass, dboClass) in enumerate(zip(self._ic_list, self._dbo_list)):
-            best_connection = self.find_a_connection(dboClass)
-            if best_connection is None:
-                dbo = dboClass()
-                self._active_connections.append(dbo.connection)
-            else:
-                dbo = dboClass(connection=best_connection)
-
+            # the connection is opened (or found) in the
+            # process-wide registry of connections
+            dbo = dboClass()
             ic = icClass(dbo, obs_metadata=self._obs_metadata)
 
             # assign all non-private member variables of the CompoundInstanceCatalog
@@ -233,16 +215,38 @@ class CompoundInstanceCatalog(object):
             ic._write_pre_process()
             instantiated_ic_list[ix] = ic
 
+        # InstanceCatalogs that are queried through a CompoundCatalogDBObject
+        # check all of their cannot_be_null columns against the query results
+        for row in self._dbObjectGroupList:
+            if len(row) > 1:
+                for ix in row:
+                    instantiated_ic_list[ix]._pre_screen = True
+
+        return instantiated_ic_list
+
+    def _header_catalog_index(self):
+        """
+        Return the index (in self._ic_list) of the InstanceCatalog
+        whose header write_catalog writes
+        """
         for row in self._dbObjectGroupList:
             if len(row) == 1:
-                ic = instantiated_ic_list[row[0]]
-                ic._query_and_write(filename, chunk_size=chunk_size,
-                                    write_header=write_header, write_mode=write_mode,
-                                    obs_metadata=self._obs_metadata,
-                                    constraint=self._constraint)
-                write_mode = 'a'
-                write_header = False
+                return row[0]
+        return self._dbObjectGroupList[0][0]
+
+    def _make_compound_dbo(self, dbObjClassList, connection=None):
+        """
+        Instantiate the CompoundCatalogDBObject that will query the
+        CatalogDBObject classes in dbObjClassList (which all query the same table)
+
+        @param [in] dbObjClassList is a list of CatalogDBObject classes
 
+        @param [in] connection is an optional open DBConnection to the database
+
+        @param [out] an instantiation of self._compoundDBclass (or of the
+        class in self._compoundDBclass that supports the table) or, if there
+        is no such class, of CompoundCatalogDBObject
+        """
         default_compound_dbo = None
         if self._compoundDBclass is not None:
             if not hasattr(self._compoundDBclass, '__getitem__'):
@@ -254,52 +258,378 @@ class CompoundInstanceCatalog(object):
                         break
 
                 if default_compound_dbo is None:
-                    default_compound_dbo is CompoundCatalogDBObject
+                    default_compound_dbo = CompoundCatalogDBObject
+
+        if self._compoundDBclass is None:
+            return CompoundCatalogDBObject(dbObjClassList, connection=connection)
+
+        if not hasattr(self._compoundDBclass, '__getitem__'):
+            # if self._compoundDBclass is not a list
+            try:
+                return self._compoundDBclass(dbObjClassList)
+            except:
+                return default_compound_dbo(dbObjClassList)
+
+        for candidate in self._compoundDBclass:
+            use_it = True
+            if False in [candidate._table_restriction is not None and
+                         dbo.tableid in candidate._table_restriction
+                         for dbo in dbObjClassList]:
+
+                use_it = False
+
+            if use_it:
+                return candidate(dbObjClassList)
+
+        return default_compound_dbo(dbObjClassList)
+
+    def _build_groups(self):
+        """
+        Instantiate the InstanceCatalogs (see _instantiate_catalogs) and the
+        CompoundCatalogDBObjects of the groups of them that query the same table.
+
+        @param [out] the list of instantiated InstanceCatalogs and the list of
+        groups, in the order in which write_catalog writes them.  Each group is
+        a tuple containing a list of InstanceCatalogs and, for InstanceCatalogs
+        sharing a table, their CompoundCatalogDBObject (None otherwise).
+        """
+        instantiated_ic_list = self._instantiate_catalogs()
+
+        group_list = []
+        for row in self._dbObjectGroupList:
+            if len(row) == 1:
+                group_list.append(([instantiated_ic_list[row[0]]], None))
 
         for row in self._dbObjectGroupList:
             if len(row) > 1:
                 dbObjClassList = [self._dbo_list[ix] for ix in row]
                 catList = [instantiated_ic_list[ix] for ix in row]
-                for cat in catList:
-                    cat._pre_screen = True
 
                 # if a connection is already open to the database, use
                 # it rather than opening a new connection
                 best_connection = self.find_a_connection(dbObjClassList[0])
+                compound_dbo = self._make_compound_dbo(dbObjClassList, connection=best_connection)
+                group_list.append((catList, compound_dbo))
+
+        return instantiated_ic_list, group_list
+
+    def write_catalog(self, filename, chunk_size=None, write_header=True, write_mode='w',
+                      async_write=False, threads=None, sort_by=None, max_rows_in_memory=None):
+        """
+        Write the stored list of InstanceCatalogs to a single ASCII output catalog.
 
-                if self._compoundDBclass is None:
-                    compound_dbo = CompoundCatalogDBObject(dbObjClassList, connection=best_connection)
-                elif not hasattr(self._compoundDBclass, '__getitem__'):
-                    # if self._compoundDBclass is not a list
-                    try:
-                        compound_dbo = self._compoundDBclass(dbObjClassList)
-                    except:
-                        compound_dbo = default_compound_dbo(dbObjClassList)
-                else:
-                    compound_dbo = None
-                    for candidate in self._compoundDBclass:
-                        use_it = True
-                        if False in [candidate._table_restriction is not None and
-                                     dbo.tableid in candidate._table_restriction
-                                     for dbo in dbObjClassList]:
-
-                            use_it = False
-
-                        if use_it:
-                            compound_dbo = candidate(dbObjClassList)
-                            break
-
-                    if compound_dbo is None:
-                        compound_dbo = default_compound_dbo(dbObjClassList)
-
-                self._write_compound(catList, compound_dbo, filename,
-                                     chunk_size=chunk_size, write_header=write_header,
-                                     write_mode=write_mode)
+        @param [in] filename is the name of the file to be written
+
+        @param [in] chunk_size is an optional parameter telling the CompoundInstanceCatalog
+        to query the database in manageable chunks (in case returning the whole catalog
+        takes too much memory)
+
+        @param [in] write_header a boolean specifying whether or not to add a header
+        to the output catalog (Note: only one header will be written; there will not be
+        a header for each InstanceCatalog in the CompoundInstanceCatalog; default True)
+
+        @param [in] write_mode is 'w' if you want to overwrite the output file or
+        'a' if you want to append to an existing output file (default: 'w')
+
+        @param [in] async_write is a boolean.  If True, the catalog is written
+        to disk in large blocks by a background thread (see AsyncFileWriter),
+        so that slow disk writes do not hold up the next chunk (default False).
+
+        @param [in] threads is an optional number of threads.  If it is greater
+        than 1, the groups of InstanceCatalogs that query different tables are
+        queried and written concurrently on a pool of that many threads, each
+        to a temporary segment file in the directory of filename.  The segments
+        are then concatenated into filename in the same order as the groups are
+        written without threads, so the output does not depend on threads.
+        filename is not touched if writing any of the segments fails.
+
+        @param [in] sort_by is the name of an output column of every InstanceCatalog.
+        If it is set, the rows of all of the InstanceCatalogs are merged into one
+        sequence in ascending order of that column (see InstanceCatalog.write_catalog).
+        Rows with equal values are written in the order in which they would be
+        written without sort_by, whether or not threads is set.
+
+        @param [in] max_rows_in_memory is the number of rows sorted in memory
+        before they are spilled to disk when sort_by is set (default 1000000)
+        """
+
+        instantiated_ic_list, group_list = self._build_groups()
+
+        # the InstanceCatalogs were pre-processed by _instantiate_catalogs
+        try:
+            self._write_groups(filename, instantiated_ic_list, group_list,
+                               chunk_size=chunk_size, write_header=write_header,
+                               write_mode=write_mode, async_write=async_write,
+                               threads=threads, sort_by=sort_by,
+                               max_rows_in_memory=max_rows_in_memory)
+        finally:
+            for ic in instantiated_ic_list:
+                ic._write_post_process()
+
+    def _write_groups(self, filename, instantiated_ic_list, group_list, chunk_size=None,
+                      write_header=True, write_mode='w', async_write=False, threads=None,
+                      sort_by=None, max_rows_in_memory=None):
+        """
+        Write the groups of InstanceCatalogs made by _build_groups
+        to filename (see write_catalog for the parameters)
+        """
+        if sort_by is not None:
+            self._write_sorted(filename, instantiated_ic_list, group_list, sort_by,
+                               chunk_size=chunk_size, write_header=write_header,
+                               write_mode=write_mode, async_write=async_write,
+                               threads=threads, max_rows_in_memory=max_rows_in_memory)
+            return
+
+        if threads is None or threads < 2 or len(group_list) < 2:
+            for catList, compound_dbo in group_list:
+                self._write_group(catList, compound_dbo, filename, chunk_size=chunk_size,
+                                  write_header=write_header, write_mode=write_mode,
+                                  async_write=async_write)
                 write_mode = 'a'
                 write_header = False
+            return
+
+        segment_dir = os.path.dirname(os.path.abspath(filename))
+        segment_list = []
+        try:
+            for ix in range(len(group_list)):
+                file_descriptor, segment_name = tempfile.mkstemp(dir=segment_dir, suffix='.segment')
+                os.close(file_descriptor)
+                segment_list.append(segment_name)
+
+            tasks = [(catList, compound_dbo, segment_name, chunk_size, async_write, self._obs_metadata)
+                     for (catList, compound_dbo), segment_name in zip(group_list, segment_list)]
+
+            pool = ThreadPool(min(threads, len(tasks)))
+            try:
+                pool.map(self._write_group_segment, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+            with open(filename, write_mode) as file_handle:
+                if write_header:
+                    instantiated_ic_list[self._header_catalog_index()].write_header(file_handle)
+                for segment_name in segment_list:
+                    with open(segment_name, 'r') as segment:
+                        shutil.copyfileobj(segment, file_handle)
+        finally:
+            for segment_name in segment_list:
+                if os.path.exists(segment_name):
+                    os.unlink(segment_name)
+
+    def _write_sorted(self, filename, instantiated_ic_list, group_list, sort_by,
+                      chunk_size=None, write_header=True, write_mode='w',
+                      async_write=False, threads=None, max_rows_in_memory=None):
+        """
+        Write the groups of InstanceCatalogs (see _build_groups) to filename
+        through a SortedCatalogWriter, each group to a segment ranked by its
+        position in group_list (see write_catalog for the other parameters)
+        """
+        for ic in instantiated_ic_list:
+            ic._check_sort_column(sort_by)
+
+        header_catalog = instantiated_ic_list[self._header_catalog_index()]
+
+        for ic in instantiated_ic_list:
+            ic._sort_column = sort_by
+
+        try:
+            with open_catalog_file(filename, write_mode, async_write=async_write) as file_handle:
+                if write_header:
+                    header_catalog.write_header(file_handle)
+
+                with SortedCatalogWriter(file_handle, max_rows_in_memory=max_rows_in_memory,
+                                         scratch_dir=os.path.dirname(os.path.abspath(filename)),
+                                         endline=header_catalog.endline) as sorted_handle:
+
+                    tasks = [(catList, compound_dbo, sorted_handle.segment(rank), chunk_size,
+                              self._obs_metadata)
+                             for rank, (catList, compound_dbo) in enumerate(group_list)]
+
+                    if threads is None or threads < 2 or len(tasks) < 2:
+                        for task in tasks:
+                            self._write_sorted_segment(task)
+                    else:
+                        pool = ThreadPool(min(threads, len(tasks)))
+                        try:
+                            pool.map(self._write_sorted_segment, tasks)
+                        finally:
+                            pool.close()
+                            pool.join()
+        finally:
+            for ic in instantiated_ic_list:
+                ic._sort_column = None
+
+    def _write_sorted_segment(self, task):
+        """
+        Write one group of InstanceCatalogs to a segment of a SortedCatalogWriter.
+        task is a tuple containing the list of InstanceCatalogs, the
+        CompoundCatalogDBObject (or None), the segment, chunk_size
+        and the ObservationMetaData
+        """
+        catList, compound_dbo, segment, chunk_size, obs_metadata = task
+        if compound_dbo is None:
+            catList[0]._write_query_results(segment, chunk_size=chunk_size,
+                                            obs_metadata=obs_metadata,
+                                            constraint=self._constraint)
+        else:
+            self._write_compound_results(catList, compound_dbo, segment,
+                                         chunk_size=chunk_size, obs_metadata=obs_metadata)
+        segment.close()
+
+    def _write_group_segment(self, task):
+        """
+        Write one group of InstanceCatalogs to a segment file, without a header.
+        task is a tuple containing the list of InstanceCatalogs, the
+        CompoundCatalogDBObject (or None), the name of the segment file,
+        chunk_size, async_write and the ObservationMetaData (see _write_group)
+        """
+        catList, compound_dbo, segment_name, chunk_size, async_write, obs_metadata = task
+        self._write_group(catList, compound_dbo, segment_name, chunk_size=chunk_size,
+                          write_header=False, write_mode='w', async_write=async_write,
+                          obs_metadata=obs_metadata)
+
+    def _write_group(self, catList, compound_dbo, filename, chunk_size=None,
+                     write_header=False, write_mode='a', async_write=False,
+                     obs_metadata=None):
+        """
+        Write out a group of InstanceCatalogs that query the same table
+
+        @param [in] catList is the list of InstanceCatalog instantiations
+
+        @param [in] compound_dbo is the CompoundCatalogDBObject instantiation
+        associated with catList, or None if catList contains a single
+        InstanceCatalog (which then queries its own db_obj)
+
+        @param [in] obs_metadata is the ObservationMetaData of the query
+        (default: the ObservationMetaData of the CompoundInstanceCatalog)
+
+        The other parameters are as in write_catalog
+        """
+        if obs_metadata is None:
+            obs_metadata = self._obs_metadata
+
+        if compound_dbo is None:
+            catList[0]._query_and_write(filename, chunk_size=chunk_size,
+                                        write_header=write_header, write_mode=write_mode,
+                                        obs_metadata=obs_metadata,
+                                        constraint=self._constraint,
+                                        async_write=async_write)
+        else:
+            self._write_compound(catList, compound_dbo, filename,
+                                 chunk_size=chunk_size, write_header=write_header,
+                                 write_mode=write_mode, async_write=async_write,
+                                 obs_metadata=obs_metadata)
+
+    def write_catalogs(self, filename_list, obs_metadata_list, chunk_size=None,
+                       write_header=True, write_mode='w', async_write=False,
+                       threads=None):
+        """
+        Write this CompoundInstanceCatalog once for each of a list of
+        ObservationMetaData (e.g. one catalog per visit).  The InstanceCatalogs
+        and CompoundCatalogDBObjects are built once and re-used for every
+        ObservationMetaData (only their obs_metadata is changed), so that each
+        catalog only costs its queries and the evaluation of its columns.
+
+        @param [in] filename_list is a list of the names of the files
+        to be written, one for each element of obs_metadata_list
+
+        @param [in] obs_metadata_list is a list of ObservationMetaData (None
+        stands for the ObservationMetaData of the CompoundInstanceCatalog)
+
+        @param [in] chunk_size, write_header, write_mode and async_write
+        are as in write_catalog (and apply to every file)
+
+        @param [in] threads is an optional number of threads.  If it is greater
+        than 1, up to that many catalogs are written concurrently, each thread
+        with its own set of InstanceCatalogs and CompoundCatalogDBObjects (so
+        that at most threads sets are built).
+        """
+        if len(filename_list) != len(obs_metadata_list):
+            raise RuntimeError("write_catalogs was given %d file names, but %d "
+                               "ObservationMetaData"
+                               % (len(filename_list), len(obs_metadata_list)))
+
+        if len(filename_list) == 0:
+            return
+
+        n_threads = 1
+        if threads is not None and threads > 1:
+            n_threads = min(threads, len(filename_list))
+
+        visit_kwargs = dict(chunk_size=chunk_size, write_header=write_header,
+                            write_mode=write_mode, async_write=async_write)
+
+        if n_threads == 1:
+            groups = self._build_groups()
+            for filename, obs_metadata in zip(filename_list, obs_metadata_list):
+                self._write_visit(groups, filename, obs_metadata, **visit_kwargs)
+            return
+
+        # each thread takes a set of InstanceCatalogs and CompoundCatalogDBObjects
+        # from the queue for the catalog it writes, and puts it back afterwards
+        group_queue = Queue.Queue()
+        for ix in range(n_threads):
+            group_queue.put(self._build_groups())
+
+        tasks = [(group_queue, filename, obs_metadata, visit_kwargs)
+                 for filename, obs_metadata in zip(filename_list, obs_metadata_list)]
+
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(self._write_visit_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _write_visit_task(self, task):
+        """
+        Write one of the catalogs of write_catalogs on a thread.  task is a
+        tuple containing the queue of sets of InstanceCatalogs and
+        CompoundCatalogDBObjects, the file name, the ObservationMetaData
+        and a dict of the other arguments of _write_visit
+        """
+        group_queue, filename, obs_metadata, visit_kwargs = task
+        groups = group_queue.get()
+        try:
+            self._write_visit(groups, filename, obs_metadata, **visit_kwargs)
+        finally:
+            group_queue.put(groups)
+
+    def _write_visit(self, groups, filename, obs_metadata, chunk_size=None,
+                     write_header=True, write_mode='w', async_write=False):
+        """
+        Write the catalog for one ObservationMetaData from groups (the
+        output of _build_groups), re-binding the obs_metadata of the
+        InstanceCatalogs to obs_metadata (see write_catalogs)
+        """
+        # the rows are selected and evaluated with the same ObservationMetaData
+        if obs_metadata is None:
+            obs_metadata = self._obs_metadata
+
+        instantiated_ic_list, group_list = groups
+        for ic in instantiated_ic_list:
+            if obs_metadata is not None:
+                ic.obs_metadata = copy.deepcopy(obs_metadata)
+            else:
+                ic.obs_metadata = ObservationMetaData()
+            ic._write_pre_process()
+
+        try:
+            for catList, compound_dbo in group_list:
+                self._write_group(catList, compound_dbo, filename, chunk_size=chunk_size,
+                                  write_header=write_header, write_mode=write_mode,
+                                  async_write=async_write, obs_metadata=obs_metadata)
+                write_mode = 'a'
+                write_header = False
+        finally:
+            for ic in instantiated_ic_list:
+                ic._write_post_process()
 
     def _write_compound(self, catList, compound_dbo, filename,
-                        chunk_size=None, write_header=False, write_mode='a'):
+                        chunk_size=None, write_header=False, write_mode='a',
+                        async_write=False, obs_metadata=None):
         """
         Write out a set of InstanceCatalog instantiations that have been
         determined to query the same database table.
@@ -321,54 +651,120 @@ class CompoundInstanceCatalog(object):
 
         @param [in] write_mode is 'w' if you want to overwrite the output file or
         'a' if you want to append to an existing output file (default: 'w')
+
+        @param [in] async_write is a boolean indicating whether to write
+        the file on a background thread (see write_catalog)
+
+        @param [in] obs_metadata is the ObservationMetaData of the query
+        (default: the ObservationMetaData of the CompoundInstanceCatalog)
         """
 
-        colnames = []
-        master_colnames = []
-        name_map = []
-        dbObjNameList = [db.objid for db in compound_dbo._dbObjectClassList]
-        for name, cat in zip(dbObjNameList, catList):
-            localNames = []
-            local_map = {}
-            for colName in cat._active_columns:
-                colnames.append('%s_%s' % (name, colName))
-                localNames.append('%s_%s' % (name, colName))
-                local_map['%s_%s' % (name, colName)] = colName
-            master_colnames.append(localNames)
-            name_map.append(local_map)
-
-        master_results = compound_dbo.query_columns(colnames=colnames,
-                                                    obs_metadata=self._obs_metadata,
-                                                    constraint=self._constraint,
-                                                    chunk_size=chunk_size)
+        if obs_metadata is None:
+            obs_metadata = self._obs_metadata
 
-        with open(filename, write_mode) as file_handle:
+        with open_catalog_file(filename, write_mode, async_write=async_write) as file_handle:
             if write_header:
                 catList[0].write_header(file_handle)
 
-            new_dtype_list = [None]*len(catList)
+            self._write_compound_results(catList, compound_dbo, file_handle,
+                                         chunk_size=chunk_size, obs_metadata=obs_metadata)
+
+    def _write_compound_results(self, catList, compound_dbo, file_handle,
+                                chunk_size=None, obs_metadata=None):
+        """
+        Query compound_dbo and write the rows of each InstanceCatalog in
+        catList to file_handle (an open file, or any object with its
+        write() and writelines() methods).  See _write_compound for the
+        other parameters.
+        """
+        dbObjNameList = [db.objid for db in compound_dbo._dbObjectClassList]
+        splitter = _CompoundChunkSplitter(dbObjNameList, catList)
 
-            first_chunk = True
-            for chunk in master_results:
-                for ix, (catName, cat) in enumerate(zip(dbObjNameList, catList)):
+        shared_predicates = _shared_null_predicates(catList)
+        if compound_dbo._has_custom_final_pass():
+            shared_predicates = []
 
-                    if first_chunk:
-                        for iy, name in enumerate(master_colnames[ix]):
-                            if name not in chunk.dtype.fields:
-                                master_colnames[ix][iy] = name_map[ix][name]
+        constraint = compound_dbo.combine_constraints(self._constraint, shared_predicates)
 
-                    local_recarray = chunk[master_colnames[ix]].view(np.recarray)
+        master_results = compound_dbo.query_columns(colnames=splitter.colnames,
+                                                    obs_metadata=obs_metadata,
+                                                    constraint=constraint,
+                                                    chunk_size=chunk_size)
+
+        for chunk in master_results:
+            for cat, local_recarray in zip(catList, splitter.split(chunk)):
+                cat._write_recarray(local_recarray, file_handle)
+
+
+def _shared_null_predicates(catList):
+    """
+    Return the cannot_be_null predicates that can be pushed into a query
+    whose results are read by all of the InstanceCatalogs in catList.
+
+    Rows removed from the query are removed for every catalog, so only
+    the cannot_be_null predicates shared by all of the catalogs can be
+    pushed into the SQL
+    """
+    shared_predicates = None
+    for cat in catList:
+        predicates = cat._null_predicates()
+        if shared_predicates is None:
+            shared_predicates = predicates
+        else:
+            shared_predicates = [pp for pp in shared_predicates if pp in predicates]
+
+    return shared_predicates
+
+
+class _CompoundChunkSplitter(object):
+    """
+    Splits the chunks of query results returned by a CompoundCatalogDBObject
+    into the chunks read by each of the InstanceCatalogs it is queried for.
+    The columns of the CatalogDBObject whose objid is 'name' are called
+    'name_column' in the query results.  Each InstanceCatalog is given a
+    RoutedChunk, which reads its columns from the query results without
+    copying them.
+    """
+
+    def __init__(self, dbObjNameList, catList):
+        """
+        @param [in] dbObjNameList is a list of the objids of the
+        CatalogDBObjects associated with the InstanceCatalogs in catList
+        (InstanceCatalogs sharing a CatalogDBObject class share its columns)
+
+        @param [in] catList is a list of InstanceCatalog instantiations
+        """
+        self.colnames = []
+        self._name_maps = []
+        self._dtype_list = [None]*len(catList)
+
+        for name, cat in zip(dbObjNameList, catList):
+            name_map = OrderedDict()
+            for colName in cat._active_columns:
+                master_name = '%s_%s' % (name, colName)
+                if master_name not in self.colnames:
+                    self.colnames.append(master_name)
+                name_map[colName] = master_name
+            self._name_maps.append(name_map)
+
+    def split(self, chunk):
+        """
+        @param [in] chunk is a chunk of the results of querying self.colnames
+
+        @param [out] a list containing a RoutedChunk for each InstanceCatalog,
+        with the columns named as the InstanceCatalog expects
+        """
+        output = []
+        for ix, name_map in enumerate(self._name_maps):
 
-                    local_recarray.flags['WRITEABLE'] = False  # so numpy does not raise a warning
-                                                               # because it thinks we may accidentally
-                                                               # write to this array
-                    if new_dtype_list[ix] is None:
-                        new_dtype = np.dtype([tuple([dd.replace(catName+'_', '')] +
-                                                    [local_recarray.dtype[dd]])
-                                              for dd in master_colnames[ix]])
-                        new_dtype_list[ix] = new_dtype
+            if self._dtype_list[ix] is None:
+                # a CompoundCatalogDBObject may return some columns
+                # under their unprefixed names
+                for colName in name_map:
+                    if name_map[colName] not in chunk.dtype.fields:
+                        name_map[colName] = colName
+                self._dtype_list[ix] = RoutedChunk.make_dtype(chunk, name_map)
 
-                    local_recarray.dtype = new_dtype_list[ix]
-                    cat._write_recarray(local_recarray, file_handle)
+            output.append(RoutedChunk(chunk, name_map, dtype=self._dtype_list[ix]))
 
-                first_chunk = False
+        return output
@@ -1,12 +1,22 @@
 """Instance Catalog"""
+import os
 import warnings
 import numpy as np
 import inspect
 import re
 import copy
+import time
+import StringIO
 from collections import OrderedDict
 from lsst.sims.utils import defaultSpecMap
 from lsst.sims.utils import ObservationMetaData
+from .CatalogProcessPool import CatalogProcessPool
+from .CatalogStatistics import CatalogStatistics
+from .AsyncFileWriter import open_catalog_file
+from .CatalogShards import ShardedCatalogWriter
+from .SortedCatalogWriter import SortedCatalogWriter
+from .CatalogEpochs import _EpochTracker
+from lsst.sims.catalogs.decorators import CompoundColumn
 
 __all__ = ["InstanceCatalog"]
 
@@ -37,6 +47,7 @@ class InstanceCatalogMeta(type):
         dct['_cached_columns'] = {}
         dct['_compound_columns'] = {}
         dct['_compound_column_names'] = {}
+        dct['_column_plans'] = {}
 
         return super(InstanceCatalogMeta, cls).__new__(cls, name, bases, dct)
 
@@ -52,11 +63,12 @@ class InstanceCatalogMeta(type):
                              % cls.catalog_type)
         cls.registry[cls.catalog_type] = cls
 
-        # add methods for default columns
+        # add methods for default columns; these return read-only broadcast views
+        # of a single value rather than len(chunk) copies of it
         for default in cls.default_columns:
             setattr(cls, 'default_%s'%(default[0]),
                     lambda self, value=default[1], type=default[2]:
-                    np.array([value for i in xrange(len(self._current_chunk))], dtype=type))
+                    self.constant_column(value, dtype=type))
 
         # store compound columns and check for collisions
         #
@@ -95,6 +107,241 @@ class InstanceCatalogMeta(type):
         return super(InstanceCatalogMeta, cls).__init__(name, bases, dct)
 
 
+def _take_rows(values, dexes):
+    """
+    Return values[dexes].  Constant columns (zero-stride broadcast views, as
+    returned by InstanceCatalog.constant_column) stay broadcast views, rather
+    than being expanded into one copy of the value per selected row.
+    """
+    if (isinstance(values, np.ndarray) and values.ndim == 1 and
+        len(values) > 0 and values.strides[0] == 0):
+
+        return np.broadcast_to(values[:1].reshape(()), (len(dexes),))
+    return values[dexes]
+
+
+_null_strings = ('none', 'nan', 'null')
+
+
+def _sample_kwargs(sample_fraction, seed):
+    """
+    Return the keyword arguments with which to ask query_columns for a
+    sample of its results (none if sample_fraction is None, so that
+    CatalogDBObjects overriding query_columns without them still work)
+    """
+    if sample_fraction is None:
+        return {}
+    return {'sample_fraction': sample_fraction, 'seed': seed}
+
+
+def _is_null_object(value):
+    """
+    Return True if a single (Python object) value counts as null for the
+    purposes of cannot_be_null: None, NaN, or a string reading
+    'None', 'NaN' or 'Null' (in any case).
+    """
+    if value is None:
+        return True
+    if isinstance(value, basestring):
+        return value.lower() in _null_strings
+    try:
+        return bool(value != value)
+    except (TypeError, ValueError):
+        return False
+
+
+def _null_mask(values):
+    """
+    Return a boolean array that is True wherever values (a numpy array)
+    is null in the sense of cannot_be_null.  Return None if values is of
+    a type that cannot hold nulls (ints, bools, etc.), so that callers do not
+    need to allocate a mask at all.
+
+    The test depends on the dtype of values: floats are tested with isnan,
+    strings are tested case-insensitively against 'none', 'nan' and 'null',
+    and object arrays are tested element by element with _is_null_object.
+    """
+    values = np.asarray(values)
+    kind = values.dtype.kind
+    if kind in ('f', 'c'):
+        return np.isnan(values)
+    elif kind in ('S', 'U'):
+        lowered = np.char.lower(values)
+        return np.logical_or(lowered == 'none',
+                             np.logical_or(lowered == 'nan', lowered == 'null'))
+    elif kind == 'O':
+        return np.fromiter((_is_null_object(vv) for vv in values),
+                           dtype=bool, count=len(values))
+    return None
+
+
+def _class_that_defined(catalog_class, name):
+    """
+    Return the first class in the MRO of catalog_class whose own
+    namespace defines the attribute name
+    """
+    for cls in inspect.getmro(catalog_class):
+        if name in cls.__dict__:
+            return cls
+    return None
+
+
+class _ColumnPlan(object):
+    """
+    The resolution of every column an InstanceCatalog class can return, given
+    the columns provided by its CatalogDBObject.  Each column is mapped to the
+    getter, compound getter, database column or default column that provides
+    it.  A plan is built once per (InstanceCatalog class, columnMap) and is
+    shared by every instantiation of that class on that columnMap.
+    """
+
+    def __init__(self, catalog_class, db_column_names):
+        """
+        @param [in] catalog_class is the InstanceCatalog class
+
+        @param [in] db_column_names is the list of the columns in the
+        CatalogDBObject's columnMap
+        """
+        self.all_available_columns = []
+        available = set()
+
+        def add_column(name):
+            if name not in available:
+                available.add(name)
+                self.all_available_columns.append(name)
+
+        for name in db_column_names:
+            add_column(name)
+
+        for name in catalog_class._compound_column_names:
+            add_column(name)
+
+        for name in catalog_class._compound_columns:
+            add_column(name)
+
+        for name in dir(catalog_class):
+            if name[:4] == 'get_':
+                add_column(name[4:])
+            elif name[:8] == 'default_':
+                add_column(name[8:])
+
+        # because asking for a compound_column means asking for
+        # its individual sub-columns, which means those columns
+        # would get listed twice in the catalog
+        self.default_column_outputs = [name for name in self.all_available_columns
+                                       if name not in catalog_class._compound_columns]
+
+        # self.resolution maps column names to (kind, attribute name) where
+        # kind is one of 'getter', 'compound', 'database' or 'default'.
+        # self.origins maps calculated columns to the class that defined them.
+        db_column_set = set(db_column_names)
+        self.resolution = {}
+        self.origins = {}
+        for name in self.all_available_columns:
+            getter = 'get_%s' % name
+            default = 'default_%s' % name
+            if hasattr(catalog_class, getter):
+                self.resolution[name] = ('getter', getter)
+                self.origins[name] = _class_that_defined(catalog_class, getter)
+            elif name in catalog_class._compound_column_names:
+                getter = catalog_class._compound_column_names[name]
+                self.resolution[name] = ('compound', getter)
+                self.origins[name] = _class_that_defined(catalog_class, getter)
+            elif name in db_column_set:
+                self.resolution[name] = ('database', None)
+            elif hasattr(catalog_class, default):
+                self.resolution[name] = ('default', default)
+
+        # compiled output transformations, keyed on the output columns and
+        # the contents of the transformations dict (see output_transforms)
+        self.transform_plans = {}
+
+    def output_transforms(self, column_names, transformations):
+        """
+        Return a tuple containing, for each of column_names, the function in
+        transformations to apply to that column before it is output (or None
+        if it is output as it is).  The result is memoized, so that each
+        combination of output columns and transformations is only compiled
+        once per plan, however many catalogs (e.g. the members of a
+        CompoundInstanceCatalog) use it.
+
+        @param [in] column_names is a tuple of the output column names
+
+        @param [in] transformations is a dict mapping column names to functions
+        """
+        key = (column_names, frozenset(transformations.items()))
+        if key not in self.transform_plans:
+            self.transform_plans[key] = tuple(transformations.get(name, None)
+                                              for name in column_names)
+        return self.transform_plans[key]
+
+    @classmethod
+    def for_catalog(cls, catalog_class, db_obj):
+        """
+        Return the (memoized) plan for catalog_class reading from db_obj
+        """
+        key = tuple(db_obj.columnMap.keys())
+        if key not in catalog_class._column_plans:
+            catalog_class._column_plans[key] = cls(catalog_class, key)
+        return catalog_class._column_plans[key]
+
+
+class _FilterStatistics(object):
+    """
+    Running totals of the cost and pass rate of one cannot_be_null predicate
+    as evaluated by InstanceCatalog._filter_chunk
+    """
+
+    def __init__(self, source):
+        """
+        @param [in] source is 'database' if the predicate is evaluated on the
+        raw database query results or 'getter' if it is evaluated on a
+        column calculated by the catalog
+        """
+        self.source = source
+        self.calls = 0
+        self.rows_in = 0
+        self.rows_passed = 0
+        self.time = 0.0
+
+    def record(self, rows_in, rows_passed, elapsed):
+        self.calls += 1
+        self.rows_in += rows_in
+        self.rows_passed += rows_passed
+        self.time += elapsed
+
+    def merge(self, calls, rows_in, rows_passed, elapsed):
+        """
+        Add the totals of calls made elsewhere (e.g. in a worker process)
+        """
+        self.calls += calls
+        self.rows_in += rows_in
+        self.rows_passed += rows_passed
+        self.time += elapsed
+
+    @property
+    def pass_rate(self):
+        if self.rows_in == 0:
+            return None
+        return float(self.rows_passed)/float(self.rows_in)
+
+    def rank(self):
+        """
+        The expected cost of this predicate per row it rejects.  Predicates
+        are evaluated in ascending order of rank.  Returns None if the
+        predicate has not yet been evaluated on any rows.
+        """
+        if self.rows_in == 0:
+            return None
+        rejection_rate = max(1.0 - self.pass_rate, 1.0e-6)
+        return (self.time/self.rows_in)/rejection_rate
+
+    def as_dict(self):
+        return {'source': self.source, 'calls': self.calls,
+                'rows_in': self.rows_in, 'rows_passed': self.rows_passed,
+                'time': self.time, 'pass_rate': self.pass_rate}
+
+
 class _MimicRecordArray(object):
     """An object used for introspection of the database colums.
 
@@ -141,8 +388,12 @@ class InstanceCatalog(object):
     delimiter = ", "
     comment_char = "#"
     endline = "\n"
-    _pre_screen = False  # if true, write_catalog() will check database query results against
-                         # cannot_be_null before calculating getter columns
+    _pre_screen = False  # cannot_be_null columns that come straight from the database are always
+                         # checked against the query results before any getter columns are calculated.
+                         # If true, write_catalog() will also check database query results against
+                         # cannot_be_null for columns whose names are overridden by getters
+    profile = False  # if true, write_catalog() records a CatalogStatistics describing where
+                     # the time went (see run_statistics())
 
     @classmethod
     def new_catalog(cls, catalog_type, *args, **kwargs):
@@ -168,8 +419,9 @@ class InstanceCatalog(object):
         """Iterate the column names, expanding any compound columns"""
 
         for column in self._column_outputs:
-            if self.is_compound_column(column):
-                for col in getattr(getattr(self, "get_" + column), '_colnames'):
+            getfunc = "get_" + column
+            if getfunc in self._compound_columns:
+                for col in self._compound_columns[getfunc]:
                     yield col
             else:
                 yield column
@@ -215,6 +467,8 @@ class InstanceCatalog(object):
 
         self.db_obj = db_obj
         self._current_chunk = None
+        self._current_rows = None
+        self._transformed_cache = {}
 
         # this dict will contain information telling the user where the columns in
         # the catalog come from
@@ -229,11 +483,11 @@ class InstanceCatalog(object):
             self.obs_metadata = ObservationMetaData()
 
         if self.column_outputs is not None:
-            self._column_outputs = copy.deepcopy(self.column_outputs)
+            self._column_outputs = list(self.column_outputs)
 
         if column_outputs is not None:
             if self.column_outputs is None:
-                self._column_outputs = copy.deepcopy(column_outputs)
+                self._column_outputs = list(column_outputs)
             else:
                 for col in column_outputs:
                     if col not in self._column_outputs:
@@ -248,17 +502,21 @@ class InstanceCatalog(object):
         # is what the catalog actually uses in self._filter_chunk
         self._cannot_be_null = None
         if self.cannot_be_null is not None:
-            self._cannot_be_null = copy.deepcopy(self.cannot_be_null)
+            self._cannot_be_null = list(self.cannot_be_null)
 
         if cannot_be_null is not None:
             if self.cannot_be_null is None:
-                self._cannot_be_null = copy.deepcopy(cannot_be_null)
+                self._cannot_be_null = list(cannot_be_null)
             else:
                 for col in cannot_be_null:
                     if col not in self._cannot_be_null:
                         self._cannot_be_null.append(col)
 
         self._actually_calculated_columns = []  # a list of all the columns referenced by self.column_by_name
+
+        # a dict of _FilterStatistics keyed on (column name, source) recording the cost
+        # and pass rate of each cannot_be_null predicate
+        self._filter_stats = OrderedDict()
         self.constraint = constraint
 
         if specFileMap is not None:
@@ -268,64 +526,89 @@ class InstanceCatalog(object):
 
         self._column_cache = {}
 
+        # the CatalogStatistics being recorded while the catalog is written
+        # with self.profile = True (None otherwise)
+        self._profiler = None
+        self._run_statistics = None
+
+        # the (RA, Dec) output columns used to place rows on the sky
+        # while writing a sharded catalog (None otherwise)
+        self._shard_columns = None
+
+        # the output column by which the rows are sorted while
+        # writing a sorted catalog (None otherwise)
+        self._sort_column = None
+
+        # the _EpochTracker sorting static from time-dependent columns
+        # while write_epoch_catalogs() is running (None otherwise)
+        self._epoch_tracker = None
+
+        # the SharedColumnCache through which this catalog shares columns
+        # with the other catalogs written by parallelCatalogWriter (None
+        # otherwise), and the stack of the sets of columns read by each
+        # column being calculated
+        self._shared_columns = None
+        self._shared_column_stack = []
+
+        # identifies the columns of the query results this catalog reads its
+        # database columns from, when the catalogs sharing columns read
+        # different columns of the same query results (None otherwise)
+        self._shared_column_source = None
+
         # self._column_origins_switch tells column_by_name to log where it is getting
         # the columns in self._column_origins (we only want to do that once)
         self._column_origins_switch = True
 
-        # now we will create and populate a list containing the names of
-        # all of the columns which this InstanceCatalog can return.
+        # now we will look up the plan resolving each of the columns
+        # which this InstanceCatalog can return (it is built the first time this
+        # class is instantiated on a CatalogDBObject with these columns) and
+        # copy the list of available columns out of it.
         # Note: this needs to happen before self._check_requirements()
         # is called in case any getters depend on the contents of
         # _all_available_columns.  That way, self._check_requirements()
         # can verify that the getter will run the way it is actually
         # being called.
-        self._all_available_columns = []
-
-        for name in self.db_obj.columnMap.keys():
-            if name not in self._all_available_columns:
-                self._all_available_columns.append(name)
-
-        for name in self._compound_column_names:
-            if name not in self._all_available_columns:
-                self._all_available_columns.append(name)
-
-        for name in self._compound_columns:
-            if name not in self._all_available_columns:
-                self._all_available_columns.append(name)
-
-        for name in dir(self):
-            if name[:4] == 'get_':
-                columnName = name[4:]
-                if columnName not in self._all_available_columns:
-                    self._all_available_columns.append(columnName)
-            elif name[:8] == 'default_':
-                columnName = name[8:]
-                if columnName not in self._all_available_columns:
-                    self._all_available_columns.append(columnName)
+        self._column_plan = _ColumnPlan.for_catalog(self.__class__, self.db_obj)
+        self._column_resolution = self._column_plan.resolution
+        self._all_available_columns = list(self._column_plan.all_available_columns)
 
         if not hasattr(self, '_column_outputs'):
-            self._column_outputs = []
-
-            # because asking for a compound_column means asking for
-            # its individual sub-columns, which means those columns
-            # will get listed twice in the catalog
-            for name in self._all_available_columns:
-                if name not in self._compound_columns:
-                    self._column_outputs.append(name)
+            self._column_outputs = list(self._column_plan.default_column_outputs)
 
         self._check_requirements()
 
-    def _set_current_chunk(self, chunk, column_cache=None):
-        """Set the current chunk and clear the column cache"""
+    def _set_current_chunk(self, chunk, column_cache=None, rows=None):
+        """
+        Set the current chunk and clear the column cache.  rows are the
+        indices of the rows of chunk in the chunk of query results
+        it was selected from (optional).
+        """
         self._current_chunk = chunk
+        self._current_rows = rows
+        self._transformed_cache = {}
         if column_cache is None:
             self._column_cache = {}
         else:
             self._column_cache = column_cache
 
+    def constant_column(self, value, dtype=None):
+        """
+        Return a column containing value in every row of the current chunk.
+
+        The column is a read-only, zero-stride view of a single value, so it
+        costs the same regardless of the size of the chunk.  Getters can use it
+        like any other numpy array, except that they cannot modify it in place.
+        This is what default_columns are made of.
+
+        @param [in] value is the value to be repeated
+
+        @param [in] dtype is an optional numpy dtype for the column
+        """
+        return np.broadcast_to(np.array(value, dtype=dtype), (len(self._current_chunk),))
+
     def db_required_columns(self):
         """Get the list of columns required to be in the database object."""
-        saved_cache = self._cached_columns
+        saved_cache = self._column_cache
         saved_chunk = self._current_chunk
         self._set_current_chunk(_MimicRecordArray())
 
@@ -353,11 +636,173 @@ class InstanceCatalog(object):
     def column_by_name(self, column_name, *args, **kwargs):
         """Given a column name, return the column data"""
 
+        if self._profiler is not None:
+            return self._profiled_column_by_name(column_name, *args, **kwargs)
+
+        return self._unprofiled_column_by_name(column_name, *args, **kwargs)
+
+    def _unprofiled_column_by_name(self, column_name, *args, **kwargs):
+        """
+        column_by_name, without the profiling
+        """
+        if self._epoch_tracker is not None:
+            return self._epoch_column_by_name(column_name, *args, **kwargs)
+
+        if self._shared_columns is not None:
+            return self._shared_column_by_name(column_name, *args, **kwargs)
+
+        return self._resolve_column(column_name, *args, **kwargs)
+
+    def _shared_column_by_name(self, column_name, *args, **kwargs):
+        """
+        column_by_name while parallelCatalogWriter is sharing columns between
+        catalogs: columns calculated by getters are looked up in (and
+        added to) self._shared_columns, along with the columns they read
+        """
+        shared = self._shared_columns
+        stack = self._shared_column_stack
+        identity = shared.column_identity(self, column_name)
+        shareable = identity is not None and len(args) == 0 and len(kwargs) == 0
+
+        if (not shareable or identity[0] not in ('getter', 'compound') or
+            self._current_rows is None):
+
+            value = self._resolve_column(column_name, *args, **kwargs)
+            closure = frozenset([(column_name, identity)]) if shareable else None
+        else:
+            value, closure = shared.lookup(self, column_name, identity, self._current_rows)
+            if closure is not None:
+                if self._column_origins_switch:
+                    self._column_origins[column_name] = self._column_plan.origins[column_name]
+            else:
+                stack.append(set())
+                try:
+                    value = self._resolve_column(column_name)
+                finally:
+                    read_columns = stack.pop()
+
+                # columns that read anything which cannot be shared
+                # are not shared either
+                if None not in read_columns:
+                    read_columns.add((column_name, identity))
+                    closure = frozenset(read_columns)
+                    shared.store(column_name, identity, self._current_rows, value, closure)
+
+        if len(stack) > 0:
+            if closure is None:
+                stack[-1].add(None)
+            else:
+                stack[-1].update(closure)
+        return value
+
+    def _epoch_column_by_name(self, column_name, *args, **kwargs):
+        """
+        column_by_name while write_epoch_catalogs() is running: static columns
+        are read from self._column_cache once they have been evaluated for the
+        chunk, and, until the columns have been classified, every column
+        evaluated is reported to self._epoch_tracker
+        """
+        tracker = self._epoch_tracker
+        if tracker.classified:
+            if column_name in self._column_cache and tracker.is_static(column_name):
+                return self._column_cache[column_name]
+            return self._resolve_column(column_name, *args, **kwargs)
+
+        tracker.enter(column_name)
+        try:
+            return self._resolve_column(column_name, *args, **kwargs)
+        finally:
+            tracker.exit()
+
+    def _profiled_column_by_name(self, column_name, *args, **kwargs):
+        """
+        column_by_name, recording the time spent on column_name
+        (and whether it came out of the column cache) in self._profiler
+        """
+        profiler = self._profiler
+        cache_hit = self._is_cache_hit(column_name)
+        profiler.enter_column()
+        t_start = time.time()
+        try:
+            return self._unprofiled_column_by_name(column_name, *args, **kwargs)
+        finally:
+            profiler.exit_column(column_name, self._column_origin_name(column_name),
+                                 time.time()-t_start, cache_hit)
+
+    def _is_cache_hit(self, column_name):
+        """
+        Return True if column_name is provided by a @cached getter
+        whose result is already in self._column_cache
+        """
+        resolution = self._column_resolution.get(column_name, None)
+        if resolution is None or resolution[0] not in ('getter', 'compound'):
+            return False
+        getter = resolution[1]
+        return (getattr(getattr(self, getter), '_cache_results', False) and
+                getter[4:] in self._column_cache)
+
+    def _column_origin_name(self, column_name):
+        """
+        Return the name of the class that defined column_name
+        (or 'the database' or 'default column')
+        """
+        origin = self._column_plan.origins.get(column_name, None)
+        if origin is not None:
+            return origin.__name__
+        resolution = self._column_resolution.get(column_name, None)
+        if resolution is not None and resolution[0] == 'default':
+            return 'default column'
+        if resolution is None and hasattr(self, 'get_%s' % column_name):
+            return self._get_class_that_defined_method(getattr(self, 'get_%s' % column_name)).__name__
+        return 'the database'
+
+    def _resolve_column(self, column_name, *args, **kwargs):
+        """
+        Return the column data for column_name, dispatching to the getter,
+        compound getter, database column or default column that provides it
+        """
         if (isinstance(self._current_chunk, _MimicRecordArray) and
             column_name not in self._actually_calculated_columns):
 
             self._actually_calculated_columns.append(column_name)
 
+        resolution = self._column_resolution.get(column_name, None)
+        if resolution is None:
+            return self._column_by_name_unplanned(column_name, *args, **kwargs)
+
+        kind, attr_name = resolution
+        if kind == 'getter':
+            if self._column_origins_switch:
+                self._column_origins[column_name] = self._column_plan.origins[column_name]
+
+            return getattr(self, attr_name)(*args, **kwargs)
+        elif kind == 'compound':
+            if self._column_origins_switch:
+                self._column_origins[column_name] = self._column_plan.origins[column_name]
+
+            compound_column = getattr(self, attr_name)(*args, **kwargs)
+            return compound_column[column_name]
+        elif (kind == 'database' or
+              isinstance(self._current_chunk, _MimicRecordArray) or
+              column_name in self._current_chunk.dtype.names):
+
+            if self._column_origins_switch:
+                self._column_origins[column_name] = 'the database'
+
+            return self._current_chunk[column_name]
+        else:
+
+            if self._column_origins_switch:
+                self._column_origins[column_name] = 'default column'
+
+            return getattr(self, attr_name)(*args, **kwargs)
+
+    def _column_by_name_unplanned(self, column_name, *args, **kwargs):
+        """
+        Return the column data for a column name that is not in
+        self._column_plan (i.e. a column that is not provided by this
+        catalog class or by its CatalogDBObject's columnMap).
+        """
         getfunc = "get_%s" % column_name
         if hasattr(self, getfunc):
             function = getattr(self, getfunc)
@@ -366,15 +811,6 @@ class InstanceCatalog(object):
                 self._column_origins[column_name] = self._get_class_that_defined_method(function)
 
             return function(*args, **kwargs)
-        elif column_name in self._compound_column_names:
-            getfunc = self._compound_column_names[column_name]
-            function = getattr(self, getfunc)
-
-            if self._column_origins_switch and column_name:
-                self._column_origins[column_name] = self._get_class_that_defined_method(function)
-
-            compound_column = function(*args, **kwargs)
-            return compound_column[column_name]
         elif (isinstance(self._current_chunk, _MimicRecordArray) or
               column_name in self._current_chunk.dtype.names):
 
@@ -449,7 +885,9 @@ class InstanceCatalog(object):
                           self.endline)
 
     def write_catalog(self, filename, chunk_size=None,
-                      write_header=True, write_mode='w'):
+                      write_header=True, write_mode='w', workers=None,
+                      async_write=False, sample_fraction=None, seed=0,
+                      sort_by=None, max_rows_in_memory=None):
         """
         Write query self.db_obj and write the resulting InstanceCatalog to
         an ASCII output file
@@ -465,18 +903,67 @@ class InstanceCatalog(object):
 
         @param [in] write_mode is 'w' if you want to overwrite the output file or
         'a' if you want to append to an existing output file (default: 'w')
+
+        @param [in] workers is an optional number of worker processes.  If it
+        is greater than 1, the database is still queried by this process, but
+        the filtering, column evaluation and formatting of each chunk is done
+        in a pool of worker processes, each holding a copy of this catalog.
+        Chunks are written in the order in which they were queried.  Getters
+        must not query the database themselves in this mode.  The statistics
+        of the cannot_be_null filters and the values calculated by
+        @persistent_cached getters are handed back by the workers with each
+        chunk (the hit and miss counts of the stores only cover the lookups
+        made by this process).  The workers are forked from this process, so
+        this needs multiprocessing to use its 'fork' start method; a
+        RuntimeError is raised otherwise (default None).
+
+        @param [in] async_write is a boolean.  If True, the catalog is written
+        to disk in large blocks by a background thread (see AsyncFileWriter),
+        so that slow disk writes do not hold up the next chunk (default False).
+
+        @param [in] sample_fraction is an optional fraction of the objects to
+        write, e.g. 0.01 for a quick preview of the catalog.  The objects are
+        selected by a hash of their unique ids, in the database query where
+        possible (see CatalogDBObject.sample_predicate), so the same objects
+        are selected every time (default None, i.e. write every object).
+
+        @param [in] seed is an integer choosing which sample of the objects
+        sample_fraction selects (default 0)
+
+        @param [in] sort_by is the name of an output column.  If it is set, the
+        rows are written in ascending order of that column (as written, i.e.
+        after any transformation), rows with equal values in the order in which
+        they were queried and rows with NaN values last (default None, i.e. the
+        rows are written in the order in which they were queried).  Sorted runs
+        of rows are spilled to temporary files in the directory of filename,
+        and merged into filename once every chunk has been written (see
+        SortedCatalogWriter), so the catalog need not fit in memory.
+
+        @param [in] max_rows_in_memory is the number of rows sorted in memory
+        before they are spilled to disk when sort_by is set (default 1000000)
         """
 
         self._write_pre_process()
 
-        self._query_and_write(filename, chunk_size=chunk_size,
-                              write_header=write_header,
-                              write_mode=write_mode,
-                              obs_metadata=self.obs_metadata,
-                              constraint=self.constraint)
+        try:
+            self._query_and_write(filename, chunk_size=chunk_size,
+                                  write_header=write_header,
+                                  write_mode=write_mode,
+                                  obs_metadata=self.obs_metadata,
+                                  constraint=self.constraint,
+                                  workers=workers,
+                                  async_write=async_write,
+                                  sample_fraction=sample_fraction,
+                                  seed=seed,
+                                  sort_by=sort_by,
+                                  max_rows_in_memory=max_rows_in_memory)
+        finally:
+            self._write_post_process()
 
     def _query_and_write(self, filename, chunk_size=None, write_header=True,
-                         write_mode='w', obs_metadata=None, constraint=None):
+                         write_mode='w', obs_metadata=None, constraint=None,
+                         workers=None, async_write=False, sample_fraction=None,
+                         seed=0, sort_by=None, max_rows_in_memory=None):
         """
         This method queries db_obj, and then writes the resulting recarray
         to the specified ASCII output file.
@@ -497,29 +984,418 @@ class InstanceCatalog(object):
 
         @param [in] write_mode is 'w' if you want to overwrite the output file or
         'a' if you want to append to an existing output file (default: 'w')
+
+        @param [in] workers is an optional number of worker processes
+        in which to evaluate the chunks (see write_catalog)
+
+        @param [in] async_write is a boolean indicating whether to write
+        the file on a background thread (see write_catalog)
+
+        @param [in] sample_fraction and seed select a sample of the
+        objects to write (see write_catalog)
+
+        @param [in] sort_by and max_rows_in_memory optionally sort
+        the rows by an output column (see write_catalog)
         """
 
-        file_handle = open(filename, write_mode)
-        if write_header:
-            self.write_header(file_handle)
+        if sort_by is not None:
+            self._check_sort_column(sort_by)
+
+        with open_catalog_file(filename, write_mode, async_write=async_write) as file_handle:
+            if write_header:
+                self.write_header(file_handle)
+
+            if sort_by is None:
+                self._write_query_results(file_handle, chunk_size=chunk_size,
+                                          obs_metadata=obs_metadata,
+                                          constraint=constraint,
+                                          workers=workers,
+                                          sample_fraction=sample_fraction,
+                                          seed=seed)
+                return
+
+            self._sort_column = sort_by
+            try:
+                with SortedCatalogWriter(file_handle, max_rows_in_memory=max_rows_in_memory,
+                                         scratch_dir=os.path.dirname(os.path.abspath(filename)),
+                                         endline=self.endline) as sorted_handle:
+
+                    self._write_query_results(sorted_handle, chunk_size=chunk_size,
+                                              obs_metadata=obs_metadata,
+                                              constraint=constraint,
+                                              workers=workers,
+                                              sample_fraction=sample_fraction,
+                                              seed=seed)
+            finally:
+                self._sort_column = None
+
+    def _check_sort_column(self, column_name):
+        """
+        Raise a RuntimeError if the catalog cannot be sorted by column_name
+        (it must be one of the output columns)
+        """
+        if column_name not in self.iter_column_names():
+            raise RuntimeError("Cannot sort %s by %s; it is not one of its output columns"
+                               % (self.__class__.__name__, column_name))
+
+    def write_epoch_catalogs(self, filename_list, obs_metadata_list, chunk_size=None,
+                             write_header=True, write_mode='w'):
+        """
+        Write this catalog once for each of a list of ObservationMetaData that
+        differ only in time (e.g. many visits to the same field), querying the
+        database only once.
+
+        Getter columns are sorted into time-dependent columns (declared with the
+        @time_dependent decorator, found to read self.obs_metadata.mjd, or
+        depending on another time-dependent column) and static columns.  Static
+        columns are evaluated once per chunk and reused for every epoch; only
+        the time-dependent columns are evaluated for each epoch.  The columns are
+        sorted while the first epoch that writes any rows is evaluated (until
+        then, every column is evaluated for every epoch), so a getter must read
+        the mjd every time it depends on it (not only on some branches) to be
+        detected.
+
+        @param [in] filename_list is a list of the names of the ASCII files
+        to be written, one for each element of obs_metadata_list
+
+        @param [in] obs_metadata_list is a list of ObservationMetaData.  They
+        must all have the same bounds, since the database is queried with
+        the first of them.
+
+        @param [in] chunk_size is an optional parameter telling the InstanceCatalog
+        to query the database in manageable chunks (in case returning the whole catalog
+        takes too much memory)
+
+        @param [in] write_header a boolean specifying whether or not to add a header
+        to the output catalogs (default True)
+
+        @param [in] write_mode is 'w' if you want to overwrite the output files or
+        'a' if you want to append to existing output files (default: 'w')
+
+        Returns a dict listing the 'static' and the 'time_dependent' columns
+        """
+        if len(filename_list) != len(obs_metadata_list):
+            raise RuntimeError("write_epoch_catalogs needs one file name per ObservationMetaData; "
+                               "you gave %d file names and %d ObservationMetaData"
+                               % (len(filename_list), len(obs_metadata_list)))
+
+        if len(obs_metadata_list) == 0:
+            return {'static': [], 'time_dependent': []}
+
+        ref_obs = obs_metadata_list[0]
+        for obs in obs_metadata_list[1:]:
+            if ((obs is None) != (ref_obs is None) or
+                (obs is not None and not obs.bounds == ref_obs.bounds)):
+
+                raise RuntimeError("The ObservationMetaData passed to write_epoch_catalogs "
+                                   "must all have the same bounds")
+
+        saved_obs_metadata = self.obs_metadata
+        self._write_pre_process()
+        tracker = _EpochTracker(self._declared_time_dependent_columns())
+        self._epoch_tracker = tracker
+
+        # each epoch is evaluated with its own copy of its ObservationMetaData,
+        # as a catalog instantiated with it would be
+        epoch_obs_list = [copy.deepcopy(obs) for obs in obs_metadata_list]
+
+        # each epoch's file is opened once and kept open for the whole run
+        file_handles = []
+        try:
+            for filename in filename_list:
+                file_handle = open_catalog_file(filename, write_mode)
+                file_handles.append(file_handle)
+                if write_header:
+                    self.write_header(file_handle)
+
+            constraint = self.db_obj.combine_constraints(self.constraint, self._null_predicates())
+
+            query_result = self.db_obj.query_columns(colnames=self._active_columns,
+                                                     obs_metadata=ref_obs,
+                                                     constraint=constraint,
+                                                     chunk_size=chunk_size)
+
+            for chunk in query_result:
+                chunk, final_dexes, getter_filters = self._apply_database_filters(chunk)
+                if len(chunk) == 0:
+                    continue
+
+                static_cache = None
+                for file_handle, obs in zip(file_handles, epoch_obs_list):
+                    if not tracker.classified:
+                        self.obs_metadata = tracker.watch(obs)
+                        self._set_current_chunk(chunk)
+                        self._apply_getter_filters(getter_filters, final_dexes)
+                    else:
+                        self.obs_metadata = obs
+                        if static_cache is None:
+                            # apply the static filters and evaluate the static
+                            # columns once for all of the epochs
+                            self._set_current_chunk(chunk)
+                            static_dexes = self._apply_getter_filters(
+                                [col for col in getter_filters if tracker.is_static(col)],
+                                final_dexes)
+                            static_chunk = self._current_chunk
+                            static_cache = self._evaluate_static_columns()
+
+                        self._set_current_chunk(static_chunk, column_cache=dict(static_cache))
+                        self._apply_getter_filters([col for col in getter_filters
+                                                    if not tracker.is_static(col)],
+                                                   static_dexes)
+
+                    self._write_current_chunk(file_handle)
+
+                    # the columns can only be sorted once every getter has
+                    # been evaluated on some rows; if the getter filters left
+                    # none, keep evaluating every column
+                    if not tracker.classified and len(self._current_chunk) > 0:
+                        tracker.classify(self._compound_column_names)
+            while len(file_handles) > 0:
+                file_handles.pop(0).close()
+        finally:
+            for file_handle in file_handles:
+                if hasattr(file_handle, 'abort'):
+                    file_handle.abort()
+                else:
+                    file_handle.close()
+            self._epoch_tracker = None
+            self.obs_metadata = saved_obs_metadata
+            self._write_post_process()
+
+        return {'static': list(tracker.static_columns),
+                'time_dependent': sorted(tracker.time_dependent)}
+
+    def _declared_time_dependent_columns(self):
+        """
+        Return a list of the columns whose getters were declared
+        with the @time_dependent decorator
+        """
+        return [column_name for column_name, (kind, attr_name) in self._column_resolution.items()
+                if kind in ('getter', 'compound') and
+                getattr(getattr(self, attr_name), '_time_dependent', False)]
+
+    def _evaluate_static_columns(self):
+        """
+        Evaluate the static columns (as classified by self._epoch_tracker) for
+        self._current_chunk, storing the ones that are not cached by their
+        getters in self._column_cache.  Returns a copy of self._column_cache.
+        """
+        if len(self._current_chunk) == 0:
+            return dict(self._column_cache)
+
+        for column_name in self._epoch_tracker.static_columns:
+            value = self.column_by_name(column_name)
+            if self._column_resolution.get(column_name, (None, None))[0] == 'getter':
+                self._column_cache[column_name] = value
+        return dict(self._column_cache)
+
+    def _write_query_results(self, file_handle, chunk_size=None, obs_metadata=None,
+                             constraint=None, workers=None, sample_fraction=None,
+                             seed=0):
+        """
+        Query db_obj and write the resulting rows to file_handle
+        (see _query_and_write for the parameters)
+        """
+        constraint = self.db_obj.combine_constraints(constraint, self._null_predicates())
 
         query_result = self.db_obj.query_columns(colnames=self._active_columns,
                                                  obs_metadata=obs_metadata,
                                                  constraint=constraint,
-                                                 chunk_size=chunk_size)
+                                                 chunk_size=chunk_size,
+                                                 **_sample_kwargs(sample_fraction, seed))
 
-        for chunk in query_result:
-            self._write_recarray(chunk, file_handle)
+        if workers is not None and workers > 1:
+            self._write_in_process_pool(query_result, file_handle, workers)
+        else:
+            for chunk in query_result:
+                self._write_recarray(chunk, file_handle)
+
+    def write_sharded_catalog(self, filename, max_rows=None, max_bytes=None,
+                              pixel_size=None, ra_col='raJ2000', dec_col='decJ2000',
+                              chunk_size=None, write_header=True, workers=None,
+                              async_write=False, max_open_shards=64):
+        """
+        Query self.db_obj and write the resulting InstanceCatalog to several
+        ASCII output files (shards), each with its own header, and a manifest
+        describing them (see ShardedCatalogWriter).  If filename is root.ext, the
+        shards are root_0000.ext, root_0001.ext, ... and the manifest is
+        root_manifest.json.
+
+        @param [in] filename is the name from which the shard names are made
+
+        @param [in] max_rows is the maximum number of rows in a shard (optional)
+
+        @param [in] max_bytes is the maximum size of a shard in bytes (optional)
+
+        @param [in] pixel_size is the size of the cells of an RA/Dec grid.  If it is
+        set, rows in different cells of the grid are written to different shards.
+        It is in the units in which ra_col and dec_col are written to the catalog
+        (i.e. after any transformations).  Rows with NaN positions are written
+        to shards of their own.
+
+        @param [in] ra_col and dec_col are the output columns giving the position of
+        each row.  If they are both in the catalog, the manifest records the
+        extent in RA and Dec of each shard.  They must be in the catalog if
+        pixel_size is set (defaults 'raJ2000' and 'decJ2000')
+
+        @param [in] chunk_size, write_header, workers and async_write are as in
+        write_catalog().  With async_write, each shard is written on its own
+        background thread.
+
+        @param [in] max_open_shards is the maximum number of shards kept open
+        at once; others are closed and reopened as needed (default 64)
+
+        Returns the manifest as a dict
+        """
+        column_names = list(self.iter_column_names())
+        if ra_col in column_names and dec_col in column_names:
+            shard_columns = (ra_col, dec_col)
+        elif pixel_size is not None:
+            raise RuntimeError("Cannot shard %s on the sky; %s and %s are not both "
+                               "in its output columns" % (self.__class__.__name__, ra_col, dec_col))
+        else:
+            shard_columns = None
 
-        file_handle.close()
+        header = ''
+        if write_header:
+            header_buffer = StringIO.StringIO()
+            self.write_header(header_buffer)
+            header = header_buffer.getvalue()
+
+        self._write_pre_process()
+        self._shard_columns = shard_columns
+
+        try:
+            with ShardedCatalogWriter(filename, header=header, max_rows=max_rows,
+                                      max_bytes=max_bytes, pixel_size=pixel_size,
+                                      endline=self.endline,
+                                      async_write=async_write,
+                                      max_open_shards=max_open_shards) as file_handle:
+
+                self._write_query_results(file_handle, chunk_size=chunk_size,
+                                          obs_metadata=self.obs_metadata,
+                                          constraint=self.constraint,
+                                          workers=workers)
+        finally:
+            self._shard_columns = None
+            self._write_post_process()
+
+        return file_handle.manifest()
+
+    def _write_in_process_pool(self, query_result, file_handle, workers):
+        """
+        Write the chunks in query_result to file_handle, evaluating them
+        in a CatalogProcessPool with the specified number of workers.
+
+        Chunks are evaluated in this process until the line template has
+        been set by the first non-empty chunk, so that every worker formats
+        its chunks with the same template as a serial write would.
+        """
+        pool = None
+        try:
+            for chunk in query_result:
+                if self._template is None:
+                    self._write_recarray(chunk, file_handle)
+                    continue
+
+                if pool is None:
+                    pool = CatalogProcessPool(self, workers)
+
+                for result in pool.submit(chunk):
+                    self._write_pool_result(result, file_handle)
+
+            if pool is not None:
+                for result in pool.drain():
+                    self._write_pool_result(result, file_handle)
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+
+        if pool is not None:
+            pool.close()
+
+    def _write_pool_result(self, result, file_handle):
+        """
+        Write the (text, chunk statistics, coordinates, sort keys, worker
+        updates) tuple returned by a CatalogProcessPool to file_handle, and
+        merge the worker's updates into this catalog
+        """
+        text, record, coordinates, sort_keys, updates = result
+        self._merge_worker_updates(updates)
+        if coordinates is not None:
+            file_handle.set_coordinates(*coordinates)
+        if sort_keys is not None:
+            file_handle.set_sort_keys(sort_keys)
+        t_start = time.time()
+        file_handle.write(text)
+        if self._profiler is not None and record is not None:
+            record['write_time'] += time.time() - t_start
+            self._profiler.add_chunk(record)
+
+    def _merge_worker_updates(self, updates):
+        """
+        Merge the (filter statistics, persistent store values) updates made
+        by a worker process while it evaluated a chunk (see CatalogProcessPool)
+        into this catalog's filter statistics and the stores of its
+        @persistent_cached getters
+        """
+        filter_updates, store_updates = updates
+        for col_name, source, calls, rows_in, rows_passed, elapsed in filter_updates:
+            self._filter_statistics_entry(col_name, source).merge(calls, rows_in,
+                                                                   rows_passed, elapsed)
+
+        stores = self._persistent_stores()
+        for ix, object_type, ids, values in store_updates:
+            stores[ix].store(ids, values, object_type=object_type)
 
     def _write_pre_process(self):
         """
         This function verifies the catalog's required columns, initializes
         some member variables that are required for the catalog-writing process.
         """
-        db_required_columns, required_columns_with_defaults = self.db_required_columns()
         self._template = None
+        if self.profile:
+            self._profiler = CatalogStatistics(catalog_class=self.__class__.__name__)
+        else:
+            self._profiler = None
+
+    def _write_post_process(self):
+        """
+        This function stops the profiling started by _write_pre_process()
+        and stores the result for run_statistics(), and writes the values
+        added to the stores of @persistent_cached getters to disk
+        """
+        if self._profiler is not None:
+            self._profiler.end_chunk()
+            self._run_statistics = self._profiler
+            self._profiler = None
+
+        for store in self._persistent_stores():
+            store.flush()
+
+    def _persistent_stores(self):
+        """
+        Return a list of the PersistentColumnStores used by the
+        @persistent_cached getters of this catalog (in the order of the
+        names of their getters, so that a worker process lists them in
+        the same order; see CatalogProcessPool)
+        """
+        stores = []
+        for kind, attr_name in sorted(self._column_resolution.values()):
+            if kind == 'getter':
+                store = getattr(getattr(self, attr_name), '_persistent_store', None)
+                if store is not None and store not in stores:
+                    stores.append(store)
+        return stores
+
+    def run_statistics(self):
+        """
+        Return the CatalogStatistics recorded by the most recent
+        write_catalog() run with self.profile = True (None if no such run
+        has been made)
+        """
+        return self._run_statistics
 
     def _update_current_chunk(self, good_dexes):
         """
@@ -538,11 +1414,103 @@ class InstanceCatalog(object):
                     continue
                 elif 'get_'+col_name in self._compound_columns:
                     super_col = self._column_cache[col_name]
-                    new_cache[col_name] = OrderedDict([(key, super_col[key][good_dexes]) for key in super_col])
+                    if getattr(super_col, 'data', None) is not None:
+                        # all of the sub-columns are stored in one array
+                        new_cache[col_name] = super_col.take(good_dexes)
+                    else:
+                        new_cache[col_name] = CompoundColumn([(key, _take_rows(super_col[key], good_dexes))
+                                                              for key in super_col])
                 else:
-                    new_cache[col_name] = self._column_cache[col_name][good_dexes]
+                    new_cache[col_name] = _take_rows(self._column_cache[col_name], good_dexes)
+
+        rows = None if self._current_rows is None else self._current_rows[good_dexes]
+        self._set_current_chunk(self._current_chunk[good_dexes], column_cache=new_cache, rows=rows)
+
+    def _is_getter_column(self, column_name):
+        """
+        Return True if column_name is calculated by a getter (or compound getter)
+        rather than read from the database
+        """
+        resolution = self._column_resolution.get(column_name, None)
+        if resolution is None:
+            return hasattr(self, 'get_%s' % column_name)
+        return resolution[0] in ('getter', 'compound')
+
+    def _split_filter_columns(self, chunk):
+        """
+        Sort the columns in self._cannot_be_null into those that can be checked
+        against the database query results in chunk and those that have to be
+        calculated by the catalog.  Returns two lists of column names.
+        """
+        database_filters = []
+        getter_filters = []
+        for col_name in self._cannot_be_null:
+            in_chunk = col_name in chunk.dtype.names
+            is_getter = self._is_getter_column(col_name)
+            if in_chunk and (self._pre_screen or not is_getter):
+                database_filters.append(col_name)
+            if is_getter or not in_chunk:
+                getter_filters.append(col_name)
+        return database_filters, getter_filters
+
+    def _null_predicates(self):
+        """
+        Return a list of SQL predicates that remove rows that would fail
+        self._cannot_be_null from the database query itself.  Only the
+        cannot_be_null columns that are read straight from the database
+        (the columns that _filter_chunk checks against the query results)
+        are pushed into the query.
+        """
+        if self._cannot_be_null is None:
+            return []
 
-        self._set_current_chunk(self._current_chunk[good_dexes], column_cache=new_cache)
+        columns = [col_name for col_name in self._cannot_be_null
+                   if col_name in self._active_columns and
+                   (self._pre_screen or not self._is_getter_column(col_name))]
+
+        if len(columns) == 0:
+            return []
+
+        return self.db_obj.not_null_predicates(columns)
+
+    def _filter_statistics_entry(self, col_name, source):
+        key = (col_name, source)
+        if key not in self._filter_stats:
+            self._filter_stats[key] = _FilterStatistics(source)
+        return self._filter_stats[key]
+
+    def _order_filter_columns(self, getter_filters):
+        """
+        Return getter_filters sorted in the order in which they should be evaluated.
+        Predicates which have not been measured yet come first (in the order in
+        which they were declared); the rest are sorted by their measured cost per
+        rejected row.
+        """
+        unmeasured = []
+        measured = []
+        for ix, col_name in enumerate(getter_filters):
+            rank = self._filter_statistics_entry(col_name, 'getter').rank()
+            if rank is None:
+                unmeasured.append(col_name)
+            else:
+                measured.append((rank, ix, col_name))
+        measured.sort()
+        return unmeasured + [mm[2] for mm in measured]
+
+    def filter_statistics(self):
+        """
+        Return a dict keyed on the columns in cannot_be_null describing how
+        each predicate has performed while writing this catalog.  Each value is
+        a list of dicts (one for each place the predicate was evaluated: against
+        the 'database' query results or a 'getter' column) containing the number
+        of calls, rows in, rows passed, pass rate and time spent in seconds.
+        """
+        output = OrderedDict()
+        for (col_name, source), stats in self._filter_stats.items():
+            if col_name not in output:
+                output[col_name] = []
+            output[col_name].append(stats.as_dict())
+        return output
 
     def _filter_chunk(self, chunk):
         """
@@ -550,49 +1518,130 @@ class InstanceCatalog(object):
         set by self._cannot_be_null.  Set self._current_chunk to be the rows that pass
         this test.  Return a numpy array of the indices of those rows relative to
         the original chunk.
+
+        Predicates on columns that come straight from the database are evaluated
+        first, against the query results, and combined into a single mask.  The
+        remaining predicates are evaluated one at a time, cheapest and most selective
+        first (as measured on the preceding chunks), each only on the rows that have
+        survived the predicates before it.
+        """
+        if self._profiler is not None:
+            self._profiler.start_chunk(len(chunk))
+            t_start = time.time()
+            final_dexes = self._filter_chunk_unprofiled(chunk)
+            self._profiler.end_filter(len(final_dexes), time.time()-t_start)
+            return final_dexes
+
+        return self._filter_chunk_unprofiled(chunk)
+
+    def _filter_chunk_unprofiled(self, chunk):
+        """
+        The body of _filter_chunk (without the profiling)
+        """
+        chunk, final_dexes, getter_filters = self._apply_database_filters(chunk)
+        self._set_current_chunk(chunk, rows=final_dexes)
+        return self._apply_getter_filters(getter_filters, final_dexes)
+
+    def _apply_database_filters(self, chunk):
+        """
+        Remove the rows of chunk that fail the cannot_be_null predicates which
+        can be checked against the database query results.  Returns the
+        remaining rows, their indices in the original chunk, and the list of
+        the predicates that still have to be checked by
+        _apply_getter_filters.
         """
         final_dexes = np.arange(len(chunk), dtype=int)
 
-        if self._pre_screen and self._cannot_be_null is not None:
-            # go through the database query results and remove all of those
-            # rows that have already run afoul of self._cannot_be_null
-            for col_name in self._cannot_be_null:
-                if col_name in chunk.dtype.names:
-                    str_vec = np.char.lower(chunk[col_name].astype('str'))
-                    good_dexes = np.where(np.logical_and(str_vec != 'none',
-                                          np.logical_and(str_vec != 'nan', str_vec != 'null')))
-                    chunk = chunk[good_dexes]
-                    final_dexes = final_dexes[good_dexes]
+        if self._cannot_be_null is None:
+            return chunk, final_dexes, []
 
-        self._set_current_chunk(chunk)
+        database_filters, getter_filters = self._split_filter_columns(chunk)
 
-        # If some columns are specified as cannot_be_null, loop over those columns,
-        # removing rows that run afoul of that criterion from the chunk.
-        if self._cannot_be_null is not None:
-            for filter_col in self._cannot_be_null:
-                filter_vals = np.char.lower(self.column_by_name(filter_col).astype('str'))
+        # go through the database query results and remove all of those
+        # rows that have already run afoul of self._cannot_be_null
+        keep = None
+        for col_name in database_filters:
+            t_start = time.time()
+            null = _null_mask(chunk[col_name])
+            if null is None:
+                n_passed = len(chunk)
+            else:
+                n_passed = len(chunk) - np.count_nonzero(null)
+                if keep is None:
+                    keep = np.logical_not(null)
+                else:
+                    keep = np.logical_and(keep, np.logical_not(null), out=keep)
+            self._filter_statistics_entry(col_name, 'database').record(len(chunk), n_passed,
+                                                                        time.time()-t_start)
 
-                good_dexes = np.where(np.logical_and(filter_vals != 'none',
-                                      np.logical_and(filter_vals  != 'nan', filter_vals != 'null')))
+        if keep is not None and not keep.all():
+            good_dexes = np.where(keep)[0]
+            chunk = chunk[good_dexes]
+            final_dexes = final_dexes[good_dexes]
 
-                final_dexes = final_dexes[good_dexes]
+        return chunk, final_dexes, getter_filters
 
-                if len(good_dexes[0]) < len(chunk):
-                    self._update_current_chunk(good_dexes)
+    def _apply_getter_filters(self, getter_filters, final_dexes):
+        """
+        Remove the rows of self._current_chunk that fail the cannot_be_null
+        predicates in getter_filters.  final_dexes are the indices of the rows
+        of self._current_chunk in the original chunk; returns the indices of
+        the rows that pass.
+        """
+        # evaluate the predicates that require calculated columns, removing the
+        # rows that run afoul of each before the next one is calculated
+        for col_name in self._order_filter_columns(getter_filters):
+            n_in = len(self._current_chunk)
+            if n_in == 0:
+                break
+
+            t_start = time.time()
+            null = _null_mask(self.column_by_name(col_name))
+            elapsed = time.time() - t_start
+            stats = self._filter_statistics_entry(col_name, 'getter')
+
+            if null is None or not null.any():
+                stats.record(n_in, n_in, elapsed)
+                continue
+
+            good_dexes = np.where(np.logical_not(null))[0]
+            stats.record(n_in, len(good_dexes), elapsed)
+            final_dexes = final_dexes[good_dexes]
+            self._update_current_chunk(good_dexes)
 
         return final_dexes
 
-    def _write_current_chunk(self, file_handle):
+    def _current_chunk_columns(self):
         """
-        write self._current_chunk to the file specified by file_handle
+        Return a list of the (transformed) output columns of
+        self._current_chunk, in the order of self.iter_column_names()
+        """
+        column_names = tuple(self.iter_column_names())
+        transforms = self._column_plan.output_transforms(column_names, self.transformations)
+        return [self.column_by_name(col) if transform is None else
+                self._transformed_column(col, transform)
+                for col, transform in zip(column_names, transforms)]
+
+    def _transformed_column(self, column_name, transform):
+        """
+        Return transform(column_by_name(column_name)), calculating it only once
+        per chunk however many times it is needed (e.g. by an output column
+        listed twice, or by the coordinates of a sharded catalog).  The
+        transformation is not applied in place, since column_by_name may
+        return a view of the query results or of a column other getters use.
+        """
+        if column_name not in self._transformed_cache:
+            self._transformed_cache[column_name] = transform(self.column_by_name(column_name))
+        return self._transformed_cache[column_name]
+
+    def _current_chunk_lines(self):
+        """
+        Return an iterator over the formatted lines of self._current_chunk
         """
         if len(self._current_chunk) is 0:
-            return
+            return iter(())
 
-        chunk_cols = [self.transformations[col](self.column_by_name(col))
-                      if col in self.transformations.keys() else
-                      self.column_by_name(col)
-                      for col in self.iter_column_names()]
+        chunk_cols = self._current_chunk_columns()
 
         # Create the template with the first chunk
         if self._template is None:
@@ -600,7 +1649,59 @@ class InstanceCatalog(object):
 
         # use a generator expression for lines rather than a list
         # for memory efficiency
-        file_handle.writelines(self._template % line for line in zip(*chunk_cols))
+        return (self._template % line for line in zip(*chunk_cols))
+
+    def _current_chunk_coordinates(self):
+        """
+        Return the (transformed) values of the (RA, Dec) columns in
+        self._shard_columns for self._current_chunk, or None if the catalog
+        is not being written to a sharded catalog with coordinates
+        """
+        if self._shard_columns is None or len(self._current_chunk) == 0:
+            return None
+        transforms = self._column_plan.output_transforms(self._shard_columns, self.transformations)
+        return tuple(self.column_by_name(col) if transform is None else
+                     self._transformed_column(col, transform)
+                     for col, transform in zip(self._shard_columns, transforms))
+
+    def _current_chunk_sort_keys(self):
+        """
+        Return the (transformed) values of the column self._sort_column for
+        self._current_chunk, or None if the catalog is not being written
+        to a SortedCatalogWriter
+        """
+        if self._sort_column is None or len(self._current_chunk) == 0:
+            return None
+        transform = self._column_plan.output_transforms((self._sort_column,), self.transformations)[0]
+        if transform is None:
+            return self.column_by_name(self._sort_column)
+        return self._transformed_column(self._sort_column, transform)
+
+    def _write_current_chunk(self, file_handle):
+        """
+        write self._current_chunk to the file specified by file_handle
+        """
+        coordinates = self._current_chunk_coordinates()
+        if coordinates is not None:
+            file_handle.set_coordinates(*coordinates)
+
+        sort_keys = self._current_chunk_sort_keys()
+        if sort_keys is not None:
+            file_handle.set_sort_keys(sort_keys)
+
+        if self._profiler is None:
+            file_handle.writelines(self._current_chunk_lines())
+            return
+
+        profiler = self._profiler
+        column_time = profiler.column_time
+        t_start = time.time()
+        lines = list(self._current_chunk_lines())
+        t_format = time.time()
+        file_handle.writelines(lines)
+        profiler.add_time('format', t_format - t_start - (profiler.column_time - column_time))
+        profiler.add_time('write', time.time() - t_format)
+        profiler.end_chunk()
 
     def _write_recarray(self, chunk, file_handle):
         """
@@ -609,7 +1710,8 @@ class InstanceCatalog(object):
         of columns that needs to happen before they are written to the catalog.
 
         @param [in] chunk is the recarray of queried columns to be formatted
-        and written to the catalog.
+        and written to the catalog (or an object with the same chunk
+        protocol, such as a RoutedChunk).
 
         @param [in] file_handle is a file handle pointing to the file where
         the catalog is being written.
@@ -617,37 +1719,83 @@ class InstanceCatalog(object):
         self._filter_chunk(chunk)
         self._write_current_chunk(file_handle)
 
-    def iter_catalog(self, chunk_size=None):
-        self.db_required_columns()
+    def iter_catalog(self, chunk_size=None, sample_fraction=None, seed=0):
+        """
+        Iterate over the rows of the catalog
 
+        @param [in] chunk_size is an optional number of rows to query from the
+        database at a time
+
+        @param [in] sample_fraction and seed optionally select a sample
+        of the objects (see write_catalog)
+        """
         query_result = self.db_obj.query_columns(colnames=self._active_columns,
                                                  obs_metadata=self.obs_metadata,
                                                  constraint=self.constraint,
-                                                 chunk_size=chunk_size)
+                                                 chunk_size=chunk_size,
+                                                 **_sample_kwargs(sample_fraction, seed))
         for chunk in query_result:
             self._set_current_chunk(chunk)
-            chunk_cols = [self.transformations[col](self.column_by_name(col))
-                          if col in self.transformations.keys() else
-                          self.column_by_name(col)
-                          for col in self.iter_column_names()]
+            chunk_cols = self._current_chunk_columns()
             for line in zip(*chunk_cols):
                 yield line
 
     def iter_catalog_chunks(self, chunk_size=None):
-        self.db_required_columns()
-
         query_result = self.db_obj.query_columns(colnames=self._active_columns,
                                                  obs_metadata=self.obs_metadata,
                                                  constraint=self.constraint,
                                                  chunk_size=chunk_size)
+
+        chunkColMap = dict([(col, i) for i, col in enumerate(self.iter_column_names())])
         for chunk in query_result:
             self._set_current_chunk(chunk)
-            chunk_cols = [self.transformations[col](self.column_by_name(col))
-                          if col in self.transformations.keys() else
-                          self.column_by_name(col)
-                          for col in self.iter_column_names()]
-            chunkColMap = dict([(col, i) for i, col in enumerate(self.iter_column_names())])
-            yield chunk_cols, chunkColMap
+            chunk_cols = self._current_chunk_columns()
+            yield chunk_cols, dict(chunkColMap)
+
+    def iter_catalog_columns(self, chunk_size=None, structured=False):
+        """
+        Iterate over the catalog one chunk at a time, yielding the output
+        columns of each chunk as numpy arrays, rather than as rows.
+
+        Unlike iter_catalog() and iter_catalog_chunks(), the rows of each
+        chunk are filtered on cannot_be_null exactly as they are by write_catalog().
+        Transformations are applied.
+
+        @param [in] chunk_size is an optional number of rows to query from the
+        database at a time
+
+        @param [in] structured is a boolean.  If False (the default), each chunk
+        is yielded as an OrderedDict keyed on the names from iter_column_names(),
+        whose values are read-only views of the arrays returned by the getters
+        (no data is copied).  If True, each chunk is copied into a single
+        numpy structured array with those field names.
+        """
+        constraint = self.db_obj.combine_constraints(self.constraint, self._null_predicates())
+
+        query_result = self.db_obj.query_columns(colnames=self._active_columns,
+                                                 obs_metadata=self.obs_metadata,
+                                                 constraint=constraint,
+                                                 chunk_size=chunk_size)
+
+        column_names = list(self.iter_column_names())
+        for chunk in query_result:
+            self._filter_chunk(chunk)
+            chunk_cols = [np.asarray(col) for col in self._current_chunk_columns()]
+
+            if structured:
+                output = np.empty(len(self._current_chunk),
+                                  dtype=np.dtype([(name, col.dtype)
+                                                  for name, col in zip(column_names, chunk_cols)]))
+                for name, col in zip(column_names, chunk_cols):
+                    output[name] = col
+            else:
+                output = OrderedDict()
+                for name, col in zip(column_names, chunk_cols):
+                    view = col.view()
+                    view.flags['WRITEABLE'] = False
+                    output[name] = view
+
+            yield output
 
     def get_objId(self):
         return self.column_by_name(self.refIdCol)
@@ -1,11 +1,22 @@
+import os
 import copy
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from .AsyncFileWriter import open_catalog_file
+from .CompoundInstanceCatalog import CompoundInstanceCatalog
+from .CompoundInstanceCatalog import _CompoundChunkSplitter, _shared_null_predicates
+from .SharedColumnCache import SharedColumnCache
+from .SortedCatalogWriter import SortedCatalogWriter
 
 
 __all__ = ["parallelCatalogWriter"]
 
 
 def parallelCatalogWriter(catalog_dict, chunk_size=None, constraint=None,
-                          write_mode='w', write_header=True):
+                          write_mode='w', write_header=True, async_write=False,
+                          threads=None, share_columns=False, sort_by=None,
+                          max_rows_in_memory=None):
     """
     This method will take several InstanceCatalog classes that are meant
     to be based on the same CatalogDBObject and write them out in parallel
@@ -18,10 +29,25 @@ def parallelCatalogWriter(catalog_dict, chunk_size=None, constraint=None,
     catalog_dict is a dict keyed on the names of the files to be written.
     The values are the InstanceCatalogs to be written.  These are full
     instantiations of InstanceCatalogs, not just InstanceCatalog classes
-    as with the CompoundInstanceCatalog.  They cannot be CompoundInstanceCatalogs
+    as with the CompoundInstanceCatalog.
+
+    The values can instead all be CompoundInstanceCatalogs (e.g. a compound
+    PhoSim catalog of stars and galaxies and the matching compound truth
+    catalog).  The InstanceCatalogs inside all of the CompoundInstanceCatalogs
+    are grouped by the table they query (as in CompoundInstanceCatalog), and
+    each table is queried once (through a CompoundCatalogDBObject if the
+    InstanceCatalogs use different CatalogDBObject classes), so that the
+    database is queried as it would be to write one of the
+    CompoundInstanceCatalogs.  Each chunk of the query results is written
+    to every file that reads the table.  The rows of each file are written
+    table by table, in the order in which the tables first appear in the
+    CompoundInstanceCatalogs (which need not be the order in which
+    CompoundInstanceCatalog.write_catalog would write them).
 
     constraint is an optional SQL constraint to be applied to the database query.
-    Note: constraints applied to individual catalogs will be ignored.
+    Note: constraints applied to individual catalogs will be ignored (if
+    constraint is None, the constraint of the first CompoundInstanceCatalog
+    is applied to all of them).
 
     chunk_size is an int which optionally specifies the number of rows to be
     returned from db_obj at a time
@@ -32,13 +58,174 @@ def parallelCatalogWriter(catalog_dict, chunk_size=None, constraint=None,
     write_header is a boolean that controls whether or not to write the header
     in the catalogs.
 
+    async_write is a boolean.  If True, each catalog is written to disk in
+    large blocks by a background thread (see AsyncFileWriter), so that slow
+    disk writes do not hold up the next chunk (default False).
+
+    threads is an optional number of threads.  If it is greater than 1, the
+    catalogs are filtered and formatted concurrently on a pool of that many
+    threads (each catalog is handled by one thread at a time, and the lines
+    are written to the files in the same order as without threads).
+
+    share_columns is either a boolean or a SharedColumnCache.  If it is not
+    False, a column calculated for one catalog is given to every other catalog
+    that provides it with the same getter, reading columns which are provided
+    by the same getters (or database columns), rather than being calculated
+    again for each catalog (see SharedColumnCache for the details).  This
+    requires the getters to depend only on the columns they read and the
+    ObservationMetaData.  Pass a SharedColumnCache to read its statistics()
+    after the run (default False).
+
+    sort_by is the name of an output column of every catalog.  If it is set,
+    the rows of each file are written in ascending order of that column
+    through a SortedCatalogWriter (see InstanceCatalog.write_catalog), spilling
+    at most max_rows_in_memory sorted rows per file to disk at a time
+    (default 1000000).  The 'write_time' of each file then includes the
+    merging of its sorted runs.
+
+    Each file is opened once and kept open for the whole run.
+
     Output
     ------
-    This method does not return anything, it just writes the files that are the
-    keys of catalog_dict
+    An OrderedDict keyed on the names of the files written.  Each value is an
+    OrderedDict giving the number of chunks and rows written to that file, the
+    time in seconds spent filtering and formatting the catalog ('process_time')
+    and the time spent writing it ('write_time').  If share_columns is set,
+    it also gives the numbers of columns the catalog found already calculated
+    ('shared_column_hits') and calculated itself ('shared_column_misses').
+    (parallelCatalogWriter used to return None; callers that ignore the
+    output are unaffected.)
     """
 
     list_of_file_names = catalog_dict.keys()
+
+    is_compound = [isinstance(catalog_dict[file_name], CompoundInstanceCatalog)
+                   for file_name in list_of_file_names]
+
+    if True in is_compound:
+        if False in is_compound:
+            raise RuntimeError('parallelCatalogWriter cannot write InstanceCatalogs and '
+                               'CompoundInstanceCatalogs together.  Either all or none of '
+                               'the catalogs must be CompoundInstanceCatalogs.')
+
+        obs_metadata, header_catalogs, query_groups = _plan_compound_queries(catalog_dict,
+                                                                             list_of_file_names,
+                                                                             constraint)
+    else:
+        obs_metadata, header_catalogs, query_groups = _plan_catalog_query(catalog_dict,
+                                                                          list_of_file_names,
+                                                                          constraint)
+
+    timing = OrderedDict([(file_name, OrderedDict([('chunks', 0), ('rows', 0),
+                                                   ('process_time', 0.0),
+                                                   ('write_time', 0.0)]))
+                          for file_name in list_of_file_names])
+
+    members = [member for query_group in query_groups for member in query_group.members]
+
+    pool = None
+    if threads is not None and threads > 1:
+        pool = ThreadPool(threads)
+
+    shared_columns = None
+    if share_columns is True:
+        shared_columns = SharedColumnCache()
+    elif share_columns is not False and share_columns is not None:
+        shared_columns = share_columns
+
+    for file_name, cat in members:
+        cat._shared_columns = shared_columns
+        cat._sort_column = sort_by
+
+    file_handles = OrderedDict()
+    sorted_handles = OrderedDict()
+    try:
+        if sort_by is not None:
+            for file_name, cat in members:
+                cat._check_sort_column(sort_by)
+
+        for file_name in list_of_file_names:
+            file_handles[file_name] = open_catalog_file(file_name, write_mode,
+                                                        async_write=async_write)
+            if write_header:
+                header_catalogs[file_name].write_header(file_handles[file_name])
+            if sort_by is not None:
+                scratch_dir = os.path.dirname(os.path.abspath(file_name))
+                sorted_handles[file_name] = SortedCatalogWriter(file_handles[file_name],
+                                                                max_rows_in_memory=max_rows_in_memory,
+                                                                scratch_dir=scratch_dir,
+                                                                endline=header_catalogs[file_name].endline)
+
+        for query_group in query_groups:
+            query_result = query_group.query(obs_metadata, chunk_size)
+
+            for master_chunk in query_result:
+                if shared_columns is not None:
+                    shared_columns.new_chunk()
+
+                tasks = zip([cat for file_name, cat in query_group.members],
+                            query_group.split(master_chunk))
+                if pool is None:
+                    results = [_process_catalog_chunk(task) for task in tasks]
+                else:
+                    results = pool.map(_process_catalog_chunk, tasks)
+
+                for (file_name, cat), (chunk_buffer, process_time) in zip(query_group.members, results):
+                    t_start = time.time()
+                    chunk_buffer.replay(sorted_handles.get(file_name, file_handles[file_name]))
+                    file_timing = timing[file_name]
+                    file_timing['write_time'] += time.time() - t_start
+                    file_timing['process_time'] += process_time
+                    file_timing['rows'] += len(chunk_buffer.lines)
+
+                for file_name in query_group.file_names:
+                    timing[file_name]['chunks'] += 1
+
+        for file_name in list_of_file_names:
+            t_start = time.time()
+            if file_name in sorted_handles:
+                sorted_handles.pop(file_name).close()
+            file_handles.pop(file_name).close()
+            timing[file_name]['write_time'] += time.time() - t_start
+    except:
+        for sorted_handle in sorted_handles.values():
+            sorted_handle.abort()
+        for file_handle in file_handles.values():
+            if hasattr(file_handle, 'abort'):
+                file_handle.abort()
+            else:
+                file_handle.close()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for file_name, cat in members:
+            cat._shared_columns = None
+            cat._shared_column_source = None
+            cat._sort_column = None
+            cat._write_post_process()
+
+    if shared_columns is not None:
+        for file_name in list_of_file_names:
+            timing[file_name]['shared_column_hits'] = 0
+            timing[file_name]['shared_column_misses'] = 0
+        for file_name, cat in members:
+            stats = shared_columns.catalog_statistics(cat)
+            timing[file_name]['shared_column_hits'] += stats['hits']
+            timing[file_name]['shared_column_misses'] += stats['misses']
+
+    return timing
+
+
+def _plan_catalog_query(catalog_dict, list_of_file_names, constraint):
+    """
+    Verify that the InstanceCatalogs in catalog_dict can be written from
+    one query, pre-process them and plan the query.
+
+    Returns the ObservationMetaData, a dict of the catalog whose header is
+    written to each file, and a list containing the one _QueryGroup
+    """
     ref_cat = catalog_dict[list_of_file_names[0]]
     for ix, file_name in enumerate(list_of_file_names):
         if ix>0:
@@ -69,37 +256,189 @@ def parallelCatalogWriter(catalog_dict, chunk_size=None, constraint=None,
         cat = catalog_dict[file_name]
         cat._write_pre_process()
 
-    active_columns = None
-    for file_name in catalog_dict:
-        cat = catalog_dict[file_name]
-        if active_columns is None:
-            active_columns = copy.deepcopy(cat._active_columns)
+    members = [(file_name, catalog_dict[file_name]) for file_name in list_of_file_names]
+    query_group = _QueryGroup(ref_cat.db_obj, constraint, members)
+
+    return ref_cat.obs_metadata, catalog_dict, [query_group]
+
+
+def _plan_compound_queries(catalog_dict, list_of_file_names, constraint):
+    """
+    Verify that the CompoundInstanceCatalogs in catalog_dict can be written
+    together, instantiate and pre-process the InstanceCatalogs inside them,
+    and plan one query for each table they read.
+
+    Returns the ObservationMetaData, a dict of the catalog whose header is
+    written to each file, and a list of _QueryGroups (one per table)
+    """
+    ref_compound = catalog_dict[list_of_file_names[0]]
+    for file_name in list_of_file_names[1:]:
+        compound_cat = catalog_dict[file_name]
+        if not compound_cat._obs_metadata == ref_compound._obs_metadata:
+            print compound_cat._obs_metadata
+            print ref_compound._obs_metadata
+            raise RuntimeError('Catalogs passed to parallelCatalogWriter have different '
+                               'ObservationMetaData.  I do not know how to deal with that.')
+
+    if constraint is None:
+        constraint = ref_compound._constraint
+
+    # group the InstanceCatalogs of all of the CompoundInstanceCatalogs
+    # by the table they query
+    header_catalogs = {}
+    table_groups = []
+    for file_name in list_of_file_names:
+        compound_cat = catalog_dict[file_name]
+        ic_list = compound_cat._instantiate_catalogs()
+        header_catalogs[file_name] = ic_list[compound_cat._header_catalog_index()]
+
+        for cat, dboClass in zip(ic_list, compound_cat._dbo_list):
+            member = (file_name, cat, dboClass, compound_cat)
+            for group in table_groups:
+                if ref_compound.areDBObjectsTheSame(dboClass, group[0][2]):
+                    group.append(member)
+                    break
+            else:
+                table_groups.append([member])
+
+    query_groups = []
+    for group in table_groups:
+        members = [(file_name, cat) for file_name, cat, dboClass, compound_cat in group]
+        catList = [cat for file_name, cat in members]
+
+        dbObjClassList = []
+        for file_name, cat, dboClass, compound_cat in group:
+            if dboClass not in dbObjClassList:
+                dbObjClassList.append(dboClass)
+
+        if len(dbObjClassList) == 1:
+            query_groups.append(_QueryGroup(catList[0].db_obj, constraint, members))
+            continue
+
+        # the CompoundCatalogDBObject class is chosen by the
+        # first CompoundInstanceCatalog that reads the table
+        compound_dbo = group[0][3]._make_compound_dbo(dbObjClassList,
+                                                      connection=catList[0].db_obj.connection)
+
+        # as in CompoundInstanceCatalog, every InstanceCatalog read through a
+        # CompoundCatalogDBObject checks its cannot_be_null columns against the
+        # query results, even one that is alone in its CompoundInstanceCatalog
+        dbObjNameList = [dboClass.objid for file_name, cat, dboClass, compound_cat in group]
+        for cat, name in zip(catList, dbObjNameList):
+            cat._shared_column_source = name
+            cat._pre_screen = True
+
+        query_groups.append(_QueryGroup(compound_dbo, constraint, members,
+                                        splitter=_CompoundChunkSplitter(dbObjNameList, catList)))
+
+    return ref_compound._obs_metadata, header_catalogs, query_groups
+
+
+class _QueryGroup(object):
+    """
+    A database query whose chunks of results are written by
+    several catalogs (possibly to the same file)
+    """
+
+    def __init__(self, db_obj, constraint, members, splitter=None):
+        """
+        db_obj is the CatalogDBObject (or CompoundCatalogDBObject) to query
+
+        constraint is the SQL constraint applied to the query
+
+        members is a list of (file_name, InstanceCatalog) tuples
+
+        splitter is an optional _CompoundChunkSplitter that splits the chunks
+        of results of a CompoundCatalogDBObject into the columns read by
+        each catalog.  If it is None, each catalog reads the whole chunk.
+        """
+        self.db_obj = db_obj
+        self.members = members
+        self.splitter = splitter
+
+        self.file_names = []
+        for file_name, cat in members:
+            if file_name not in self.file_names:
+                self.file_names.append(file_name)
+
+        catList = [cat for file_name, cat in members]
+
+        if splitter is None:
+            self.colnames = copy.deepcopy(catList[0]._active_columns)
+            for cat in catList[1:]:
+                for col_name in cat._active_columns:
+                    if col_name not in self.colnames:
+                        self.colnames.append(col_name)
         else:
-            for col_name in cat._active_columns:
-                if col_name not in active_columns:
-                    active_columns.append(col_name)
-
-    query_result = ref_cat.db_obj.query_columns(colnames=active_columns,
-                                                obs_metadata=ref_cat.obs_metadata,
-                                                constraint=constraint,
-                                                chunk_size=chunk_size)
-    local_write_mode = write_mode
-    if write_header:
-        for file_name in catalog_dict:
-            with open(file_name, local_write_mode) as file_handle:
-                catalog_dict[file_name].write_header(file_handle)
-        local_write_mode = 'a'
-
-    for master_chunk in query_result:
-
-        for i_file, file_name in enumerate(list_of_file_names):
-            chunk = master_chunk
-            cat = catalog_dict[file_name]
-            good_dexes = cat._filter_chunk(chunk)
-            if len(good_dexes) < len(chunk):
-                chunk = chunk[good_dexes]
+            self.colnames = splitter.colnames
+
+        # push the cannot_be_null predicates that every catalog shares
+        # into the database query
+        shared_predicates = _shared_null_predicates(catList)
+        if splitter is not None and db_obj._has_custom_final_pass():
+            shared_predicates = []
+
+        self.constraint = db_obj.combine_constraints(constraint, shared_predicates)
+
+    def query(self, obs_metadata, chunk_size):
+        return self.db_obj.query_columns(colnames=self.colnames,
+                                         obs_metadata=obs_metadata,
+                                         constraint=self.constraint,
+                                         chunk_size=chunk_size)
+
+    def split(self, chunk):
+        """
+        Return a list of the chunks read by each of self.members
+        """
+        if self.splitter is None:
+            return [chunk]*len(self.members)
+        return self.splitter.split(chunk)
+
+
+class _ChunkBuffer(object):
+    """
+    A stand-in for a file handle which keeps the lines (and coordinates and
+    sort keys) one catalog writes for one chunk, so that a chunk can be
+    formatted on one thread and written to the real file on another
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.coordinates = None
+        self.sort_keys = None
+
+    def set_coordinates(self, ra, dec):
+        self.coordinates = (ra, dec)
+
+    def set_sort_keys(self, keys):
+        self.sort_keys = keys
+
+    def write(self, text):
+        self.lines.append(text)
 
-            with open(file_name, local_write_mode) as file_handle:
-                catalog_dict[file_name]._write_current_chunk(file_handle)
+    def writelines(self, lines):
+        self.lines.extend(lines)
 
-        local_write_mode = 'a'
+    def replay(self, file_handle):
+        """
+        Write the buffered lines to file_handle
+        """
+        if self.coordinates is not None:
+            file_handle.set_coordinates(*self.coordinates)
+        if self.sort_keys is not None:
+            file_handle.set_sort_keys(self.sort_keys)
+        file_handle.writelines(self.lines)
+
+
+def _process_catalog_chunk(task):
+    """
+    Filter and format one chunk of one catalog.  task is a tuple containing
+    the catalog and the chunk.  Returns a _ChunkBuffer containing the formatted
+    lines and the time taken.
+    """
+    cat, master_chunk = task
+    t_start = time.time()
+    chunk_buffer = _ChunkBuffer()
+    cat._filter_chunk(master_chunk)
+    cat._write_current_chunk(chunk_buffer)
+    return chunk_buffer, time.time() - t_start
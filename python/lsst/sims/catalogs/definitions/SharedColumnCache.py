@@ -0,0 +1,164 @@
+"""
+Sharing the columns calculated for one chunk of query results between the
+catalogs written from it by parallelCatalogWriter
+"""
+import threading
+import numpy as np
+from collections import OrderedDict
+from .InstanceCatalog import _take_rows
+
+__all__ = ["SharedColumnCache"]
+
+
+class SharedColumnCache(object):
+    """
+    A cache of the columns calculated by several InstanceCatalogs that are
+    being written from the same chunks of query results (see the share_columns
+    argument of parallelCatalogWriter).
+
+    Each column a catalog calculates is stored with the rows of the chunk it
+    was calculated for and its closure: the set of columns that were read
+    while it was being calculated (directly or through other getters), each
+    identified by the method (or database column) that provides it.  When
+    another catalog asks for the same column, resolved to the same method,
+    the stored values are given to it if every column in the closure is
+    resolved to the same method in that catalog too, and the rows it needs
+    are a subset of the stored rows (so columns can be shared after the
+    catalogs' cannot_be_null filters have removed different rows).
+
+    This assumes that a getter's values depend only on the columns it reads,
+    row by row, and on the ObservationMetaData (which parallelCatalogWriter
+    requires to be the same for every catalog), not on other attributes of
+    the catalog.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._catalog_statistics = {}
+        self._entries = {}
+        self._closure_matches = {}
+        # the (catalog, column, identity) lookups already counted in this chunk
+        self._recorded = set()
+        self._lock = threading.Lock()
+
+    def new_chunk(self):
+        """
+        Forget the columns of the previous chunk
+        """
+        with self._lock:
+            self._entries = {}
+            self._recorded = set()
+
+    @staticmethod
+    def column_identity(catalog, column_name):
+        """
+        Return a hashable description of what provides column_name in
+        catalog: the function (shared by every class that inherits it) of a
+        getter or compound getter, or the database column (with the set of
+        columns of the query results it is read from; see the
+        _shared_column_source of InstanceCatalog).
+        Returns None for columns that are not in catalog's column plan.
+        """
+        resolution = catalog._column_resolution.get(column_name, None)
+        if resolution is None:
+            return None
+        kind, attr_name = resolution
+        if kind == 'database':
+            return (kind, catalog._shared_column_source)
+        method = getattr(catalog.__class__, attr_name)
+        return (kind, getattr(method, 'im_func', method))
+
+    def _matches(self, catalog, closure):
+        """
+        Return True if every column in closure is provided
+        by the same method in catalog
+        """
+        # the identities of database columns also depend on the
+        # compound source the catalog reads (see column_identity)
+        key = (id(catalog._column_plan), catalog._shared_column_source, closure)
+        if key not in self._closure_matches:
+            self._closure_matches[key] = all(self.column_identity(catalog, column_name) == identity
+                                             for column_name, identity in closure)
+        return self._closure_matches[key]
+
+    def lookup(self, catalog, column_name, identity, rows):
+        """
+        Look for column_name (provided by identity) calculated for a set of
+        rows including rows (the indices of catalog's current rows in the
+        chunk of query results) by a catalog compatible with catalog.
+
+        Returns the values and the closure of the column, or (None, None)
+        if it has not been calculated.  Only the first lookup of a column by
+        a catalog in each chunk is counted as a hit or a miss.
+        """
+        with self._lock:
+            entries = list(self._entries.get((column_name, identity), ()))
+
+        for entry_rows, value, closure in entries:
+            if not self._matches(catalog, closure):
+                continue
+
+            if len(entry_rows) == len(rows) and np.array_equal(entry_rows, rows):
+                self._record(catalog, column_name, identity, True)
+                return value, closure
+
+            if len(rows) == 0:
+                self._record(catalog, column_name, identity, True)
+                return value[:0], closure
+
+            positions = np.searchsorted(entry_rows, rows)
+            if positions[-1] < len(entry_rows) and np.array_equal(entry_rows[positions], rows):
+                self._record(catalog, column_name, identity, True)
+                return _take_rows(value, positions), closure
+
+        self._record(catalog, column_name, identity, False)
+        return None, None
+
+    def store(self, column_name, identity, rows, value, closure):
+        """
+        Store the values of column_name (provided by identity, and calculated
+        from the columns in closure) for rows (indices into the chunk
+        of query results, in ascending order)
+        """
+        if not isinstance(value, np.ndarray) or value.ndim != 1 or len(value) != len(rows):
+            return
+
+        with self._lock:
+            key = (column_name, identity)
+            if key not in self._entries:
+                self._entries[key] = []
+            self._entries[key].append((rows, value, closure))
+
+    def _record(self, catalog, column_name, identity, hit):
+        with self._lock:
+            key = (catalog, column_name, identity)
+            if key in self._recorded:
+                return
+            self._recorded.add(key)
+            if catalog not in self._catalog_statistics:
+                self._catalog_statistics[catalog] = [0, 0]
+            if hit:
+                self.hits += 1
+                self._catalog_statistics[catalog][0] += 1
+            else:
+                self.misses += 1
+                self._catalog_statistics[catalog][1] += 1
+
+    def catalog_statistics(self, catalog):
+        """
+        Return the numbers of columns catalog found in the cache (hits)
+        and had to calculate (misses)
+        """
+        hits, misses = self._catalog_statistics.get(catalog, (0, 0))
+        return OrderedDict([('hits', hits), ('misses', misses)])
+
+    def statistics(self):
+        """
+        Return the total numbers of hits and misses, and the hit rate
+        (the fraction of calculated columns that were shared)
+        """
+        n_lookups = self.hits + self.misses
+        return OrderedDict([('hits', self.hits),
+                            ('misses', self.misses),
+                            ('hit_rate', float(self.hits)/n_lookups if n_lookups > 0 else 0.0)])
@@ -0,0 +1,267 @@
+"""
+Writing the lines of a catalog in the order of one of its columns, merging
+sorted runs spilled to disk when the catalog does not fit in memory (see
+the sort_by argument of InstanceCatalog.write_catalog)
+"""
+import os
+import heapq
+import tempfile
+import threading
+import numpy as np
+
+__all__ = ["SortedCatalogWriter"]
+
+
+class _SortedRunBuffer(object):
+    """
+    A write-only file-like object that keeps the lines written to it with
+    their sort keys, and hands them to a SortedCatalogWriter as a sorted
+    run whenever it holds max_rows_in_memory lines (and when it is closed)
+    """
+
+    def __init__(self, writer, rank, endline):
+        self._writer = writer
+        self._rank = rank
+        self._endline = endline
+        self._keys = None
+        self._next_row = 0
+        self._key_list = []
+        self._line_list = []
+        self._rows = 0
+        self._closed = False
+
+    def set_sort_keys(self, keys):
+        """
+        Set the sort keys of the lines that are about to be written (one
+        value per line; they are consumed in order by write() and writelines())
+        """
+        keys = np.asarray(keys)
+        if keys.dtype.kind == 'O':
+            raise RuntimeError("Cannot sort a catalog by a column of Python objects")
+        self._keys = keys
+        self._next_row = 0
+
+    def write(self, text):
+        """
+        Write text (a whole number of lines)
+        """
+        lines = text.split(self._endline)
+        if len(lines[-1]) > 0:
+            raise RuntimeError("SortedCatalogWriter.write() was passed a partial line")
+        self.writelines([line + self._endline for line in lines[:-1]])
+
+    def writelines(self, lines):
+        """
+        Write a sequence of lines
+        """
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+
+        lines = list(lines)
+        if len(lines) == 0:
+            return
+
+        if self._keys is None:
+            raise RuntimeError("SortedCatalogWriter needs set_sort_keys() to be "
+                               "called before lines are written")
+
+        start = self._next_row
+        self._next_row += len(lines)
+        keys = self._keys[start:self._next_row]
+        if len(keys) != len(lines):
+            raise RuntimeError("SortedCatalogWriter was given sort keys "
+                               "for fewer lines than it was asked to write")
+
+        self._key_list.append(keys)
+        self._line_list.extend(lines)
+        self._rows += len(lines)
+        if self._rows >= self._writer.max_rows_in_memory:
+            self._flush()
+
+    def _flush(self):
+        """
+        Sort the buffered lines by their keys (keeping the order in which
+        lines with the same key were written) and hand them to the writer
+        """
+        if self._rows == 0:
+            return
+
+        keys = np.concatenate(self._key_list)
+        lines = np.array(self._line_list)
+        order = np.argsort(keys, kind='mergesort')
+        run = np.empty(len(keys), dtype=[('key', keys.dtype), ('line', lines.dtype)])
+        run['key'] = keys[order]
+        run['line'] = lines[order]
+
+        self._key_list = []
+        self._line_list = []
+        self._rows = 0
+        self._writer._add_run(run, self._rank)
+
+    def close(self):
+        """
+        Hand the remaining lines to the writer
+        """
+        if self._closed:
+            return
+        self._flush()
+        self._closed = True
+
+
+class SortedCatalogWriter(object):
+    """
+    A write-only file-like object that writes the lines of a catalog to
+    file_handle sorted by keys given with set_sort_keys() (lines with the same
+    key stay in the order in which they were written).
+
+    Lines are kept in memory, with their keys, until max_rows_in_memory of
+    them have been written.  They are then sorted into a run.  When the
+    runs held in memory add up to more than max_rows_in_memory lines, they
+    are spilled to temporary .npy files in scratch_dir.  close() merges the
+    runs into file_handle, reading the spilled runs from disk a block at a
+    time, so that catalogs larger than memory can be sorted.  NaN keys
+    are written last.
+
+    Several threads can write to one SortedCatalogWriter through the segments
+    returned by segment().  Lines are merged in the order of their keys, then
+    of the ranks of the segments they were written to, then of writing.
+    """
+
+    def __init__(self, file_handle, max_rows_in_memory=None, scratch_dir=None,
+                 endline='\n', block_rows=10000):
+        """
+        @param [in] file_handle is the (open) file to which the sorted lines are
+        written by close().  It is not closed.
+
+        @param [in] max_rows_in_memory is the number of lines held in memory
+        before they are sorted into a run, and the number of lines in the runs
+        held in memory before they are spilled to disk (default 1000000)
+
+        @param [in] scratch_dir is the directory in which the runs are spilled
+        (default: the system's temporary directory)
+
+        @param [in] endline is the string ending each line (default '\\n')
+
+        @param [in] block_rows is the number of lines of each spilled run read
+        into memory at a time while merging (default 10000)
+        """
+        if max_rows_in_memory is None:
+            max_rows_in_memory = 1000000
+        if max_rows_in_memory < 1:
+            raise RuntimeError("SortedCatalogWriter needs max_rows_in_memory to be "
+                               "at least 1; you gave %s" % str(max_rows_in_memory))
+
+        self.max_rows_in_memory = max_rows_in_memory
+        self._file_handle = file_handle
+        self._scratch_dir = scratch_dir
+        self._endline = endline
+        self._block_rows = block_rows
+        self._runs = []
+        self._rows_in_memory = 0
+        self._lock = threading.Lock()
+        self._buffer = _SortedRunBuffer(self, 0, endline)
+        self._closed = False
+
+    @property
+    def spilled_runs(self):
+        """
+        The list of the names of the files holding the runs spilled so far
+        """
+        return [run for rank, seq, run in self._runs if isinstance(run, basestring)]
+
+    def segment(self, rank):
+        """
+        Return a file-like object with set_sort_keys(), write(), writelines()
+        and close() through which one thread writes lines into this
+        SortedCatalogWriter.  Its lines are merged after the lines with the
+        same keys written to segments of lower rank (and to the
+        SortedCatalogWriter itself, whose rank is 0).  The segment must be
+        closed before the SortedCatalogWriter.
+        """
+        return _SortedRunBuffer(self, rank, self._endline)
+
+    def set_sort_keys(self, keys):
+        self._buffer.set_sort_keys(keys)
+
+    def write(self, text):
+        self._buffer.write(text)
+
+    def writelines(self, lines):
+        self._buffer.writelines(lines)
+
+    def _add_run(self, run, rank):
+        """
+        Add a sorted run of lines from the segment of rank rank,
+        spilling the runs held in memory if there are too many lines
+        """
+        with self._lock:
+            self._runs.append((rank, len(self._runs), run))
+            self._rows_in_memory += len(run)
+            if self._rows_in_memory > self.max_rows_in_memory:
+                self._spill()
+
+    def _spill(self):
+        """
+        Save the runs held in memory to temporary files
+        """
+        for ix, (rank, seq, run) in enumerate(self._runs):
+            if isinstance(run, basestring):
+                continue
+            file_descriptor, run_name = tempfile.mkstemp(dir=self._scratch_dir, suffix='.npy')
+            with os.fdopen(file_descriptor, 'wb') as run_file:
+                self._runs[ix] = (rank, seq, run_name)
+                np.save(run_file, run)
+        self._rows_in_memory = 0
+
+    def _iter_run(self, rank, seq, run):
+        """
+        Yield a (merge key, line) tuple for each line of a run
+        """
+        if isinstance(run, basestring):
+            run = np.load(run, mmap_mode='r')
+
+        for start in range(0, len(run), self._block_rows):
+            block = run[start:start+self._block_rows]
+            for ix, (key, line) in enumerate(zip(block['key'].tolist(), block['line'].tolist())):
+                if key != key:
+                    yield (True, None, rank, seq, start+ix), line
+                else:
+                    yield (False, key, rank, seq, start+ix), line
+
+    def close(self):
+        """
+        Merge the sorted runs into file_handle and delete the spilled runs
+        """
+        if self._closed:
+            return
+        self._buffer.close()
+        self._closed = True
+
+        try:
+            merged = heapq.merge(*[self._iter_run(*run) for run in self._runs])
+            self._file_handle.writelines(line for key, line in merged)
+        finally:
+            self._remove_runs()
+
+    def abort(self):
+        """
+        Delete the spilled runs without writing anything to file_handle
+        """
+        self._closed = True
+        self._remove_runs()
+
+    def _remove_runs(self):
+        for run_name in self.spilled_runs:
+            if os.path.exists(run_name):
+                os.unlink(run_name)
+        self._runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
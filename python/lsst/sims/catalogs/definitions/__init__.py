@@ -1,3 +1,9 @@
 from .InstanceCatalog import *
+from .ChunkRouting import *
 from .CompoundInstanceCatalog import *
 from .ParallelCatalogWriter import *
+from .SharedColumnCache import *
+from .CatalogStatistics import *
+from .AsyncFileWriter import *
+from .CatalogShards import *
+from .SortedCatalogWriter import *
@@ -0,0 +1,53 @@
+"""
+A catalog and a text database of objects scattered over a patch of sky,
+shared by the tests of sharded and sorted catalog writing
+"""
+import os
+import numpy as np
+
+from lsst.sims.catalogs.definitions import InstanceCatalog
+from lsst.sims.catalogs.db import fileDBObject
+
+__all__ = ["SkyCat", "makeSkyFileDB"]
+
+
+class SkyCat(InstanceCatalog):
+    """
+    A catalog of the id, raJ2000 and decJ2000 of the objects served by
+    makeSkyFileDB, leaving out the objects whose id % 7 == 3
+    """
+    column_outputs = ['id', 'raJ2000', 'decJ2000']
+    cannot_be_null = ['ip']
+
+    def get_ip(self):
+        ii = self.column_by_name('id')
+        return np.where(ii % 7 != 3, ii, None)
+
+
+def makeSkyFileDB(filename, size=100, seedVal=None):
+    """
+    Write a text file of objects with an id, an raJ2000 between 0 and 40
+    and a decJ2000 between -20 and 20, and return a fileDBObject serving it
+
+    @param [in] filename is the name of the text file (it is overwritten)
+
+    @param [in] size is the number of objects
+
+    @param [in] seedVal is the random seed to use
+    """
+    if os.path.exists(filename):
+        os.unlink(filename)
+
+    if seedVal is not None:
+        rng = np.random.RandomState(seedVal)
+    else:
+        rng = np.random.RandomState(88)
+
+    with open(filename, 'w') as output_file:
+        output_file.write('#a header\n')
+        for ii in range(size):
+            output_file.write('%d %f %f\n' % (ii, rng.random_sample()*40.0,
+                                              rng.random_sample()*40.0-20.0))
+
+    dtype = np.dtype([('id', int), ('raJ2000', float), ('decJ2000', float)])
+    return fileDBObject(filename, runtable='test', dtype=dtype, idColKey='id')
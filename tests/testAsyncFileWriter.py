@@ -0,0 +1,163 @@
+from __future__ import with_statement
+import unittest
+import os
+import numpy as np
+
+import lsst.utils.tests
+from lsst.utils import getPackageDir
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.catalogs.definitions import InstanceCatalog, AsyncFileWriter
+from lsst.sims.catalogs.db import fileDBObject
+from lsst.sims.catalogs.decorators import cached
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class FailingFile(object):
+    """
+    A stand-in for a file handle whose writes fail
+    """
+
+    def write(self, text):
+        raise IOError("the disk is full")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class AsyncCat(InstanceCatalog):
+    column_outputs = ['id', 'ip1', 'ip2t']
+    cannot_be_null = ['ip2t']
+
+    @cached
+    def get_ip2t(self):
+        base = self.column_by_name('ip2')
+        return np.where(base % 3 != 0, base, None)
+
+
+class AsyncFileWriterTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = os.path.join(getPackageDir('sims_catalogs'), 'tests', 'scratchSpace')
+
+        cls.db_src_name = os.path.join(cls.scratch_dir, 'async_writer_db.txt')
+        if os.path.exists(cls.db_src_name):
+            os.unlink(cls.db_src_name)
+
+        with open(cls.db_src_name, 'w') as output_file:
+            output_file.write('#a header\n')
+            for ii in range(100):
+                output_file.write('%d %d %d %d\n' % (ii, ii+1, ii+2, ii+3))
+
+        dtype = np.dtype([('id', int), ('ip1', int), ('ip2', int), ('ip3', int)])
+        cls.db = fileDBObject(cls.db_src_name, runtable='test', dtype=dtype,
+                              idColKey='id')
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+
+        del cls.db
+
+        if os.path.exists(cls.db_src_name):
+            os.unlink(cls.db_src_name)
+
+    def test_blocks(self):
+        """
+        Test that text written in pieces smaller and larger than the block
+        size comes out intact
+        """
+        file_name = os.path.join(self.scratch_dir, 'async_writer_blocks.txt')
+        if os.path.exists(file_name):
+            os.unlink(file_name)
+
+        lines = ['%d %s\n' % (ii, 'x'*(ii % 37)) for ii in range(500)]
+        with AsyncFileWriter(file_name, 'w', block_size=64, max_pending=2) as file_handle:
+            file_handle.writelines(lines[:250])
+            for line in lines[250:]:
+                file_handle.write(line)
+
+        self.assertTrue(file_handle.closed)
+        with open(file_name, 'r') as input_file:
+            self.assertEqual(input_file.read(), ''.join(lines))
+
+        # test that append mode adds to the file
+        with AsyncFileWriter(file_name, 'a', block_size=64) as file_handle:
+            file_handle.write('last line\n')
+
+        with open(file_name, 'r') as input_file:
+            self.assertEqual(input_file.read(), ''.join(lines) + 'last line\n')
+
+        if os.path.exists(file_name):
+            os.unlink(file_name)
+
+    def test_errors(self):
+        """
+        Test that a failed write on the background thread is raised
+        in the thread that is writing
+        """
+        file_name = os.path.join(self.scratch_dir, 'async_writer_errors.txt')
+        if os.path.exists(file_name):
+            os.unlink(file_name)
+
+        file_handle = AsyncFileWriter(file_name, 'w', block_size=8)
+        file_handle._file_handle.close()
+        file_handle._file_handle = FailingFile()
+
+        with self.assertRaises(IOError):
+            for ii in range(1000):
+                file_handle.write('a line\n')
+        self.assertTrue(file_handle.closed)
+
+        file_handle = AsyncFileWriter(file_name, 'w', block_size=1024)
+        file_handle._file_handle.close()
+        file_handle._file_handle = FailingFile()
+        file_handle.write('a short line\n')
+        with self.assertRaises(IOError):
+            file_handle.close()
+
+        if os.path.exists(file_name):
+            os.unlink(file_name)
+
+    def test_write_catalog(self):
+        """
+        Test that InstanceCatalog.write_catalog writes the same catalog
+        with async_write=True as without it
+        """
+        serial_name = os.path.join(self.scratch_dir, 'async_writer_serial_cat.txt')
+        async_name = os.path.join(self.scratch_dir, 'async_writer_async_cat.txt')
+        for file_name in (serial_name, async_name):
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+        cat = AsyncCat(self.db)
+        cat.write_catalog(serial_name, chunk_size=7)
+        cat = AsyncCat(self.db)
+        cat.write_catalog(async_name, chunk_size=7, async_write=True)
+
+        with open(serial_name, 'r') as input_file:
+            serial_lines = input_file.readlines()
+        with open(async_name, 'r') as input_file:
+            async_lines = input_file.readlines()
+
+        self.assertEqual(len(serial_lines), 68)  # 67 data lines and a header
+        self.assertEqual(serial_lines, async_lines)
+
+        for file_name in (serial_name, async_name):
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
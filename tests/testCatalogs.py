@@ -39,6 +39,30 @@ class TransformationCatalog(InstanceCatalog):
     transformations = {'raJ2000': twice_fn}
 
 
+class CountingTransform(object):
+    """
+    A transformation which counts the number of times it is applied
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, x):
+        self.calls += 1
+        return 2.0*x
+
+
+class SharedTransformationCatalog(InstanceCatalog):
+    catalog_type = 'shared_transformation_catalog'
+    refIdCol = 'id'
+    column_outputs = ['id', 'raJ2000', 'ra_raw', 'raJ2000']
+    default_formats = {'f': '%.12f'}
+    transformations = {'raJ2000': CountingTransform()}
+
+    def get_ra_raw(self):
+        return self.column_by_name('raJ2000')
+
+
 class BasicCatalog(InstanceCatalog):
     catalog_type = 'basic_catalog'
     refIdCol = 'id'
@@ -284,6 +308,39 @@ class InstanceCatalogTestCase(unittest.TestCase):
         if os.path.exists(catName):
             os.unlink(catName)
 
+    def test_shared_transformation(self):
+        """
+        Test that a transformation is applied once per chunk to a column that
+        is output twice, and does not alter the untransformed column
+        """
+        catName = os.path.join(getPackageDir('sims_catalogs'), 'tests', 'scratchSpace',
+                               'shared_transformation_catalog.txt')
+
+        if os.path.exists(catName):
+            os.unlink(catName)
+
+        transform = SharedTransformationCatalog.transformations['raJ2000']
+        transform.calls = 0
+        t = self.starDB.getCatalog('shared_transformation_catalog', obs_metadata=self.obsMd)
+        t.write_catalog(catName, chunk_size=10)
+
+        dtype = np.dtype([('id', np.int),
+                          ('raJ2000', np.float),
+                          ('ra_raw', np.float),
+                          ('ra_again', np.float)])
+
+        testData = np.genfromtxt(catName, delimiter=', ', dtype=dtype)
+        self.assertGreater(len(testData), 10)
+        self.assertEqual(transform.calls, (len(testData)+9)//10)
+        for line in testData:
+            ic = np.where(self.starControlData['id'] == line['id'])[0][0]
+            self.assertAlmostEqual(line['raJ2000'], 2.0*self.starControlData['raJ2000'][ic], 5)
+            self.assertAlmostEqual(line['ra_again'], 2.0*self.starControlData['raJ2000'][ic], 5)
+            self.assertAlmostEqual(line['ra_raw'], self.starControlData['raJ2000'][ic], 5)
+
+        if os.path.exists(catName):
+            os.unlink(catName)
+
 
 class boundingBoxTest(unittest.TestCase):
 
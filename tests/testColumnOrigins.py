@@ -332,6 +332,40 @@ class AllAvailableColumns(unittest.TestCase):
         self.assertIn('objid', cat._all_available_columns)
         self.assertIn('sillyDefault', cat._all_available_columns)
 
+    def testSharedColumnPlan(self):
+        """
+        Test that instantiations of the same InstanceCatalog class on the same
+        CatalogDBObject share one column plan, but do not share their mutable
+        lists of columns
+        """
+        cat1 = myDummyCatalogClass(self.db, column_outputs=['aa'])
+        cat2 = myDummyCatalogClass(self.db)
+        self.assertIs(cat1._column_plan, cat2._column_plan)
+        self.assertEqual(cat1._all_available_columns, cat2._all_available_columns)
+        self.assertIsNot(cat1._all_available_columns, cat2._all_available_columns)
+        self.assertEqual(cat1._column_outputs, ['aa'])
+        self.assertEqual(cat1._column_plan.resolution['aa'], ('database', None))
+        self.assertEqual(cat1._column_plan.resolution['cc'], ('getter', 'get_cc'))
+        self.assertEqual(cat1._column_plan.resolution['ee'], ('compound', 'get_compound'))
+        self.assertEqual(cat1._column_plan.resolution['sillyDefault'],
+                         ('default', 'default_sillyDefault'))
+
+    def testDefaultColumns(self):
+        """
+        Test that default columns are returned as constant broadcast views
+        with the right length, type and value
+        """
+        cat = myDummyCatalogClass(self.db, column_outputs=['aa', 'sillyDefault'])
+        ct = 0
+        for chunk_cols, col_map in cat.iter_catalog_chunks(chunk_size=4):
+            default_col = chunk_cols[col_map['sillyDefault']]
+            self.assertEqual(len(default_col), len(chunk_cols[col_map['aa']]))
+            self.assertEqual(default_col.dtype, np.dtype(float))
+            self.assertEqual(default_col.strides, (0,))
+            np.testing.assert_array_equal(default_col, 2.0*np.ones(len(default_col)))
+            ct += len(default_col)
+        self.assertEqual(ct, 10)
+
     def testDependentColumns(self):
         """
         We want to be able to use self._all_available_columns to change the calculation
@@ -294,6 +294,99 @@ class CompoundCatalogDBObjectTestCase(unittest.TestCase):
                                                     3.0*self.controlArray['b'],
                                                     decimal=6)
 
+    def testColumnDeduplication(self):
+        """
+        Verify that columns with the same SQL expression are only
+        selected once and returned as aliases of the same column
+        """
+
+        class testDbClass9(dbClass1):
+            database = self.dbName
+            driver = 'sqlite'
+
+        class testDbClass10(dbClass2):
+            database = self.dbName
+            driver = 'sqlite'
+
+        class testDbClass11(dbClass3):
+            database = self.dbName
+            driver = 'sqlite'
+
+        db1 = testDbClass9
+        db2 = testDbClass10
+        db3 = testDbClass11
+
+        compoundDb = CompoundCatalogDBObject([db1, db2, db3])
+
+        # class1_aa, class2_bb and class3_bb are all 'a'
+        colNames = ['%s_aa' % db1.objid, '%s_aa' % db2.objid,
+                    '%s_bb' % db2.objid, '%s_bb' % db3.objid]
+
+        selected, aliases = compoundDb._deduplicate_columns(colNames)
+        self.assertEqual(selected, ['%s_aa' % db1.objid, '%s_aa' % db2.objid])
+        self.assertEqual(aliases, {'%s_bb' % db2.objid: '%s_aa' % db1.objid,
+                                   '%s_bb' % db3.objid: '%s_aa' % db1.objid})
+
+        results = compoundDb.query_columns(colnames=colNames, chunk_size=10)
+
+        ct = 0
+        for chunk in results:
+            rows = chunk['id']
+            ct += len(rows)
+            self.assertEqual(chunk.dtype.names[1:], tuple(colNames))
+            offset = chunk.dtype.fields['%s_aa' % db1.objid][1]
+            self.assertEqual(chunk.dtype.fields['%s_bb' % db2.objid][1], offset)
+            self.assertEqual(chunk.dtype.fields['%s_bb' % db3.objid][1], offset)
+
+            numpy.testing.assert_array_almost_equal(chunk['%s_bb' % db2.objid],
+                                                    self.controlArray['a'][rows],
+                                                    decimal=6)
+
+            numpy.testing.assert_array_almost_equal(chunk['%s_bb' % db3.objid],
+                                                    self.controlArray['a'][rows],
+                                                    decimal=6)
+
+            numpy.testing.assert_array_almost_equal(chunk['%s_aa' % db2.objid],
+                                                    2.0*self.controlArray['b'][rows],
+                                                    decimal=6)
+
+        self.assertEqual(ct, 100)
+
+    def testMembersNotInstantiated(self):
+        """
+        Verify that CompoundCatalogDBObject works out the columns of its
+        members from the shared table without instantiating them
+        """
+
+        class countingDbClass(CatalogDBObject):
+            skipRegistration = True
+            database = self.dbName
+            driver = 'sqlite'
+            instantiations = 0
+
+            def _get_table(self):
+                countingDbClass.instantiations += 1
+                super(countingDbClass, self)._get_table()
+
+        class testDbClass23(dbClass1, countingDbClass):
+            pass
+
+        class testDbClass24(dbClass2, countingDbClass):
+            pass
+
+        class testDbClass25(dbClass3, countingDbClass):
+            pass
+
+        dbList = [testDbClass23, testDbClass24, testDbClass25]
+        compoundDb = CompoundCatalogDBObject(dbList)
+        self.assertEqual(countingDbClass.instantiations, 0)
+        self.assertEqual(compoundDb.idColKey, 'id')
+
+        for dbo in dbList:
+            self.assertEqual(dbo._columns_for_table(compoundDb.table), dbo().columns)
+
+        self.assertEqual(countingDbClass.instantiations, 3)
+
     def testTableRestriction(self):
         """
         Verify that _table_restriction works the way it should in CompoundCatalogDBObject
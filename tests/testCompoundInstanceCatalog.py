@@ -2,12 +2,15 @@ from __future__ import with_statement
 import os
 import numpy as np
 import unittest
+from collections import OrderedDict
 import lsst.utils.tests
 from lsst.utils import getPackageDir
 from lsst.sims.utils.CodeUtilities import sims_clean_up
 from lsst.sims.utils import ObservationMetaData
 from lsst.sims.catalogs.db import fileDBObject, CatalogDBObject, CompoundCatalogDBObject
 from lsst.sims.catalogs.definitions import InstanceCatalog, CompoundInstanceCatalog
+from lsst.sims.catalogs.definitions import parallelCatalogWriter, RoutedChunk
+from lsst.sims.catalogs.definitions.ParallelCatalogWriter import _plan_compound_queries
 
 
 def setup_module(module):
@@ -36,6 +39,15 @@ class negativeDecCompound_table2(CompoundCatalogDBObject):
         return results
 
 
+class countingCompound(CompoundCatalogDBObject):
+
+    queries = 0
+
+    def query_columns(self, *args, **kwargs):
+        countingCompound.queries += 1
+        return super(countingCompound, self).query_columns(*args, **kwargs)
+
+
 class cartoonDBbase(object):
 
     driver = 'sqlite'
@@ -142,6 +154,25 @@ class Cat4(Cat3):
         return self.column_by_name('id')+4000
 
 
+class TruthCat(Cat1):
+    column_outputs = ['testId', 'final_mag']
+
+
+class NullCat(TruthCat):
+    cannot_be_null = ['final_mag']
+
+    def get_final_mag(self):
+        ii = self.column_by_name('id')
+        mag = self.column_by_name('mag') + self.column_by_name('dmag')
+        return np.where(ii % 4 != 1, mag, None)
+
+
+class NullCat2(NullCat):
+
+    def get_testId(self):
+        return self.column_by_name('id')+2000
+
+
 class CompoundCatalogTest(unittest.TestCase):
 
     longMessage = True
@@ -761,6 +792,261 @@ class CompoundCatalogTest(unittest.TestCase):
             os.unlink(fileName)
 
 
+    def testRoutedChunk(self):
+        """
+        Test that a RoutedChunk renames the columns of a chunk
+        and selects its rows without copying the chunk
+        """
+        master = np.rec.fromrecords([(ii, 2.0*ii, 'a%d' % ii) for ii in range(10)],
+                                    dtype=np.dtype([('db1_id', int), ('db1_ra', float),
+                                                    ('db2_name', str, 4)]))
+
+        chunk = RoutedChunk(master, OrderedDict([('id', 'db1_id'), ('name', 'db2_name')]))
+        self.assertEqual(len(chunk), 10)
+        self.assertEqual(chunk.dtype.names, ('id', 'name'))
+        np.testing.assert_array_equal(chunk['id'], master['db1_id'])
+        self.assertTrue(np.may_share_memory(chunk['id'], master))
+        self.assertFalse(chunk['id'].flags['WRITEABLE'])
+        self.assertTrue(master.flags['WRITEABLE'])
+        with self.assertRaises(ValueError):
+            chunk['ra']
+
+        subset = chunk[np.array([1, 3, 5, 7])]
+        self.assertIsInstance(subset, RoutedChunk)
+        self.assertEqual(len(subset), 4)
+        np.testing.assert_array_equal(subset['id'], [1, 3, 5, 7])
+
+        subset = subset[subset['id'] > 3]
+        np.testing.assert_array_equal(subset['id'], [5, 7])
+        np.testing.assert_array_equal(subset['name'], ['a5', 'a7'])
+
+    def testConcurrentGroups(self):
+        """
+        Test that writing the groups of a CompoundInstanceCatalog on several
+        threads produces the same file as writing them one after another
+        """
+        fileName = os.path.join(self.baseDir, 'concurrent_compound_catalog.txt')
+        controlName = os.path.join(self.baseDir, 'concurrent_compound_control.txt')
+
+        compoundCat = CompoundInstanceCatalog([Cat1, Cat2, Cat3], [table1DB1, table1DB2, table2DB1])
+        compoundCat.write_catalog(controlName, chunk_size=7)
+
+        compoundCat = CompoundInstanceCatalog([Cat1, Cat2, Cat3], [table1DB1, table1DB2, table2DB1])
+        compoundCat.write_catalog(fileName, chunk_size=7, threads=2)
+
+        with open(controlName, 'r') as input_file:
+            control_lines = input_file.readlines()
+        with open(fileName, 'r') as input_file:
+            test_lines = input_file.readlines()
+
+        self.assertEqual(len(control_lines), 301)
+        self.assertEqual(test_lines, control_lines)
+
+        # append without a header
+        compoundCat = CompoundInstanceCatalog([Cat1, Cat2, Cat3], [table1DB1, table1DB2, table2DB1])
+        compoundCat.write_catalog(fileName, chunk_size=7, threads=2,
+                                  write_mode='a', write_header=False)
+
+        with open(fileName, 'r') as input_file:
+            test_lines = input_file.readlines()
+
+        self.assertEqual(test_lines, control_lines + control_lines[1:])
+
+        self.assertEqual([name for name in os.listdir(self.baseDir) if name.endswith('.segment')], [])
+
+        for name in (fileName, controlName):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def testParallelCompoundCatalogs(self):
+        """
+        Test that parallelCatalogWriter writes several CompoundInstanceCatalogs
+        with one query per table, producing the same rows as write_catalog
+        """
+        phosimName = os.path.join(self.baseDir, 'parallel_compound_phosim.txt')
+        truthName = os.path.join(self.baseDir, 'parallel_compound_truth.txt')
+        controlName = os.path.join(self.baseDir, 'parallel_compound_control.txt')
+
+        def make_catalogs():
+            phosimCat = CompoundInstanceCatalog([Cat1, Cat2, Cat3],
+                                                [table1DB1, table1DB2, table2DB1],
+                                                compoundDBclass=countingCompound)
+            truthCat = CompoundInstanceCatalog([TruthCat, TruthCat],
+                                               [table1DB1, table2DB1],
+                                               compoundDBclass=countingCompound)
+            return phosimCat, truthCat
+
+        for fileName in (phosimName, truthName):
+            phosimCat, truthCat = make_catalogs()
+            countingCompound.queries = 0
+            catalog_dict = {phosimName: phosimCat, truthName: truthCat}
+            timing = parallelCatalogWriter(catalog_dict, chunk_size=7)
+
+            # table1 is read through one CompoundCatalogDBObject query
+            # (table2 only through table2DB1), as for phosimCat alone
+            self.assertEqual(countingCompound.queries, 1)
+
+            if fileName == phosimName:
+                phosimCat.write_catalog(controlName, chunk_size=7)
+            else:
+                truthCat.write_catalog(controlName, chunk_size=7)
+
+            with open(controlName, 'r') as input_file:
+                control_lines = input_file.readlines()
+            with open(fileName, 'r') as input_file:
+                test_lines = input_file.readlines()
+
+            self.assertEqual(test_lines[0], control_lines[0])
+            self.assertEqual(sorted(test_lines[1:]), sorted(control_lines[1:]))
+            self.assertEqual(timing[fileName]['rows'], len(control_lines)-1)
+
+        self.assertEqual(len(control_lines), 201)
+
+        with self.assertRaises(RuntimeError):
+            parallelCatalogWriter({phosimName: make_catalogs()[0],
+                                   truthName: TruthCat(table1DB1())})
+
+        for fileName in (phosimName, truthName, controlName):
+            if os.path.exists(fileName):
+                os.unlink(fileName)
+
+    def testParallelCrossCompoundCatalogs(self):
+        """
+        Test that InstanceCatalogs which are alone in their
+        CompoundInstanceCatalogs, but are read through one CompoundCatalogDBObject
+        query by parallelCatalogWriter, are filtered as write_catalog filters
+        them when they share a CompoundInstanceCatalog
+        """
+        name1 = os.path.join(self.baseDir, 'parallel_cross_compound_1.txt')
+        name2 = os.path.join(self.baseDir, 'parallel_cross_compound_2.txt')
+        controlName = os.path.join(self.baseDir, 'parallel_cross_compound_control.txt')
+
+        def make_catalogs():
+            return {name1: CompoundInstanceCatalog([NullCat], [table1DB1]),
+                    name2: CompoundInstanceCatalog([NullCat2], [table1DB2])}
+
+        catalog_dict = make_catalogs()
+        obs, header_catalogs, query_groups = _plan_compound_queries(catalog_dict,
+                                                                    [name1, name2], None)
+        self.assertEqual(len(query_groups), 1)
+        for file_name, cat in query_groups[0].members:
+            self.assertTrue(cat._pre_screen)
+
+        parallelCatalogWriter(make_catalogs(), chunk_size=7)
+        CompoundInstanceCatalog([NullCat, NullCat2],
+                                [table1DB1, table1DB2]).write_catalog(controlName, chunk_size=7)
+
+        with open(controlName, 'r') as input_file:
+            control_lines = input_file.readlines()
+        test_lines = []
+        for file_name in (name1, name2):
+            with open(file_name, 'r') as input_file:
+                lines = input_file.readlines()
+            self.assertEqual(lines[0], control_lines[0])
+            test_lines += lines[1:]
+
+        self.assertEqual(sorted(test_lines), sorted(control_lines[1:]))
+        self.assertEqual(len(control_lines), 151)
+
+        for fileName in (name1, name2, controlName):
+            if os.path.exists(fileName):
+                os.unlink(fileName)
+
+    def testWriteCatalogs(self):
+        """
+        Test that write_catalogs produces the same files as calling
+        write_catalog for each ObservationMetaData, with and without threads
+        """
+        obs_list = [ObservationMetaData(pointingRA=180.0, pointingDec=0.0,
+                                        boundType='box', boundLength=(80.0, 25.0),
+                                        mjd=53850.0),
+                    ObservationMetaData(pointingRA=90.0, pointingDec=-10.0,
+                                        boundType='circle', boundLength=40.0,
+                                        mjd=53860.0),
+                    None]
+
+        control_names = [os.path.join(self.baseDir, 'write_catalogs_control_%d.txt' % ix)
+                         for ix in range(len(obs_list))]
+        test_names = [os.path.join(self.baseDir, 'write_catalogs_test_%d.txt' % ix)
+                      for ix in range(len(obs_list))]
+
+        control_lines = []
+        for obs, fileName in zip(obs_list, control_names):
+            compoundCat = CompoundInstanceCatalog([Cat1, Cat2, Cat3], [table1DB1, table1DB2, table2DB1],
+                                                  obs_metadata=obs)
+            compoundCat.write_catalog(fileName, chunk_size=7)
+            with open(fileName, 'r') as input_file:
+                control_lines.append(input_file.readlines())
+
+        # the pointings select different rows
+        self.assertNotEqual(len(control_lines[0]), len(control_lines[1]))
+        self.assertEqual(len(control_lines[2]), 301)
+
+        for threads in (None, 2):
+            compoundCat = CompoundInstanceCatalog([Cat1, Cat2, Cat3], [table1DB1, table1DB2, table2DB1])
+            compoundCat.write_catalogs(test_names, obs_list, chunk_size=7, threads=threads)
+
+            for fileName, lines in zip(test_names, control_lines):
+                with open(fileName, 'r') as input_file:
+                    self.assertEqual(input_file.readlines(), lines)
+
+        with self.assertRaises(RuntimeError):
+            compoundCat.write_catalogs(test_names, obs_list[:2])
+
+        # a None in obs_metadata_list selects and evaluates the rows with the
+        # ObservationMetaData of the CompoundInstanceCatalog
+        compoundCat = CompoundInstanceCatalog([Cat1, Cat2, Cat3], [table1DB1, table1DB2, table2DB1],
+                                              obs_metadata=obs_list[0])
+        compoundCat.write_catalogs(test_names[:1], [None], chunk_size=7)
+        with open(test_names[0], 'r') as input_file:
+            self.assertEqual(input_file.readlines(), control_lines[0])
+
+        for fileName in control_names + test_names:
+            if os.path.exists(fileName):
+                os.unlink(fileName)
+
+
+    def testSortedCompoundCatalog(self):
+        """
+        Test that write_catalog with sort_by merges the rows of every
+        InstanceCatalog in order of the column, with and without threads
+        """
+        fileName = os.path.join(self.baseDir, 'sorted_compound_catalog.txt')
+        controlName = os.path.join(self.baseDir, 'sorted_compound_control.txt')
+
+        compoundCat = CompoundInstanceCatalog([Cat1, Cat2, Cat3], [table1DB1, table1DB2, table2DB1])
+        compoundCat.write_catalog(controlName, chunk_size=7)
+        with open(controlName, 'r') as input_file:
+            control_lines = input_file.readlines()
+
+        sorted_lines = None
+        for threads in (None, 2):
+            compoundCat = CompoundInstanceCatalog([Cat1, Cat2, Cat3], [table1DB1, table1DB2, table2DB1])
+            compoundCat.write_catalog(fileName, chunk_size=7, sort_by='final_mag',
+                                      max_rows_in_memory=20, threads=threads)
+            with open(fileName, 'r') as input_file:
+                test_lines = input_file.readlines()
+
+            self.assertEqual(test_lines[0], control_lines[0])
+            self.assertEqual(sorted(test_lines[1:]), sorted(control_lines[1:]))
+            mags = [float(line.split()[-1]) for line in test_lines[1:]]
+            self.assertEqual(mags, sorted(mags))
+
+            if sorted_lines is None:
+                sorted_lines = test_lines
+            else:
+                self.assertEqual(test_lines, sorted_lines)
+
+        self.assertEqual([name for name in os.listdir(self.baseDir) if name.endswith('.npy')], [])
+
+        with self.assertRaises(RuntimeError):
+            compoundCat.write_catalog(fileName, sort_by='magnitude')
+
+        for name in (fileName, controlName):
+            if os.path.exists(name):
+                os.unlink(name)
+
+
 class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
     pass
 
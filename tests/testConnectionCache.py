@@ -6,7 +6,8 @@ import numpy as np
 import lsst.utils.tests
 from lsst.utils import getPackageDir
 from lsst.sims.utils.CodeUtilities import sims_clean_up
-from lsst.sims.catalogs.db import CatalogDBObject, DBObject
+from lsst.sims.catalogs.db import CatalogDBObject, DBObject, DBConnectionRegistry
+from lsst.sims.catalogs.definitions import InstanceCatalog, CompoundInstanceCatalog
 
 
 def setup_module(module):
@@ -110,6 +111,47 @@ class CachingTestCase(unittest.TestCase):
         np.testing.assert_array_equal(results['id']*(-1), results['i2'])
 
 
+    def test_connection_registry(self):
+        """
+        Test that DBConnectionRegistry finds connections by their normalized
+        parameters and that CatalogDBObject and CompoundInstanceCatalog
+        share its connections
+        """
+        registry = DBConnectionRegistry()
+        conn = registry.get_connection(self.db_name, 'sqlite', None, None)
+        relative_name = os.path.relpath(self.db_name)
+        self.assertIs(registry.get_connection(relative_name, 'sqlite', 'localhost', 1234), conn)
+        self.assertIsNone(registry.find(self.db_name, 'postgres', None, None))
+        self.assertEqual(registry.key('db', 'mssql', 'host', 1433),
+                         registry.key('db', 'mssql', 'host', '1433'))
+        self.assertEqual(registry.statistics(),
+                         {'connections': 1, 'opened': 1, 'reused': 1})
+
+        class DbClass3(CatalogDBObject):
+            database = relative_name
+            driver = 'sqlite'
+            tableid = 'test'
+            idColKey = 'id'
+            objid = 'test_db_class_3'
+
+        class DbClass4(DbClass3):
+            database = self.db_name
+            objid = 'test_db_class_4'
+
+        db3 = DbClass3()
+        stats = CatalogDBObject.connection_statistics()
+        db4 = DbClass4()
+        self.assertIs(db3.connection, db4.connection)
+        self.assertEqual(CatalogDBObject.connection_statistics()['reused'], stats['reused']+1)
+        self.assertEqual(CatalogDBObject.connection_statistics()['opened'], stats['opened'])
+
+        class TestCat(InstanceCatalog):
+            column_outputs = ['id']
+
+        compound_cat = CompoundInstanceCatalog([TestCat, TestCat], [DbClass3, DbClass4])
+        self.assertIs(compound_cat.find_a_connection(DbClass4), db3.connection)
+
+
 class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
     pass
 
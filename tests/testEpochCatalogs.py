@@ -0,0 +1,193 @@
+from __future__ import with_statement
+import unittest
+import os
+import numpy as np
+
+import lsst.utils.tests
+from lsst.utils import getPackageDir
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.utils import ObservationMetaData
+from lsst.sims.catalogs.definitions import InstanceCatalog
+from lsst.sims.catalogs.db import fileDBObject
+from lsst.sims.catalogs.decorators import cached, compound, time_dependent
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class EpochCat(InstanceCatalog):
+    column_outputs = ['id', 'static_mag', 'phase', 'flux', 'cA', 'cB']
+    cannot_be_null = ['sfilter', 'tfilter']
+    static_calls = 0
+
+    def get_static_mag(self):
+        EpochCat.static_calls += 1
+        return self.column_by_name('base')*0.1
+
+    @cached
+    def get_base(self):
+        return self.column_by_name('ip1')*2.0
+
+    def get_phase(self):
+        return self.obs_metadata.mjd.TAI + self.column_by_name('id')
+
+    @time_dependent
+    def get_flux(self):
+        return self.column_by_name('base')*3.0
+
+    @compound('cA', 'cB')
+    def get_comp(self):
+        return np.array([self.column_by_name('base')+1.0,
+                         self.column_by_name('phase')*2.0])
+
+    def get_sfilter(self):
+        ii = self.column_by_name('id')
+        return np.where(ii % 5 != 0, ii, None)
+
+    def get_tfilter(self):
+        ii = self.column_by_name('phase').astype(int)
+        return np.where(ii % 3 != 0, ii, None)
+
+
+class LateEpochCat(EpochCat):
+    cannot_be_null = ['sfilter', 'tfilter', 'late']
+
+    def get_late(self):
+        ii = self.column_by_name('id')
+        return np.where(ii >= 7, ii, None)
+
+
+class EpochCatalogTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = os.path.join(getPackageDir('sims_catalogs'), 'tests', 'scratchSpace')
+
+        cls.db_src_name = os.path.join(cls.scratch_dir, 'epoch_cat_db.txt')
+        if os.path.exists(cls.db_src_name):
+            os.unlink(cls.db_src_name)
+
+        with open(cls.db_src_name, 'w') as output_file:
+            output_file.write('#a header\n')
+            for ii in range(50):
+                output_file.write('%d %d\n' % (ii, ii+1))
+
+        dtype = np.dtype([('id', int), ('ip1', int)])
+        cls.db = fileDBObject(cls.db_src_name, runtable='test', dtype=dtype,
+                              idColKey='id')
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+
+        del cls.db
+
+        if os.path.exists(cls.db_src_name):
+            os.unlink(cls.db_src_name)
+
+    def test_epochs(self):
+        """
+        Test that write_epoch_catalogs writes the same catalogs as
+        write_catalog called once per epoch, evaluating the static
+        columns only once per chunk
+        """
+        obs_list = [ObservationMetaData(mjd=59580.0+ii) for ii in range(4)]
+        epoch_names = [os.path.join(self.scratch_dir, 'epoch_cat_%d.txt' % ii)
+                       for ii in range(4)]
+        control_names = [os.path.join(self.scratch_dir, 'epoch_control_cat_%d.txt' % ii)
+                         for ii in range(4)]
+
+        for file_name in epoch_names + control_names:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+        for obs, file_name in zip(obs_list, control_names):
+            cat = EpochCat(self.db, obs_metadata=obs)
+            cat.write_catalog(file_name, chunk_size=7)
+
+        EpochCat.static_calls = 0
+        cat = EpochCat(self.db, obs_metadata=obs_list[0])
+        saved_obs = cat.obs_metadata
+        columns = cat.write_epoch_catalogs(epoch_names, obs_list, chunk_size=7)
+
+        self.assertEqual(columns['time_dependent'],
+                         ['cA', 'cB', 'flux', 'phase', 'tfilter'])
+        self.assertEqual(sorted(columns['static']),
+                         ['base', 'id', 'ip1', 'sfilter', 'static_mag'])
+
+        # once per chunk, plus once while the columns were being
+        # classified (at the first epoch of the first chunk)
+        self.assertEqual(EpochCat.static_calls, 9)
+
+        for epoch_name, control_name in zip(epoch_names, control_names):
+            with open(epoch_name, 'r') as input_file:
+                epoch_lines = input_file.readlines()
+            with open(control_name, 'r') as input_file:
+                control_lines = input_file.readlines()
+            self.assertGreater(len(control_lines), 20)
+            self.assertEqual(epoch_lines, control_lines)
+
+        # the lines that pass tfilter differ from epoch to epoch
+        with open(epoch_names[0], 'r') as input_file:
+            first_lines = input_file.readlines()
+        with open(epoch_names[1], 'r') as input_file:
+            second_lines = input_file.readlines()
+        self.assertNotEqual(first_lines[1:], second_lines[1:])
+
+        self.assertIs(cat.obs_metadata, saved_obs)
+
+        for file_name in epoch_names + control_names:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+    def test_empty_first_chunk(self):
+        """
+        Test that the columns are only classified once an epoch has written
+        some rows, so that a first chunk emptied by the getter filters does
+        not leave every column classified as time-dependent
+        """
+        obs_list = [ObservationMetaData(mjd=59580.0+ii) for ii in range(3)]
+        epoch_names = [os.path.join(self.scratch_dir, 'late_epoch_cat_%d.txt' % ii)
+                       for ii in range(3)]
+        control_name = os.path.join(self.scratch_dir, 'late_epoch_control_cat.txt')
+
+        cat = LateEpochCat(self.db, obs_metadata=obs_list[0])
+        columns = cat.write_epoch_catalogs(epoch_names, obs_list, chunk_size=7)
+        self.assertEqual(columns['time_dependent'],
+                         ['cA', 'cB', 'flux', 'phase', 'tfilter'])
+        self.assertEqual(sorted(columns['static']),
+                         ['base', 'id', 'ip1', 'late', 'sfilter', 'static_mag'])
+
+        for obs, epoch_name in zip(obs_list, epoch_names):
+            LateEpochCat(self.db, obs_metadata=obs).write_catalog(control_name, chunk_size=7)
+            with open(epoch_name, 'r') as input_file:
+                epoch_lines = input_file.readlines()
+            with open(control_name, 'r') as input_file:
+                control_lines = input_file.readlines()
+            self.assertEqual(epoch_lines, control_lines)
+
+        for file_name in epoch_names + [control_name]:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+    def test_different_bounds(self):
+        """
+        Test that write_epoch_catalogs refuses pointings with different bounds
+        """
+        obs_list = [ObservationMetaData(mjd=59580.0, pointingRA=10.0, pointingDec=5.0,
+                                        boundType='circle', boundLength=1.0),
+                    ObservationMetaData(mjd=59581.0, pointingRA=20.0, pointingDec=5.0,
+                                        boundType='circle', boundLength=1.0)]
+        cat = EpochCat(self.db)
+        with self.assertRaises(RuntimeError):
+            cat.write_epoch_catalogs(['a.txt', 'b.txt'], obs_list)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
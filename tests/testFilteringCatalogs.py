@@ -8,7 +8,7 @@ from lsst.utils import getPackageDir
 from lsst.sims.utils.CodeUtilities import sims_clean_up
 from lsst.sims.catalogs.definitions import InstanceCatalog, CompoundInstanceCatalog
 from lsst.sims.catalogs.db import fileDBObject, CatalogDBObject
-from lsst.sims.catalogs.decorators import cached, compound
+from lsst.sims.catalogs.decorators import cached, compound, CompoundColumn
 
 
 def setup_module(module):
@@ -305,6 +305,64 @@ class InstanceCatalogTestCase(unittest.TestCase):
         if os.path.exists(cat_name):
             os.unlink(cat_name)
 
+    def test_compound_column_block(self):
+        """
+        Test that a compound column returned as one 2-D array is
+        stored as that array, and is filtered correctly
+        """
+
+        class FilteredCat5c(InstanceCatalog):
+            column_outputs = ['id', 'a', 'b', 'c']
+            cannot_be_null = ['ip3t']
+
+            @compound('a', 'b', 'c')
+            def get_alphabet(self):
+                ii = self.column_by_name('ip3')
+                return np.outer([1.5, 2.5, 3.5], ii)
+
+            def get_ip3t(self):
+                # evaluating 'a' puts the compound column in the cache
+                # before the rows are filtered
+                a = self.column_by_name('a')
+                ii = self.column_by_name('ip3')
+                return np.where(ii % 3 == 0, a, None)
+
+        block = np.array([np.arange(4.0), np.arange(4.0)*2.0])
+        results = CompoundColumn.from_results(('a', 'b'), block)
+        self.assertIs(results.data, block)
+        self.assertIs(results['b'].base, block)
+        subset = results.take(np.array([1, 3]))
+        np.testing.assert_array_equal(subset['a'], [1.0, 3.0])
+        np.testing.assert_array_equal(subset['b'], [2.0, 6.0])
+        self.assertEqual(list(subset.keys()), ['a', 'b'])
+
+        # separate columns are kept as they are, without being copied
+        columns = (np.arange(4), np.arange(4.0))
+        results = CompoundColumn.from_results(('a', 'b'), columns)
+        self.assertIsNone(results.data)
+        self.assertIs(results['a'], columns[0])
+        self.assertIs(results['b'], columns[1])
+
+        cat_name = os.path.join(self.scratch_dir, "inst_block_compound_column_filter_cat.txt")
+        if os.path.exists(cat_name):
+            os.unlink(cat_name)
+
+        cat = FilteredCat5c(self.db)
+        cat.write_catalog(cat_name, chunk_size=4)
+
+        with open(cat_name, 'r') as input_file:
+            input_lines = input_file.readlines()
+
+        self.assertEqual(len(input_lines), 5)  # 4 data lines and a header
+        for i_line, line in enumerate(input_lines[1:]):
+            ii = i_line*3
+            ip3 = ii + 3
+            self.assertEqual(line, '%d, %.4f, %.4f, %.4f\n'
+                                   % (ii, ip3*1.5, ip3*2.5, ip3*3.5))
+
+        if os.path.exists(cat_name):
+            os.unlink(cat_name)
+
     def test_empty_chunk(self):
         """
         Test that catalog filtering behaves correctly, even when the first
@@ -418,6 +476,175 @@ class InstanceCatalogTestCase(unittest.TestCase):
         if os.path.exists(cat_name):
             os.unlink(cat_name)
 
+    def test_mixed_type_filters(self):
+        """
+        Test filtering on float, string and object columns at the same time
+        """
+        class FilteredCat10(InstanceCatalog):
+            column_outputs = ['id', 'ip1']
+            cannot_be_null = ['float_filter', 'str_filter', 'obj_filter']
+
+            def get_float_filter(self):
+                ii = self.column_by_name('id')
+                return np.where(ii == 1, np.NaN, ii.astype(float))
+
+            def get_str_filter(self):
+                ii = self.column_by_name('id')
+                return np.where(ii == 3, 'NuLL', 'word')
+
+            def get_obj_filter(self):
+                ii = self.column_by_name('id')
+                values = np.array(ii, dtype=object)
+                values[np.where(ii == 5)] = None
+                values[np.where(ii == 7)] = 'nan'
+                values[np.where(ii == 9)] = np.NaN
+                return values
+
+        cat_name = os.path.join(self.scratch_dir, "inst_mixed_type_filter_cat.txt")
+        if os.path.exists(cat_name):
+            os.unlink(cat_name)
+
+        cat = FilteredCat10(self.db)
+        cat.write_catalog(cat_name)
+        with open(cat_name, 'r') as input_file:
+            input_lines = input_file.readlines()
+
+        self.assertEqual(input_lines[1:],
+                         ['%d, %d\n' % (ii, ii+1) for ii in (0, 2, 4, 6, 8)])
+
+        if os.path.exists(cat_name):
+            os.unlink(cat_name)
+
+    def test_iter_catalog_columns(self):
+        """
+        Test that iter_catalog_columns yields the filtered, transformed
+        columns of the catalog one chunk at a time
+        """
+        class FilteredCat11(InstanceCatalog):
+            column_outputs = ['id', 'ip1', 'ip3t']
+            cannot_be_null = ['ip3t']
+            transformations = {'ip1': np.negative}
+
+            @cached
+            def get_ip3t(self):
+                base = self.column_by_name('ip3')
+                ii = self.column_by_name('id')
+                return np.where(ii % 2 == 0, base, None)
+
+        cat = FilteredCat11(self.db)
+        ids = []
+        for chunk in cat.iter_catalog_columns(chunk_size=3):
+            self.assertEqual(list(chunk.keys()), ['id', 'ip1', 'ip3t'])
+            for name in chunk:
+                self.assertFalse(chunk[name].flags.writeable)
+            np.testing.assert_array_equal(chunk['ip1'], -1*(chunk['id']+1))
+            np.testing.assert_array_equal(chunk['ip3t'], chunk['id']+3)
+            ids += list(chunk['id'])
+        self.assertEqual(ids, [0, 2, 4, 6, 8])
+
+        cat = FilteredCat11(self.db)
+        ids = []
+        for chunk in cat.iter_catalog_columns(chunk_size=3, structured=True):
+            self.assertEqual(chunk.dtype.names, ('id', 'ip1', 'ip3t'))
+            np.testing.assert_array_equal(chunk['ip1'], -1*(chunk['id']+1))
+            ids += list(chunk['id'])
+        self.assertEqual(ids, [0, 2, 4, 6, 8])
+
+    def test_process_pool(self):
+        """
+        Test that writing a filtered catalog with a pool of worker
+        processes produces the same file as writing it serially
+        """
+        class FilteredCat9(InstanceCatalog):
+            column_outputs = ['id', 'ip1', 'ip2t']
+            cannot_be_null = ['ip2t']
+
+            @cached
+            def get_ip2t(self):
+                base = self.column_by_name('ip2')
+                return np.where(base % 3 != 0, base, None)
+
+        serial_name = os.path.join(self.scratch_dir, "inst_serial_pool_cat.txt")
+        pool_name = os.path.join(self.scratch_dir, "inst_process_pool_cat.txt")
+        for cat_name in (serial_name, pool_name):
+            if os.path.exists(cat_name):
+                os.unlink(cat_name)
+
+        serial_cat = FilteredCat9(self.db)
+        serial_cat.write_catalog(serial_name, chunk_size=2)
+        cat = FilteredCat9(self.db)
+        cat.write_catalog(pool_name, chunk_size=2, workers=3)
+
+        # the workers hand their filter statistics back
+        def filter_counts(catalog):
+            return [(entry['source'], entry['calls'], entry['rows_in'], entry['rows_passed'])
+                    for entry in catalog.filter_statistics()['ip2t']]
+        self.assertEqual(filter_counts(cat), filter_counts(serial_cat))
+
+        with open(serial_name, 'r') as input_file:
+            serial_lines = input_file.readlines()
+        with open(pool_name, 'r') as input_file:
+            pool_lines = input_file.readlines()
+
+        self.assertEqual(len(serial_lines), 8)  # 7 data lines and a header
+        self.assertEqual(serial_lines, pool_lines)
+
+        for cat_name in (serial_name, pool_name):
+            if os.path.exists(cat_name):
+                os.unlink(cat_name)
+
+    def test_run_statistics(self):
+        """
+        Test that a catalog written with profile = True records the rows,
+        column calls, cache hits and column origins of each chunk
+        """
+        class FilteredCat12(InstanceCatalog):
+            column_outputs = ['id', 'ip1', 'ip2t']
+            cannot_be_null = ['ip2t']
+            profile = True
+
+            @cached
+            def get_ip2t(self):
+                base = self.column_by_name('ip2')
+                return np.where(base % 3 != 0, base, None)
+
+        cat_name = os.path.join(self.scratch_dir, "inst_run_statistics_cat.txt")
+        if os.path.exists(cat_name):
+            os.unlink(cat_name)
+
+        cat = FilteredCat12(self.db)
+        cat.profile = False
+        cat.write_catalog(cat_name, chunk_size=3)
+        self.assertIsNone(cat.run_statistics())
+
+        for workers in (None, 2):
+            cat = FilteredCat12(self.db)
+            cat.write_catalog(cat_name, chunk_size=3, workers=workers)
+            stats = cat.run_statistics()
+            self.assertEqual(stats.catalog_class, 'FilteredCat12')
+            self.assertEqual([record['rows_in'] for record in stats.chunks], [3, 3, 3, 1])
+            self.assertEqual([record['rows_out'] for record in stats.chunks], [2, 2, 2, 1])
+
+            totals = stats.totals()
+            self.assertEqual(totals['chunks'], 4)
+            self.assertEqual(totals['rows_in'], 10)
+            self.assertEqual(totals['rows_out'], 7)
+
+            columns = stats.column_totals()
+            self.assertEqual(columns['ip2t']['origin'], 'FilteredCat12')
+            self.assertEqual(columns['ip2t']['calls'], 8)  # once to filter, once to write
+            self.assertEqual(columns['ip2t']['cache_hits'], 4)
+            self.assertEqual(columns['ip1']['origin'], 'the database')
+            self.assertEqual(columns['ip1']['calls'], 4)
+            self.assertEqual(columns['ip1']['cache_hits'], 0)
+
+        combined = stats + stats.from_dict(stats.as_dict())
+        self.assertEqual(combined.totals()['rows_in'], 20)
+        self.assertEqual(combined.column_totals()['ip2t']['calls'], 16)
+
+        if os.path.exists(cat_name):
+            os.unlink(cat_name)
+
 
 class CompoundInstanceCatalogTestCase(unittest.TestCase):
     """
@@ -137,6 +137,21 @@ class severalCannotBeNullCatalog(InstanceCatalog):
     cannot_be_null = ['n2', 'n4']
 
 
+class countingCannotBeNullCatalog(InstanceCatalog):
+    """
+    This catalog class filters on a database column and on a getter column,
+    counting the number of rows on which the getter is evaluated
+    """
+    column_outputs = ['id', 'n1', 'n2']
+    cannot_be_null = ['n1_plus_one', 'n2']
+    rows_seen = 0
+
+    def get_n1_plus_one(self):
+        n1 = self.column_by_name('n1')
+        self.rows_seen += len(n1)
+        return n1 + 1.0
+
+
 class CanBeNullCatalog(InstanceCatalog):
     """
     This catalog class will write all rows to the catalog
@@ -461,6 +476,62 @@ class InstanceCatalogCannotBeNullTest(unittest.TestCase):
                 if os.path.exists(control_fileName):
                     os.unlink(control_fileName)
 
+        def testDatabaseFiltersFirst(self):
+            """
+            Check that cannot_be_null columns that come straight from the database
+            are checked before any getter columns are calculated, and that the
+            statistics of each predicate are recorded.
+            """
+            scratch_dir = os.path.join(getPackageDir('sims_catalogs'), 'tests', 'scratchSpace')
+            fileName = os.path.join(scratch_dir, 'cannotBeNullTestFile_ordering.txt')
+
+            dbobj = CatalogDBObject.from_objid('cannotBeNull')
+            cat = countingCannotBeNullCatalog(dbobj)
+            cat.write_catalog(fileName, chunk_size=10)
+
+            n2_valid = np.logical_not(np.isnan(self.baselineOutput['n2']))
+            both_valid = np.logical_and(n2_valid,
+                                        np.logical_not(np.isnan(self.baselineOutput['n1'])))
+
+            self.assertEqual(cat.rows_seen, n2_valid.sum())
+
+            stats = cat.filter_statistics()
+            self.assertEqual(len(stats['n2']), 1)
+            self.assertEqual(stats['n2'][0]['source'], 'database')
+            self.assertEqual(stats['n2'][0]['rows_in'], len(self.baselineOutput))
+            self.assertEqual(stats['n2'][0]['rows_passed'], n2_valid.sum())
+            self.assertEqual(len(stats['n1_plus_one']), 1)
+            self.assertEqual(stats['n1_plus_one'][0]['source'], 'getter')
+            self.assertEqual(stats['n1_plus_one'][0]['rows_in'], n2_valid.sum())
+            self.assertEqual(stats['n1_plus_one'][0]['rows_passed'], both_valid.sum())
+
+            with open(fileName, 'r') as input_file:
+                input_lines = input_file.readlines()
+            self.assertEqual(len(input_lines), both_valid.sum()+1)
+
+            if os.path.exists(fileName):
+                os.unlink(fileName)
+
+        def testNullPredicates(self):
+            """
+            Check that only cannot_be_null columns read straight from the database
+            are pushed into the SQL query
+            """
+            dbobj = CatalogDBObject.from_objid('cannotBeNull')
+
+            cat = severalCannotBeNullCatalog(dbobj)
+            self.assertEqual(cat._null_predicates(), ['n2 IS NOT NULL', 'n4 IS NOT NULL'])
+
+            cat = countingCannotBeNullCatalog(dbobj)
+            self.assertEqual(cat._null_predicates(), ['n2 IS NOT NULL'])
+
+            cat = CanBeNullCatalog(dbobj)
+            self.assertEqual(cat._null_predicates(), [])
+
+            self.assertEqual(dbobj.combine_constraints('id < 5', cat._null_predicates()), 'id < 5')
+            self.assertEqual(dbobj.combine_constraints('id < 5', ['n2 IS NOT NULL']),
+                             '(id < 5) AND (n2 IS NOT NULL)')
+
         def testCanBeNull(self):
             """
             Test to make sure that we can still write all rows to catalogs,
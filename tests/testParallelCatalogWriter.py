@@ -3,11 +3,12 @@ import unittest
 import sqlite3
 import os
 import numpy as np
+from collections import OrderedDict
 
 import lsst.utils.tests
 from lsst.utils import getPackageDir
 from lsst.sims.utils.CodeUtilities import sims_clean_up
-from lsst.sims.catalogs.definitions import parallelCatalogWriter
+from lsst.sims.catalogs.definitions import parallelCatalogWriter, SharedColumnCache
 from lsst.sims.catalogs.definitions import InstanceCatalog
 from lsst.sims.catalogs.decorators import compound, cached
 from lsst.sims.catalogs.db import CatalogDBObject
@@ -17,6 +18,37 @@ def setup_module(module):
     lsst.utils.tests.init()
 
 
+class SharedBaseCat(InstanceCatalog):
+    expensive_calls = 0
+
+    def get_expensive(self):
+        SharedBaseCat.expensive_calls += 1
+        return self.column_by_name('ii')*2.5 + self.column_by_name('offset')
+
+    def get_offset(self):
+        return self.column_by_name('id')*0.0
+
+
+class SharedCatAll(SharedBaseCat):
+    column_outputs = ['id', 'expensive', 'ii']
+
+
+class SharedCatOdd(SharedBaseCat):
+    column_outputs = ['id', 'expensive']
+    cannot_be_null = ['odd']
+
+    def get_odd(self):
+        ii = self.column_by_name('id')
+        return np.where(ii % 2 == 1, ii, None)
+
+
+class SharedCatOffset(SharedBaseCat):
+    column_outputs = ['id', 'expensive']
+
+    def get_offset(self):
+        return self.column_by_name('id')*1.0
+
+
 class DbClass(CatalogDBObject):
     tableid = 'test'
     database = os.path.join(getPackageDir('sims_catalogs'),
@@ -243,6 +275,176 @@ class ParallelWriterTestCase(unittest.TestCase):
         self.assertEqual(ct_in_3, len(data3['id']))
         self.assertEqual(ct, 100)
 
+    def test_parallel_writing_async(self):
+        """
+        Test that parallelCatalogWriter writes the same catalogs with
+        async_write=True as without it
+        """
+
+        db = DbClass()
+
+        serial_names = [os.path.join(self.scratch_dir, 'par_serial_test%d.txt' % ii)
+                        for ii in range(3)]
+        async_names = [os.path.join(self.scratch_dir, 'par_async_test%d.txt' % ii)
+                       for ii in range(3)]
+
+        for file_name in serial_names + async_names:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+        for name_list, async_write in ((serial_names, False), (async_names, True)):
+            class_dict = {name_list[0]: CatClass1(db),
+                          name_list[1]: CatClass2(db),
+                          name_list[2]: CatClass3(db)}
+
+            parallelCatalogWriter(class_dict, chunk_size=7, async_write=async_write)
+
+        for serial_name, async_name in zip(serial_names, async_names):
+            with open(serial_name, 'r') as input_file:
+                serial_lines = input_file.readlines()
+            with open(async_name, 'r') as input_file:
+                async_lines = input_file.readlines()
+            self.assertGreater(len(serial_lines), 1)
+            self.assertEqual(serial_lines, async_lines)
+
+        for file_name in serial_names + async_names:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+    def test_parallel_writing_threads(self):
+        """
+        Test that parallelCatalogWriter writes the same catalogs when the
+        catalogs are processed on a pool of threads, and reports
+        the timing of each catalog
+        """
+
+        db = DbClass()
+
+        serial_names = [os.path.join(self.scratch_dir, 'par_unthreaded_test%d.txt' % ii)
+                        for ii in range(3)]
+        thread_names = [os.path.join(self.scratch_dir, 'par_threaded_test%d.txt' % ii)
+                        for ii in range(3)]
+
+        for file_name in serial_names + thread_names:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+        timing = {}
+        for name_list, threads in ((serial_names, None), (thread_names, 3)):
+            class_dict = {name_list[0]: CatClass1(db),
+                          name_list[1]: CatClass2(db),
+                          name_list[2]: CatClass3(db)}
+
+            timing[threads] = parallelCatalogWriter(class_dict, chunk_size=7, threads=threads)
+
+        for serial_name, thread_name in zip(serial_names, thread_names):
+            with open(serial_name, 'r') as input_file:
+                serial_lines = input_file.readlines()
+            with open(thread_name, 'r') as input_file:
+                thread_lines = input_file.readlines()
+            self.assertGreater(len(serial_lines), 1)
+            self.assertEqual(serial_lines, thread_lines)
+
+            for threads, file_name in ((None, serial_name), (3, thread_name)):
+                file_timing = timing[threads][file_name]
+                self.assertEqual(file_timing['rows'], len(serial_lines)-1)
+                self.assertEqual(file_timing['chunks'], 15)  # 100 rows in chunks of 7
+                self.assertGreater(file_timing['process_time'], 0.0)
+                self.assertGreaterEqual(file_timing['write_time'], 0.0)
+
+        for file_name in serial_names + thread_names:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+
+    def test_shared_columns(self):
+        """
+        Test that parallelCatalogWriter with share_columns=True calculates a
+        column once for catalogs that provide it with the same getters
+        (even when their filters differ), but not for a catalog which
+        provides one of its inputs differently, and that the catalogs
+        are unchanged
+        """
+
+        db = DbClass()
+
+        names = {}
+        for tag in ('unshared', 'shared'):
+            names[tag] = [os.path.join(self.scratch_dir, 'par_%s_test%d.txt' % (tag, ii))
+                          for ii in range(3)]
+
+        for file_name in names['unshared'] + names['shared']:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+        calls = {}
+        shared_cache = SharedColumnCache()
+        for tag, share_columns in (('unshared', False), ('shared', shared_cache)):
+            name_list = names[tag]
+            class_dict = OrderedDict([(name_list[0], SharedCatAll(db)),
+                                      (name_list[1], SharedCatOdd(db)),
+                                      (name_list[2], SharedCatOffset(db))])
+
+            SharedBaseCat.expensive_calls = 0
+            timing = parallelCatalogWriter(class_dict, chunk_size=7, share_columns=share_columns)
+            calls[tag] = SharedBaseCat.expensive_calls
+
+        # 100 rows in chunks of 7
+        self.assertEqual(calls['unshared'], 45)
+        self.assertEqual(calls['shared'], 30)
+
+        self.assertEqual(timing[names['shared'][1]]['shared_column_hits'], 15)
+        self.assertEqual(timing[names['shared'][0]]['shared_column_hits'], 0)
+        self.assertEqual(timing[names['shared'][2]]['shared_column_hits'], 0)
+        self.assertGreater(shared_cache.statistics()['hit_rate'], 0.0)
+
+        for unshared_name, shared_name in zip(names['unshared'], names['shared']):
+            with open(unshared_name, 'r') as input_file:
+                unshared_lines = input_file.readlines()
+            with open(shared_name, 'r') as input_file:
+                shared_lines = input_file.readlines()
+            self.assertGreater(len(unshared_lines), 1)
+            self.assertEqual(unshared_lines, shared_lines)
+
+        for file_name in names['unshared'] + names['shared']:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+
+    def test_shared_column_sources(self):
+        """
+        Test that SharedColumnCache does not give the columns of a catalog
+        reading one compound source to a catalog of the same class
+        reading another one (e.g. the bulges and the disks of galaxies)
+        """
+        db = DbClass()
+        bulge_cat = SharedCatAll(db)
+        disk_cat = SharedCatAll(db)
+        bulge_cat._shared_column_source = 'bulge'
+        disk_cat._shared_column_source = 'disk'
+
+        cache = SharedColumnCache()
+        identity = SharedColumnCache.column_identity(bulge_cat, 'expensive')
+        closure = (('ii', SharedColumnCache.column_identity(bulge_cat, 'ii')),)
+        rows = np.arange(5)
+        cache.store('expensive', identity, rows, np.arange(5)*2.5, closure)
+
+        value, found_closure = cache.lookup(bulge_cat, 'expensive', identity, rows)
+        np.testing.assert_array_equal(value, np.arange(5)*2.5)
+
+        value, found_closure = cache.lookup(disk_cat, 'expensive', identity, rows)
+        self.assertIsNone(value)
+
+        # repeated lookups of a column by a catalog count once per chunk
+        cache.lookup(bulge_cat, 'expensive', identity, rows[1:])
+        cache.lookup(disk_cat, 'expensive', identity, rows)
+        self.assertEqual(cache.catalog_statistics(bulge_cat)['hits'], 1)
+        self.assertEqual(cache.catalog_statistics(disk_cat)['misses'], 1)
+        cache.new_chunk()
+        cache.lookup(disk_cat, 'expensive', identity, rows)
+        self.assertEqual(cache.catalog_statistics(disk_cat)['misses'], 2)
+        self.assertEqual(cache.statistics()['hits'], 1)
+
 
 class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
     pass
@@ -0,0 +1,261 @@
+from __future__ import with_statement
+import unittest
+import os
+import numpy as np
+
+import lsst.utils.tests
+from lsst.utils import getPackageDir
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.catalogs.definitions import InstanceCatalog
+from lsst.sims.catalogs.db import fileDBObject
+from lsst.sims.catalogs.decorators import persistent_cached, compound, PersistentColumnStore
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+_memory_store = PersistentColumnStore(max_entries=1000)
+
+
+class PersistentCat(InstanceCatalog):
+    column_outputs = ['id', 'norm']
+    calculated_rows = []
+
+    @persistent_cached(store=_memory_store)
+    def get_norm(self):
+        ii = self.column_by_name('id')
+        PersistentCat.calculated_rows.extend(ii.tolist())
+        return np.sqrt(self.column_by_name('ip1')*1.0)
+
+
+class PersistentColumnStoreTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = os.path.join(getPackageDir('sims_catalogs'), 'tests', 'scratchSpace')
+
+        cls.db_src_name = os.path.join(cls.scratch_dir, 'persistent_cache_db.txt')
+        if os.path.exists(cls.db_src_name):
+            os.unlink(cls.db_src_name)
+
+        with open(cls.db_src_name, 'w') as output_file:
+            output_file.write('#a header\n')
+            for ii in range(100):
+                output_file.write('%d %d\n' % (ii, ii+1))
+
+        dtype = np.dtype([('id', int), ('ip1', int)])
+        cls.db = fileDBObject(cls.db_src_name, runtable='test', dtype=dtype,
+                              idColKey='id')
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+
+        del cls.db
+
+        if os.path.exists(cls.db_src_name):
+            os.unlink(cls.db_src_name)
+
+    def test_store(self):
+        """
+        Test lookups, LRU eviction and persistence to disk
+        """
+        root = os.path.join(self.scratch_dir, 'persistent_cache_store')
+        store = PersistentColumnStore(max_entries=5, filename=root)
+        store.clear()
+
+        store.store([1, 2, 3], [10.0, 20.0, 30.0])
+        values, found = store.lookup([3, 4, 1])
+        np.testing.assert_array_equal(found, [True, False, True])
+        self.assertEqual(values[0], 30.0)
+        self.assertEqual(values[2], 10.0)
+
+        # evicting 2 and 3 flushes them to disk, so they are still found
+        store.store([5, 6, 7, 8], [50.0, 60.0, 70.0, 80.0])
+        self.assertEqual(store.statistics()['memory_entries'], 5)
+        values, found = store.lookup([2, 3, 8])
+        self.assertTrue(found.all())
+        np.testing.assert_array_equal(values, [20.0, 30.0, 80.0])
+
+        stats = store.statistics()
+        self.assertEqual(stats['hits'], 5)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['disk_hits'], 2)
+        store.close()
+
+        # a new store on the same files sees every value stored above
+        store = PersistentColumnStore(max_entries=5, filename=root)
+        self.assertEqual(len(store), 7)
+        values, found = store.lookup([1, 2, 3, 5, 6, 7, 8, 9])
+        np.testing.assert_array_equal(found, [True]*7 + [False])
+        np.testing.assert_array_equal(values[:7], [10.0, 20.0, 30.0, 50.0, 60.0, 70.0, 80.0])
+
+        store.clear()
+        self.assertFalse(os.path.exists(root + '_ids.npy'))
+
+        # without a file, evicted values are lost
+        store = PersistentColumnStore(max_entries=2)
+        store.store([1, 2, 3], [1.0, 2.0, 3.0])
+        values, found = store.lookup([1, 2, 3])
+        np.testing.assert_array_equal(found, [False, True, True])
+
+    def test_runs(self):
+        """
+        Test that evicted values are written to a few merged runs,
+        which are found by lookups and merged into the main files by flush()
+        """
+        root = os.path.join(self.scratch_dir, 'persistent_cache_runs')
+        store = PersistentColumnStore(max_entries=4, filename=root)
+        store.clear()
+
+        def run_files():
+            return [name for name in os.listdir(self.scratch_dir)
+                    if name.startswith('persistent_cache_runs_run')]
+
+        for start in range(0, 64, 4):
+            store.store(np.arange(start, start+4), np.arange(start, start+4)*2.0)
+            self.assertLessEqual(len(run_files()), 5)
+        self.assertFalse(os.path.exists(root + '_ids.npy'))
+        self.assertEqual(len(store), 64)
+
+        # newer values of an id replace the older ones in the runs
+        store.store([0, 1, 2, 3], [-1.0, -1.0, -1.0, -1.0])
+        store.store([100, 101, 102, 103], [0.0, 0.0, 0.0, 0.0])
+        values, found = store.lookup(np.arange(64))
+        self.assertTrue(found.all())
+        np.testing.assert_array_equal(values[:4], [-1.0]*4)
+        np.testing.assert_array_equal(values[4:], np.arange(4, 64)*2.0)
+
+        store.flush()
+        self.assertEqual(run_files(), [])
+        self.assertEqual(len(np.load(root + '_ids.npy')), 68)
+        values, found = store.lookup([0, 63, 103])
+        self.assertTrue(found.all())
+        np.testing.assert_array_equal(values, [-1.0, 126.0, 0.0])
+
+        store.clear()
+        self.assertEqual(run_files(), [])
+        self.assertFalse(os.path.exists(root + '_ids.npy'))
+
+    def test_object_types(self):
+        """
+        Test that objects of different types with the same ids are kept
+        apart, in memory and on disk, and that each is only counted once
+        """
+        root = os.path.join(self.scratch_dir, 'persistent_cache_types')
+        store = PersistentColumnStore(max_entries=5, filename=root)
+        store.clear()
+
+        store.store([1, 2], [10.0, 20.0], object_type='bulge')
+        store.store([1, 2], [-10.0, -20.0], object_type='disk')
+        values, found = store.lookup([1, 2], object_type='disk')
+        self.assertTrue(found.all())
+        np.testing.assert_array_equal(values, [-10.0, -20.0])
+        values, found = store.lookup([1, 2])
+        self.assertFalse(found.any())
+        self.assertEqual(len(store), 4)
+
+        store.flush()
+        # storing an id which is already on disk again does not add an entry
+        store.store([2, 3], [21.0, 30.0], object_type='bulge')
+        self.assertEqual(len(store), 5)
+        store.close()
+
+        store = PersistentColumnStore(max_entries=5, filename=root)
+        self.assertEqual(len(store), 5)
+        values, found = store.lookup([1, 2, 3], object_type='bulge')
+        self.assertTrue(found.all())
+        np.testing.assert_array_equal(values, [10.0, 21.0, 30.0])
+        values, found = store.lookup([1, 2, 3], object_type='disk')
+        np.testing.assert_array_equal(found, [True, True, False])
+        np.testing.assert_array_equal(values[:2], [-10.0, -20.0])
+
+        store.clear()
+        self.assertFalse(os.path.exists(root + '.bulge_ids.npy'))
+        self.assertFalse(os.path.exists(root + '.disk_ids.npy'))
+
+    def test_catalog(self):
+        """
+        Test that a @persistent_cached getter only calculates each
+        object once, across chunks and catalogs, and that the catalogs
+        are unchanged
+        """
+        _memory_store.clear()
+        PersistentCat.calculated_rows = []
+
+        control_name = os.path.join(self.scratch_dir, 'persistent_cache_control.txt')
+        test_name = os.path.join(self.scratch_dir, 'persistent_cache_test.txt')
+        for file_name in (control_name, test_name):
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+        cat = PersistentCat(self.db, constraint='id<60')
+        cat.write_catalog(control_name, chunk_size=13)
+        self.assertEqual(sorted(PersistentCat.calculated_rows), list(range(60)))
+
+        # the second catalog only needs to calculate the new objects
+        PersistentCat.calculated_rows = []
+        cat = PersistentCat(self.db)
+        cat.write_catalog(test_name, chunk_size=17)
+        self.assertEqual(sorted(PersistentCat.calculated_rows), list(range(60, 100)))
+
+        stats = _memory_store.statistics()
+        self.assertEqual(stats['hits'], 60)
+        self.assertEqual(stats['misses'], 100)
+
+        with open(control_name, 'r') as input_file:
+            control_lines = input_file.readlines()
+        with open(test_name, 'r') as input_file:
+            test_lines = input_file.readlines()
+        self.assertEqual(len(control_lines), 61)
+        self.assertEqual(len(test_lines), 101)
+        self.assertEqual(control_lines[1:], test_lines[1:61])
+        for line in test_lines[1:]:
+            ii, norm = line.split(',')
+            self.assertAlmostEqual(float(norm), np.sqrt(int(ii)+1.0), 3)
+
+        for file_name in (control_name, test_name):
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+    def test_workers(self):
+        """
+        Test that the values calculated in the worker processes of
+        write_catalog(workers=N) are added to the store of the parent process
+        """
+        _memory_store.clear()
+        test_name = os.path.join(self.scratch_dir, 'persistent_cache_workers.txt')
+
+        cat = PersistentCat(self.db)
+        cat.write_catalog(test_name, chunk_size=13, workers=2)
+        self.assertEqual(len(_memory_store), 100)
+
+        # so that a later catalog calculates nothing
+        PersistentCat.calculated_rows = []
+        cat = PersistentCat(self.db)
+        cat.write_catalog(test_name, chunk_size=17)
+        self.assertEqual(PersistentCat.calculated_rows, [])
+
+        if os.path.exists(test_name):
+            os.unlink(test_name)
+
+    def test_compound(self):
+        """
+        Test that @persistent_cached refuses compound getters
+        """
+        with self.assertRaises(ValueError):
+            class BadCat(InstanceCatalog):
+                @persistent_cached()
+                @compound('a', 'b')
+                def get_ab(self):
+                    return np.array([[], []])
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,178 @@
+from __future__ import with_statement
+import unittest
+import os
+import sqlite3
+import numpy as np
+
+import lsst.utils.tests
+from lsst.utils import getPackageDir
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.catalogs.definitions import InstanceCatalog
+from lsst.sims.catalogs.db import fileDBObject, CatalogDBObject, CompoundCatalogDBObject
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class SampledCat(InstanceCatalog):
+    column_outputs = ['id', 'ip1']
+
+
+class RemappedIdDB(CatalogDBObject):
+    """
+    A table whose id column is called obj_id, read as id
+    """
+    tableid = 'remapped'
+    database = os.path.join(getPackageDir('sims_catalogs'),
+                            'tests', 'scratchSpace', 'sampled_remapped_id.db')
+    host = None
+    port = None
+    driver = 'sqlite'
+    objid = 'sampled_remapped_id'
+    idColKey = 'id'
+    columns = [('id', 'obj_id', int)]
+
+
+class RemappedIdTwiceDB(RemappedIdDB):
+    objid = 'sampled_remapped_id_twice'
+    columns = [('id', 'obj_id', int), ('twice', '2*ip1', int)]
+
+
+class SampledCatalogTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = os.path.join(getPackageDir('sims_catalogs'), 'tests', 'scratchSpace')
+
+        cls.db_src_name = os.path.join(cls.scratch_dir, 'sampled_cat_db.txt')
+        if os.path.exists(cls.db_src_name):
+            os.unlink(cls.db_src_name)
+
+        with open(cls.db_src_name, 'w') as output_file:
+            output_file.write('#a header\n')
+            for ii in range(2000):
+                output_file.write('%d %d\n' % (ii, 3*ii))
+
+        dtype = np.dtype([('id', int), ('ip1', int)])
+        cls.db = fileDBObject(cls.db_src_name, runtable='test', dtype=dtype,
+                              idColKey='id')
+
+        if os.path.exists(RemappedIdDB.database):
+            os.unlink(RemappedIdDB.database)
+        conn = sqlite3.connect(RemappedIdDB.database)
+        c = conn.cursor()
+        c.execute('''CREATE TABLE remapped (obj_id int, ip1 int)''')
+        for ii in range(2000):
+            c.execute('''INSERT INTO remapped VALUES(%i, %i)''' % (ii, 3*ii))
+        conn.commit()
+        conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+
+        del cls.db
+
+        for file_name in (cls.db_src_name, RemappedIdDB.database):
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+    def read_ids(self, file_name):
+        with open(file_name, 'r') as input_file:
+            lines = input_file.readlines()[1:]
+        ids = [int(line.split(',')[0]) for line in lines]
+        for line, ii in zip(lines, ids):
+            self.assertEqual(line, '%d, %d\n' % (ii, 3*ii))
+        return ids
+
+    def test_sampled_catalog(self):
+        """
+        Test that write_catalog and iter_catalog with sample_fraction select
+        the objects chosen by CatalogDBObject.sample_mask, in SQL and on the
+        client, reproducibly
+        """
+        file_name = os.path.join(self.scratch_dir, 'sampled_cat.txt')
+        if os.path.exists(file_name):
+            os.unlink(file_name)
+
+        self.assertIsNotNone(self.db.sample_predicate(0.1, seed=3))
+        all_ids = np.arange(2000)
+        expected = all_ids[CatalogDBObject.sample_mask(all_ids, 0.1, seed=3)].tolist()
+        self.assertGreater(len(expected), 150)
+        self.assertLess(len(expected), 250)
+
+        cat = SampledCat(self.db)
+        cat.write_catalog(file_name, chunk_size=100, sample_fraction=0.1, seed=3)
+        self.assertEqual(self.read_ids(file_name), expected)
+
+        # the same sample again
+        cat = SampledCat(self.db)
+        cat.write_catalog(file_name, sample_fraction=0.1, seed=3)
+        self.assertEqual(self.read_ids(file_name), expected)
+
+        # a different seed selects different objects
+        cat = SampledCat(self.db)
+        cat.write_catalog(file_name, sample_fraction=0.1, seed=4)
+        self.assertNotEqual(self.read_ids(file_name), expected)
+
+        cat = SampledCat(self.db)
+        self.assertEqual([line[0] for line in cat.iter_catalog(chunk_size=100, sample_fraction=0.1, seed=3)],
+                         expected)
+
+        # sampling on the client gives the same objects
+        self.db._sample_dialects = ()
+        try:
+            self.assertIsNone(self.db.sample_predicate(0.1, seed=3))
+            cat = SampledCat(self.db)
+            cat.write_catalog(file_name, chunk_size=7, sample_fraction=0.1, seed=3)
+            self.assertEqual(self.read_ids(file_name), expected)
+        finally:
+            del self.db._sample_dialects
+
+        with self.assertRaises(RuntimeError):
+            SampledCat(self.db).write_catalog(file_name, sample_fraction=1.5)
+
+        if os.path.exists(file_name):
+            os.unlink(file_name)
+
+    def test_remapped_id(self):
+        """
+        Test sampling a table whose id column is mapped from a column
+        with another name, with and without the id among the columns
+        queried, in SQL and on the client, and through a
+        CompoundCatalogDBObject
+        """
+        all_ids = np.arange(2000)
+        expected = all_ids[CatalogDBObject.sample_mask(all_ids, 0.1, seed=3)].tolist()
+
+        db = RemappedIdDB()
+        compound_db = CompoundCatalogDBObject([RemappedIdDB, RemappedIdTwiceDB])
+        self.assertIsNotNone(compound_db.sample_predicate(0.1, seed=3))
+
+        for in_sql in (True, False):
+            if not in_sql:
+                db._sample_dialects = ()
+                compound_db._sample_dialects = ()
+
+            for colnames, id_label in ((['ip1'], 'obj_id'), (['id', 'ip1'], 'id')):
+                chunks = list(db.query_columns(colnames=colnames, chunk_size=100,
+                                               sample_fraction=0.1, seed=3))
+                self.assertEqual(sum([chunk[id_label].tolist() for chunk in chunks], []), expected)
+                for chunk in chunks:
+                    np.testing.assert_array_equal(chunk['ip1'], 3*chunk[id_label])
+
+            colnames = ['sampled_remapped_id_ip1', 'sampled_remapped_id_twice_twice']
+            chunks = list(compound_db.query_columns(colnames=colnames, chunk_size=100,
+                                                    sample_fraction=0.1, seed=3))
+            ip1 = sum([chunk['sampled_remapped_id_ip1'].tolist() for chunk in chunks], [])
+            self.assertEqual(ip1, [3*ii for ii in expected])
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,155 @@
+from __future__ import with_statement
+import unittest
+import os
+import json
+import numpy as np
+
+import lsst.utils.tests
+from lsst.utils import getPackageDir
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.catalogs.definitions import ShardedCatalogWriter
+from skyCatalogFixtures import SkyCat, makeSkyFileDB
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class ShardedCatalogTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = os.path.join(getPackageDir('sims_catalogs'), 'tests', 'scratchSpace')
+
+        cls.db_src_name = os.path.join(cls.scratch_dir, 'sharded_cat_db.txt')
+        cls.db = makeSkyFileDB(cls.db_src_name, size=100, seedVal=6411)
+
+        cls.control_name = os.path.join(cls.scratch_dir, 'sharded_cat_control.txt')
+        SkyCat(cls.db).write_catalog(cls.control_name)
+        with open(cls.control_name, 'r') as input_file:
+            cls.control_lines = input_file.readlines()
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+
+        del cls.db
+
+        for file_name in (cls.db_src_name, cls.control_name):
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+    def read_shards(self, root, manifest):
+        """
+        Read the shards listed in manifest; return a list of the lists
+        of lines in each shard, after verifying their headers and row counts
+        """
+        self.assertEqual(manifest, json.load(open(root + '_manifest.json', 'r')))
+        shard_lines = []
+        for entry in manifest['shards']:
+            file_name = os.path.join(self.scratch_dir, entry['file'])
+            with open(file_name, 'r') as input_file:
+                lines = input_file.readlines()
+            self.assertEqual(lines[0], self.control_lines[0])
+            self.assertEqual(len(lines)-1, entry['rows'])
+            self.assertEqual(sum(len(line) for line in lines), entry['bytes'])
+            shard_lines.append(lines[1:])
+        return shard_lines
+
+    def remove_shards(self, root):
+        manifest_name = root + '_manifest.json'
+        if os.path.exists(manifest_name):
+            manifest = json.load(open(manifest_name, 'r'))
+            for entry in manifest['shards']:
+                file_name = os.path.join(self.scratch_dir, entry['file'])
+                if os.path.exists(file_name):
+                    os.unlink(file_name)
+            os.unlink(manifest_name)
+
+    def test_max_rows(self):
+        """
+        Test that sharding on row count splits the catalog into consecutive
+        pieces, with and without workers and async_write
+        """
+        root = os.path.join(self.scratch_dir, 'sharded_rows_cat')
+        for kwargs in ({}, {'workers': 2}, {'async_write': True}):
+            self.remove_shards(root)
+            cat = SkyCat(self.db)
+            manifest = cat.write_sharded_catalog(root + '.txt', max_rows=20, chunk_size=13, **kwargs)
+            shard_lines = self.read_shards(root, manifest)
+            self.assertEqual([len(lines) for lines in shard_lines], [20, 20, 20, 20, 6])
+            self.assertEqual(sum(shard_lines, []), self.control_lines[1:])
+            for entry, lines in zip(manifest['shards'], shard_lines):
+                ra = [float(line.split(',')[1]) for line in lines]
+                self.assertAlmostEqual(entry['ra_min'], min(ra), 2)
+                self.assertAlmostEqual(entry['ra_max'], max(ra), 2)
+        self.remove_shards(root)
+
+    def test_max_bytes(self):
+        """
+        Test that no shard sharded on size exceeds max_bytes
+        """
+        root = os.path.join(self.scratch_dir, 'sharded_bytes_cat')
+        self.remove_shards(root)
+        cat = SkyCat(self.db)
+        manifest = cat.write_sharded_catalog(root + '.txt', max_bytes=500, chunk_size=13)
+        shard_lines = self.read_shards(root, manifest)
+        self.assertGreater(len(shard_lines), 1)
+        for entry in manifest['shards']:
+            self.assertLessEqual(entry['bytes'], 500)
+        self.assertEqual(sum(shard_lines, []), self.control_lines[1:])
+        self.remove_shards(root)
+
+    def test_pixels(self):
+        """
+        Test that sharding on the sky puts each row in the shard
+        of the grid cell containing it
+        """
+        root = os.path.join(self.scratch_dir, 'sharded_pixel_cat')
+        for kwargs in ({}, {'workers': 2}, {'max_open_shards': 2, 'async_write': True}):
+            self.remove_shards(root)
+            cat = SkyCat(self.db)
+            manifest = cat.write_sharded_catalog(root + '.txt', pixel_size=10.0,
+                                                 max_rows=10, chunk_size=13, **kwargs)
+            shard_lines = self.read_shards(root, manifest)
+            self.assertGreater(len(shard_lines), 8)
+            for entry, lines in zip(manifest['shards'], shard_lines):
+                self.assertLessEqual(len(lines), 10)
+                for line in lines:
+                    # allow for the rounding of the output
+                    ra, dec = [float(xx) for xx in line.split(',')[1:]]
+                    self.assertGreaterEqual(ra, 10.0*entry['pixel'][0] - 1.0e-4)
+                    self.assertLessEqual(ra, 10.0*(entry['pixel'][0]+1) + 1.0e-4)
+                    self.assertGreaterEqual(dec, 10.0*entry['pixel'][1] - 1.0e-4)
+                    self.assertLessEqual(dec, 10.0*(entry['pixel'][1]+1) + 1.0e-4)
+            self.assertEqual(sorted(sum(shard_lines, [])), sorted(self.control_lines[1:]))
+        self.remove_shards(root)
+
+        # rows with NaN positions go to shards of their own
+        with ShardedCatalogWriter(root + '.txt', pixel_size=10.0, max_open_shards=1) as writer:
+            writer.set_coordinates([5.0, np.NaN, 15.0, 6.0], [5.0, 5.0, 5.0, np.NaN])
+            writer.writelines(['a\n', 'b\n', 'c\n', 'd\n'])
+        manifest = writer.manifest()
+        self.assertEqual(len(manifest['shards']), 3)
+        nan_entries = [entry for entry in manifest['shards'] if entry.get('nan_coordinates', False)]
+        self.assertEqual(len(nan_entries), 1)
+        self.assertNotIn('pixel', nan_entries[0])
+        self.assertNotIn('ra_min', nan_entries[0])
+        with open(os.path.join(self.scratch_dir, nan_entries[0]['file']), 'r') as input_file:
+            self.assertEqual(input_file.readlines(), ['b\n', 'd\n'])
+        self.remove_shards(root)
+
+        class NoPositionCat(SkyCat):
+            column_outputs = ['id']
+
+        with self.assertRaises(RuntimeError):
+            NoPositionCat(self.db).write_sharded_catalog(root + '.txt', pixel_size=10.0)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,157 @@
+from __future__ import with_statement
+import unittest
+import os
+import StringIO
+import numpy as np
+
+import lsst.utils.tests
+from lsst.utils import getPackageDir
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.catalogs.definitions import InstanceCatalog, SortedCatalogWriter
+from lsst.sims.catalogs.definitions import parallelCatalogWriter
+from skyCatalogFixtures import SkyCat, makeSkyFileDB
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class DecCat(InstanceCatalog):
+    column_outputs = ['decJ2000', 'id']
+
+
+class SortedCatalogTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = os.path.join(getPackageDir('sims_catalogs'), 'tests', 'scratchSpace')
+
+        cls.db_src_name = os.path.join(cls.scratch_dir, 'sorted_cat_db.txt')
+        cls.db = makeSkyFileDB(cls.db_src_name, size=100, seedVal=8812)
+
+        cls.control_name = os.path.join(cls.scratch_dir, 'sorted_cat_control.txt')
+        SkyCat(cls.db).write_catalog(cls.control_name)
+        with open(cls.control_name, 'r') as input_file:
+            cls.control_lines = input_file.readlines()
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+
+        del cls.db
+
+        for file_name in (cls.db_src_name, cls.control_name):
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+    def spilled_runs(self):
+        return [name for name in os.listdir(self.scratch_dir) if name.endswith('.npy')]
+
+    def test_writer(self):
+        """
+        Test that SortedCatalogWriter merges the runs of several segments
+        in the order of their keys, ranks and writing, with NaN keys last
+        """
+        output = StringIO.StringIO()
+        output.write('# header\n')
+        with SortedCatalogWriter(output, max_rows_in_memory=2, scratch_dir=self.scratch_dir) as writer:
+            segment_1 = writer.segment(1)
+            segment_1.set_sort_keys([2.0, 1.0, np.NaN])
+            segment_1.writelines(['b1\n', 'a1\n', 'n1\n'])
+
+            writer.set_sort_keys([3.0, 1.0, np.NaN, 2.0])
+            writer.write('c0\na0\nn0\n')
+            writer.writelines(['b0\n'])
+
+            segment_1.set_sort_keys([0.5])
+            segment_1.write('z1\n')
+            segment_1.close()
+
+            self.assertGreater(len(writer.spilled_runs), 0)
+            spilled_runs = writer.spilled_runs
+
+            with self.assertRaises(RuntimeError):
+                writer.writelines(['x\n'])
+
+        self.assertEqual(output.getvalue(), '# header\nz1\na0\na1\nb0\nb1\nc0\nn0\nn1\n')
+        for run_name in spilled_runs:
+            self.assertFalse(os.path.exists(run_name))
+
+        output = StringIO.StringIO()
+        with SortedCatalogWriter(output) as writer:
+            with self.assertRaises(RuntimeError):
+                writer.writelines(['x\n'])
+            writer.set_sort_keys(['b', 'a'])
+            with self.assertRaises(RuntimeError):
+                writer.write('b\na')
+            writer.writelines(['b\n', 'a\n'])
+        self.assertEqual(output.getvalue(), 'a\nb\n')
+
+    def test_write_catalog(self):
+        """
+        Test that write_catalog with sort_by writes the rows of the catalog
+        in the order of the column, spilling runs to disk, with and without
+        workers and async_write
+        """
+        file_name = os.path.join(self.scratch_dir, 'sorted_cat_test.txt')
+        for kwargs in ({}, {'workers': 2}, {'async_write': True}):
+            cat = SkyCat(self.db)
+            cat.write_catalog(file_name, chunk_size=13, sort_by='raJ2000',
+                              max_rows_in_memory=7, **kwargs)
+            with open(file_name, 'r') as input_file:
+                lines = input_file.readlines()
+
+            self.assertEqual(lines[0], self.control_lines[0])
+            self.assertEqual(sorted(lines[1:]), sorted(self.control_lines[1:]))
+            ra = [float(line.split(',')[1]) for line in lines[1:]]
+            self.assertEqual(ra, sorted(ra))
+            self.assertEqual(self.spilled_runs(), [])
+
+        # without a limit on memory, nothing is spilled
+        cat = SkyCat(self.db)
+        cat.write_catalog(file_name, chunk_size=13, sort_by='id', write_header=False)
+        with open(file_name, 'r') as input_file:
+            lines = input_file.readlines()
+        self.assertEqual(lines, self.control_lines[1:])
+
+        with self.assertRaises(RuntimeError):
+            SkyCat(self.db).write_catalog(file_name, sort_by='magnitude')
+
+        if os.path.exists(file_name):
+            os.unlink(file_name)
+
+    def test_parallel_catalog_writer(self):
+        """
+        Test that parallelCatalogWriter with sort_by writes each
+        file as write_catalog with sort_by does
+        """
+        sort_name = os.path.join(self.scratch_dir, 'sorted_parallel_sort.txt')
+        dec_name = os.path.join(self.scratch_dir, 'sorted_parallel_dec.txt')
+        control_name = os.path.join(self.scratch_dir, 'sorted_parallel_control.txt')
+
+        for threads in (None, 2):
+            parallelCatalogWriter({sort_name: SkyCat(self.db), dec_name: DecCat(self.db)},
+                                  chunk_size=13, sort_by='decJ2000', max_rows_in_memory=10,
+                                  threads=threads)
+
+            for file_name, cat in ((sort_name, SkyCat(self.db)), (dec_name, DecCat(self.db))):
+                cat.write_catalog(control_name, chunk_size=13, sort_by='decJ2000')
+                with open(control_name, 'r') as input_file:
+                    control_lines = input_file.readlines()
+                with open(file_name, 'r') as input_file:
+                    self.assertEqual(input_file.readlines(), control_lines)
+
+            self.assertEqual(self.spilled_runs(), [])
+
+        for file_name in (sort_name, dec_name, control_name):
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()